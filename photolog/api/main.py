@@ -6,7 +6,7 @@ from photolog.squeue import SqliteQueue
 from photolog.settings import Settings
 from photolog import api_logger as log, settings_file, ALLOWED_FILES
 from photolog.services.api.base import start_batch, end_batch, slugify
-from photolog.services.api.main import allowed_file, queue_file, valid_secret
+from photolog.services.api.main import allowed_file, queue_file, queue_files, valid_secret
 
 settings = Settings.load(settings_file)
 queue = SqliteQueue(settings.DB_FILE)
@@ -62,13 +62,17 @@ def verify_photo():
 @app.route("/photos/", methods=["POST"])
 @csrf.exempt
 def add_photo():
-    uploaded_file = request.files.get("photo_file")
+    uploaded_files = request.files.getlist("photo_file")
     metadata_file = request.files.get("metadata_file", None)
-    if not uploaded_file:
+    if not uploaded_files:
         return jsonify({"error": "Must send an `photo_file`"}), 400
 
-    if not allowed_file(uploaded_file.filename, uploaded_file, ALLOWED_FILES):
-        return jsonify({"error": "Invalid file type or extension"}), 400
+    for uploaded_file in uploaded_files:
+        if not allowed_file(uploaded_file.filename, uploaded_file, ALLOWED_FILES):
+            return jsonify({"error": "Invalid file type or extension"}), 400
+
+    if metadata_file and len(uploaded_files) > 1:
+        return jsonify({"error": "`metadata_file` requires a single `photo_file`"}), 400
 
     secret = request.headers.get("X-PHOTOLOG-SECRET", "")
     if not valid_secret(secret, settings.API_SECRET):
@@ -81,10 +85,17 @@ def add_photo():
     skip = request.form.get("skip", "")
     skip = [t for t in (slugify(t) for t in skip.split(",")) if t.strip()]
     target_date = request.form.get("target_date")
+    if len(uploaded_files) > 1:
+        filenames = queue_files(
+            settings, queue, uploaded_files, tags, skip, batch_id, is_last, target_date
+        )
+        log.info("Queued %s files: %s" % (len(filenames), ", ".join(filenames)))
+        return "", 202
+
     filename = queue_file(
         settings,
         queue,
-        uploaded_file,
+        uploaded_files[0],
         metadata_file,
         tags,
         skip,
@@ -0,0 +1,58 @@
+"""
+MD5 checksums of media files, used to tell if a file was already uploaded.
+Files are read in big buffers, or memory mapped when large, so hashing a
+multi GB video is bound by the disk and not by Python. `checksum_many`
+spreads a list of files over a pool of processes.
+"""
+
+import os
+import mmap
+from hashlib import md5
+from concurrent.futures import ProcessPoolExecutor
+
+BUFFER_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+MAX_WORKERS = 4  # Beyond this the disk, not the CPU, is the limit
+
+
+def file_checksum(filename, buffer_size=BUFFER_SIZE):
+    """Hex MD5 of the file contents"""
+    digest = md5()
+    with open(filename, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(mapped)  # A single call, hashlib releases the GIL
+        else:
+            buf = bytearray(buffer_size)
+            view = memoryview(buf)
+            for read in iter(lambda: fh.readinto(buf), 0):
+                digest.update(view[:read])
+    return digest.hexdigest()
+
+
+def _checksum_or_none(filename):
+    try:
+        return file_checksum(filename)
+    except OSError:
+        return None
+
+
+def checksum_many(filenames, workers=None):
+    """
+    Yields `(filename, checksum)` in the order given, hashing ahead in up to
+    `workers` processes. The checksum is None for files that can't be read.
+    """
+    filenames = list(filenames)
+    if workers is None:
+        workers = min(MAX_WORKERS, os.cpu_count() or 1)
+    workers = min(workers, len(filenames))
+    if workers <= 1:
+        for filename in filenames:
+            yield filename, _checksum_or_none(filename)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from zip(filenames, executor.map(_checksum_or_none, filenames))
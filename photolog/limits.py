@@ -0,0 +1,223 @@
+"""
+Rate limits and circuit breakers for the external services jobs talk to
+(S3, Flickr, Google Photos). Their state lives in a table of the database,
+so every worker process sees the same limits.
+"""
+
+import threading
+from contextlib import contextmanager
+from time import time
+
+import requests
+from boto3.exceptions import Boto3Error
+from botocore.exceptions import BotoCoreError, ClientError
+from flickrapi.exceptions import FlickrError
+
+from photolog.db import BaseDB
+from photolog.settings import setting
+from photolog import queue_logger as log
+
+
+class ServiceUnavailable(Exception):
+    """
+    The service can't take requests for `delay` seconds. Jobs failing with it
+    are given back to the queue to run after that, without using an attempt.
+    """
+
+    def __init__(self, service, delay, reason=None):
+        self.service = service
+        self.delay = delay
+        message = "%s unavailable for %.0fs" % (service, delay)
+        super().__init__("%s: %s" % (message, reason) if reason else message)
+
+
+class Throttled(ServiceUnavailable):
+    """The service asked us to slow down, e.g. with an HTTP 429"""
+
+
+class ServiceError(ValueError):
+    """The service answered a call with an error"""
+
+
+# Failures of the service or of the way to it. Anything else, like a missing
+# local file, fails the job without counting against the service.
+SERVICE_ERRORS = (
+    ServiceError,
+    requests.RequestException,
+    BotoCoreError,
+    ClientError,
+    Boto3Error,
+    FlickrError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class ServiceLimits(BaseDB):
+    """
+    Token bucket rate limiter plus circuit breaker per service.
+
+    Every call to a service takes a token. Tokens come back at `rate` per
+    second up to `burst`; services without a configured rate aren't limited.
+
+    After `max_failures` failed calls in a row the circuit opens and calls are
+    refused for `cooldown` seconds. Then a single call is let through to probe
+    the service: if it works the circuit closes, otherwise it opens again for
+    twice as long (up to MAX_COOLDOWN). A Throttled error opens the circuit
+    right away for as long as the service asked.
+    """
+
+    MAX_COOLDOWN = 60 * 30
+
+    _create = [
+        "CREATE TABLE IF NOT EXISTS service_limits "
+        "("
+        "  service TEXT PRIMARY KEY,"
+        "  tokens REAL,"
+        "  updated REAL,"
+        "  failures INTEGER DEFAULT 0,"
+        "  open_until REAL DEFAULT 0,"
+        "  cooldown REAL DEFAULT 0"
+        ");"
+    ]
+    _write_lock = "BEGIN IMMEDIATE"
+    _get = "SELECT * FROM service_limits WHERE service = ?"
+    _save = (
+        "INSERT OR REPLACE INTO service_limits "
+        "(service, tokens, updated, failures, open_until, cooldown) VALUES (?,?,?,?,?,?)"
+    )
+    _reset = (
+        "UPDATE service_limits SET failures = 0, open_until = 0, cooldown = 0"
+        " WHERE service = ? AND (failures > 0 OR open_until > 0)"
+    )
+
+    def __init__(self, path, rates=None, max_failures=5, cooldown=60):
+        super().__init__(path)
+        self.rates = rates or {}
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+    def _load(self, conn, service, now):
+        state = conn.execute(self._get, [service]).fetchone()
+        if state is None:
+            rate, burst = self.rates.get(service, (None, 1))
+            state = {
+                "service": service,
+                "tokens": burst,
+                "updated": now,
+                "failures": 0,
+                "open_until": 0,
+                "cooldown": 0,
+            }
+        return state
+
+    def _store(self, conn, state):
+        conn.execute(
+            self._save,
+            [
+                state["service"],
+                state["tokens"],
+                state["updated"],
+                state["failures"],
+                state["open_until"],
+                state["cooldown"],
+            ],
+        )
+
+    def acquire(self, service):
+        """
+        Takes a token to call `service`. Returns 0 if the call can be made now,
+        otherwise the seconds to wait before trying again.
+        """
+        now = time()
+        with self._get_conn() as conn:
+            conn.execute(self._write_lock)
+            state = self._load(conn, service, now)
+            if state["open_until"] > now:
+                return state["open_until"] - now
+            wait = 0
+            if service in self.rates:
+                rate, burst = self.rates[service]
+                elapsed = max(0, now - state["updated"])
+                state["tokens"] = min(burst, state["tokens"] + elapsed * rate)
+                state["updated"] = now
+                if state["tokens"] < 1:
+                    wait = (1 - state["tokens"]) / rate
+                else:
+                    state["tokens"] -= 1
+            if not wait and state["failures"] >= self.max_failures:
+                # Half open, this caller probes while the rest keep waiting
+                state["open_until"] = now + (state["cooldown"] or self.cooldown)
+            self._store(conn, state)
+        return wait
+
+    def success(self, service):
+        """Closes the circuit of `service` if it had failures"""
+        with self._get_conn() as conn:
+            conn.execute(self._reset, [service])
+
+    def failure(self, service, delay=None):
+        """
+        Records a failed call to `service`, opening its circuit if needed.
+        `delay` is how long a throttling service asked us to wait.
+        """
+        now = time()
+        with self._get_conn() as conn:
+            conn.execute(self._write_lock)
+            state = self._load(conn, service, now)
+            state["failures"] += 1
+            if delay:
+                state["open_until"] = max(state["open_until"], now + delay)
+            elif state["failures"] >= self.max_failures:
+                if state["cooldown"]:
+                    state["cooldown"] = min(self.MAX_COOLDOWN, state["cooldown"] * 2)
+                else:
+                    state["cooldown"] = self.cooldown
+                state["open_until"] = now + state["cooldown"]
+                log.warning(
+                    "%s failed %s times in a row, pausing it for %ss"
+                    % (service, state["failures"], state["cooldown"])
+                )
+            self._store(conn, state)
+
+    def status(self, service):
+        with self._get_conn() as conn:
+            return conn.execute(self._get, [service]).fetchone()
+
+    @contextmanager
+    def guard(self, service):
+        """
+        Wraps a call to `service`. Raises ServiceUnavailable instead of making
+        the call when it is rate limited or its circuit is open, and records
+        how the call went. Only SERVICE_ERRORS count as failures.
+        """
+        wait = self.acquire(service)
+        if wait > 0:
+            raise ServiceUnavailable(service, wait)
+        try:
+            yield
+        except ServiceUnavailable as err:
+            self.failure(service, err.delay)
+            raise
+        except SERVICE_ERRORS:
+            self.failure(service)
+            raise
+        else:
+            self.success(service)
+
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def get_limits(path, settings):
+    """Service limits stored in the database at `path`, set up once per process"""
+    with _limits_lock:
+        if path not in _limits:
+            _limits[path] = ServiceLimits(
+                path,
+                setting(settings, "SERVICE_RATE_LIMITS"),
+                setting(settings, "CIRCUIT_BREAKER_FAILURES"),
+                setting(settings, "CIRCUIT_BREAKER_COOLDOWN"),
+            )
+        return _limits[path]
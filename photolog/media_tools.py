@@ -0,0 +1,122 @@
+"""
+Runs external media tools (ffmpeg, ffprobe) for the queue workers. Every call
+has a timeout so a corrupt video can't hang a worker, runs with low CPU and
+IO priority to leave room for the web and API processes, and takes one of a
+few slots shared by all the processes on the box, held with file locks.
+"""
+
+import os
+import fcntl
+import shutil
+import threading
+import subprocess
+from time import time, sleep
+
+from photolog.limits import ServiceUnavailable
+from photolog.settings import setting
+
+SERVICE = "media_tools"
+SLOT_POLL = 0.1
+SLOT_WAIT = 60  # Seconds a call waits for a free slot
+SLOT_RETRY_DELAY = 30  # Seconds a job waits in the queue when no slot frees up
+STDERR_TAIL = 2000
+
+
+class MediaToolError(Exception):
+    """The tool failed or timed out, `stderr` has what it said"""
+
+    def __init__(self, cmd, returncode, stderr, reason=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        message = reason or "%s exited with %s" % (os.path.basename(cmd[0]), returncode)
+        tail = stderr.decode("utf-8", "replace").strip()[-STDERR_TAIL:]
+        super().__init__("%s: %s" % (message, tail) if tail else message)
+
+
+class MediaToolTimeout(MediaToolError):
+    pass
+
+
+class MediaTools(object):
+    """
+    Runs up to `concurrency` tools at once across processes, killing them
+    after `timeout` seconds. `nice` is the CPU niceness they run with, IO
+    gets the lowest best effort priority when `ionice` is available.
+    """
+
+    def __init__(self, lock_dir, concurrency=2, timeout=300, nice=10):
+        self.lock_dir = lock_dir
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.prefix = []
+        if nice and shutil.which("nice"):
+            self.prefix += ["nice", "-n", str(nice)]
+            if shutil.which("ionice"):
+                self.prefix += ["ionice", "-c", "2", "-n", "7"]
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def _acquire(self, wait):
+        """File descriptor holding a free slot, or None after `wait` seconds"""
+        deadline = time() + wait
+        while True:
+            for slot in range(self.concurrency):
+                fd = os.open(
+                    os.path.join(self.lock_dir, "slot-%s.lock" % slot), os.O_RDWR | os.O_CREAT
+                )
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            if time() >= deadline:
+                return None
+            sleep(SLOT_POLL)
+
+    def run(self, cmd, timeout=None):
+        """
+        Runs `cmd` and returns its CompletedProcess with stdout and stderr.
+        Raises MediaToolError if it fails, MediaToolTimeout if it takes too
+        long and ServiceUnavailable if no slot frees up meanwhile.
+        """
+        timeout = timeout or self.timeout
+        fd = self._acquire(SLOT_WAIT)
+        if fd is None:
+            raise ServiceUnavailable(
+                SERVICE, SLOT_RETRY_DELAY, "all %s slots busy" % self.concurrency
+            )
+        try:
+            proc = subprocess.run(
+                self.prefix + cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired as ex:
+            raise MediaToolTimeout(
+                cmd, None, ex.stderr or b"", "%s killed after %ss" % (cmd[0], timeout)
+            )
+        finally:
+            os.close(fd)  # Releases the lock
+        if proc.returncode:
+            raise MediaToolError(cmd, proc.returncode, proc.stderr)
+        return proc
+
+
+_tools = {}
+_tools_lock = threading.Lock()
+
+
+def get_media_tools(settings):
+    """Media tools runner for the given settings, set up once per process"""
+    lock_dir = setting(settings, "MEDIA_TOOLS_LOCK_DIR")
+    with _tools_lock:
+        if lock_dir not in _tools:
+            _tools[lock_dir] = MediaTools(
+                lock_dir,
+                setting(settings, "MEDIA_TOOLS_CONCURRENCY"),
+                setting(settings, "MEDIA_TOOLS_TIMEOUT"),
+                setting(settings, "MEDIA_TOOLS_NICE"),
+            )
+        return _tools[lock_dir]
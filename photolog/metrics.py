@@ -0,0 +1,165 @@
+"""
+Timing and outcome of every job step, so it is clear where the queue spends
+its time. Kept in a table of the database that works as a ring buffer: only
+the last MAX_ROWS measures are kept.
+"""
+
+import threading
+from contextlib import contextmanager
+from time import time, perf_counter, thread_time
+
+from photolog.db import BaseDB
+from photolog.settings import setting
+from photolog.limits import ServiceUnavailable
+
+OK = "ok"
+ERROR = "error"
+DEFERRED = "deferred"
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[rank]
+
+
+class Measure(object):
+    """
+    Wall and CPU time of a step, or sub step, while it runs. CPU time is the
+    one of the running thread, so concurrent jobs don't add to each other's.
+    """
+
+    def __init__(self, job_type, step, substep=""):
+        self.job_type = job_type
+        self.step = step
+        self.substep = substep
+        self.bytes = 0
+        self._wall = perf_counter()
+        self._cpu = thread_time()
+
+    def finish(self, outcome):
+        self.outcome = outcome
+        self.wall = perf_counter() - self._wall
+        self.cpu = thread_time() - self._cpu
+
+    def row(self):
+        return (
+            time(),
+            self.job_type,
+            self.step,
+            self.substep,
+            self.wall,
+            self.cpu,
+            self.bytes,
+            self.outcome,
+        )
+
+
+@contextmanager
+def measure(measures, job_type, step, substep=""):
+    """Times the block, adding its Measure to `measures` when it ends"""
+    current = Measure(job_type, step, substep)
+    outcome = ERROR
+    try:
+        yield current
+        outcome = OK
+    except ServiceUnavailable:
+        outcome = DEFERRED
+        raise
+    finally:
+        current.finish(outcome)
+        measures.append(current)
+
+
+class MetricsDB(BaseDB):
+    MAX_ROWS = 50000
+
+    _create = [
+        "CREATE TABLE IF NOT EXISTS step_metrics "
+        "("
+        "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "  recorded REAL,"
+        "  job_type TEXT,"
+        "  step TEXT,"
+        "  substep TEXT,"
+        "  wall REAL,"
+        "  cpu REAL,"
+        "  bytes INTEGER,"
+        "  outcome TEXT"
+        ");"
+    ]
+    _insert = (
+        "INSERT INTO step_metrics "
+        "(recorded, job_type, step, substep, wall, cpu, bytes, outcome) VALUES (?,?,?,?,?,?,?,?)"
+    )
+    # Rows are only appended, so the oldest ones have the lowest ids
+    _trim = "DELETE FROM step_metrics WHERE id <= (SELECT MAX(id) FROM step_metrics) - ?"
+    _select = (
+        "SELECT job_type, step, substep, wall, cpu, bytes, outcome FROM step_metrics"
+        " WHERE recorded >= ?"
+    )
+
+    def __init__(self, path, max_rows=MAX_ROWS):
+        super().__init__(path)
+        self.max_rows = max_rows
+
+    def record(self, measures):
+        """Stores the given Measures in a single transaction"""
+        if not measures:
+            return
+        with self._get_conn() as conn:
+            conn.executemany(self._insert, [m.row() for m in measures])
+            conn.execute(self._trim, [self.max_rows])
+
+    def summary(self, since=0, job_type=None):
+        """
+        Percentiles of the stored measures per job type, step and sub step.
+        Steps have an empty sub step and include the time of their sub steps.
+        """
+        query, params = self._select, [since]
+        if job_type:
+            query, params = query + " AND job_type = ?", params + [job_type]
+        groups = {}
+        with self._get_conn() as conn:
+            for row in conn.execute(query, params):
+                group = (row["job_type"], row["step"], row["substep"])
+                groups.setdefault(group, []).append(row)
+
+        summary = []
+        for (job_type, step, substep), rows in sorted(groups.items()):
+            wall = sorted(row["wall"] for row in rows)
+            cpu = sorted(row["cpu"] for row in rows)
+            outcomes = [row["outcome"] for row in rows]
+            summary.append(
+                {
+                    "job_type": job_type,
+                    "step": step,
+                    "substep": substep,
+                    "count": len(rows),
+                    "errors": outcomes.count(ERROR),
+                    "deferred": outcomes.count(DEFERRED),
+                    "wall_p50": percentile(wall, 50),
+                    "wall_p95": percentile(wall, 95),
+                    "wall_max": wall[-1],
+                    "cpu_p50": percentile(cpu, 50),
+                    "cpu_p95": percentile(cpu, 95),
+                    "bytes": sum(row["bytes"] for row in rows),
+                }
+            )
+        return summary
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_metrics(path, settings):
+    """Metrics stored in the database at `path`, or None if disabled"""
+    if not setting(settings, "METRICS_ENABLED"):
+        return None
+    with _metrics_lock:
+        if path not in _metrics:
+            _metrics[path] = MetricsDB(path, setting(settings, "METRICS_MAX_ROWS"))
+        return _metrics[path]
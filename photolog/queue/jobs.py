@@ -1,8 +1,14 @@
 import os
 import json
+import random
+import sqlite3
 from time import mktime
+from contextlib import contextmanager
 from photolog.services import s3, gphotos, flickr
 from photolog.services.api import base
+from photolog.limits import get_limits
+from photolog.metrics import get_metrics, measure
+from photolog.settings import setting
 from photolog import queue_logger as log, RAW_FILES, IMAGE_FILES, VIDEO_FILES
 
 
@@ -10,8 +16,35 @@ def job_fname(filename, settings):
     return os.path.join(settings.UPLOAD_FOLDER, filename)
 
 
+class Parallel(object):
+    """
+    Next step made of independent `branches` that run at the same time, each
+    as its own queue item, followed by `join` once all of them are done.
+    Jobs that reach a branch step without being a branch (e.g. queued before
+    the step was parallel) go on to the next step as usual.
+    """
+
+    def __init__(self, branches, join):
+        self.branches = branches
+        self.join = join
+
+
+def split_branches(job):
+    """
+    Separates a job forking into branches, from `process`, into the job that
+    waits for them and one job per branch.
+    """
+    job = dict(job)
+    branches = job.pop("branches")
+    return job, [dict(job, step=step, branch=step, attempt=0) for step in branches]
+
+
 class BaseJob(object):
     steps = {}
+    # Failed jobs are retried after retry_base * 2 ** attempt seconds, up to
+    # retry_cap, with jitter so failures from the same outage spread out.
+    retry_base = 5
+    retry_cap = 5 * 60
 
     def __init__(self, job_data, db, settings):
         self.data = job_data
@@ -22,9 +55,17 @@ class BaseJob(object):
     def process(self):
         raise NotImplementedError
 
+    @classmethod
+    def retry_delay(cls, attempt):
+        delay = min(cls.retry_cap, cls.retry_base * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
 
 class BaseUploadJob(BaseJob):
     format = "image"
+    # Uploads fail on S3/Flickr/Gphotos hiccups, give them time to recover
+    retry_base = 30
+    retry_cap = 60 * 60
 
     def __init__(self, job_data, db, settings):
         super(BaseUploadJob, self).__init__(job_data, db, settings)
@@ -40,6 +81,43 @@ class BaseUploadJob(BaseJob):
             self.metadata_full_filepath = job_fname(job_data["metadata_filename"], settings)
         else:
             self.metadata_full_filepath = None
+        # Timing of the step and its sub steps, stored once it ends
+        self.measures = []
+        self._measuring = []
+
+    @contextmanager
+    def _measure(self, step, substep=""):
+        # Upload jobs are all of type "upload", the format tells them apart
+        with measure(self.measures, self.format, step, substep) as current:
+            self._measuring.append(current)
+            try:
+                yield current
+            finally:
+                self._measuring.remove(current)
+
+    def _moved(self, *files):
+        """
+        Adds the size of what was sent to a service, file names or bytes, to
+        the running measures
+        """
+        size = sum(len(f) for f in files if isinstance(f, bytes))
+        size += sum(os.path.getsize(f) for f in files if isinstance(f, str) and os.path.isfile(f))
+        for current in self._measuring:
+            current.bytes += size
+
+    def _record_measures(self):
+        metrics = get_metrics(self.db.path, self.settings)
+        if not metrics:
+            return
+        try:
+            metrics.record(self.measures)
+        except sqlite3.Error as err:
+            # Losing some timings is better than failing the job
+            log.warning("Could not record metrics for %s: %s" % (self.key, err))
+
+    def _service(self, name):
+        """Guards a call to an external service with its shared rate limits"""
+        return get_limits(self.db.path, self.settings).guard(name)
 
     def _read_exif(self):
         upload_date = self.data["uploaded_at"]
@@ -51,14 +129,18 @@ class BaseUploadJob(BaseJob):
         exif = job["data"]["exif"]
         thumbs = job["data"]["thumbs"]
         path = "%s/%s" % (exif["year"], exif["month"])
-        s3_urls = s3.upload_thumbs(self.settings, thumbs, path)
+        with self._service("s3"):
+            s3_urls = s3.upload_thumbs(self.settings, thumbs, path)
+        self._moved(*thumbs.values())
         job["data"]["s3_urls"] = s3_urls
 
     def _get_notes(self):
         return ""
 
     def _get_checksum(self):
-        return base.file_checksum(self.full_filepath)
+        # Computed while the upload was saved, unless queued by older versions
+        checksum = self.data["data"].get("checksum")
+        return checksum or base.file_checksum(self.full_filepath)
 
     def _local_store(self):
         job = self.data
@@ -85,23 +167,62 @@ class BaseUploadJob(BaseJob):
         base.delete_file(self.full_filepath, thumbs)
         return None  # This ends the processing
 
+    def _run_substeps(self, substeps):
+        """
+        Runs the (name, method) sub steps of a step in order, recording in the
+        job each one completed, so a retry resumes at the first one not done
+        instead of redoing the expensive ones (thumbnails, S3 uploads).
+        """
+        done = self.data["data"].setdefault("done", [])
+        for name, task in substeps:
+            if name in done:
+                log.info("Already done %s - Step: %s" % (self.key, name))
+                continue
+            log.info("Processing %s - Step: %s (%s)" % (self.key, name, self.original_filename))
+            with self._measure(self.data["step"], name):
+                task()
+            done.append(name)
+        return self.data
+
+    def _next_step(self, job, next_step):
+        job["attempt"] = 0  # Step completed. Start next job fresh
+        job["data"].pop("done", None)  # Sub steps belong to the completed step
+        if job.get("branch"):
+            log.info("Finished %s branch of %s" % (job["branch"], self.key))
+            return None  # The job it branched from goes on
+        if isinstance(next_step, Parallel):
+            skip = job.get("skip", [])
+            branches = [step for step in next_step.branches if step not in skip]
+            if branches:
+                job["branches"] = branches
+            next_step = next_step.join
+        job["step"] = next_step
+        return job
+
     def process(self):
+        """
+        Runs the current step and returns the job at its next step, or None
+        once finished. A job returned with `branches` forks into one job per
+        branch, see `split_branches`.
+        """
         job = self.data
         step = job["step"]
         task_name, next_step = self.steps[step]
         if step in job.get("skip", []):
-            job["step"] = next_step
-            job["attempt"] = 0  # Step completed. Start next job fresh
             log.info("Skipping %s - Step: %s (%s)" % (self.key, step, self.filename))
+            job = self._next_step(job, next_step)
         else:
             log.info("Processing %s - Step: %s (%s)" % (self.key, step, self.filename))
             if job["attempt"] > 0:
                 log.info("Attempt %s for %s - %s" % (job["attempt"], step, self.key))
             task = getattr(self, task_name)
-            job = task()
+            try:
+                with self._measure(step):
+                    job = task()
+            finally:
+                self._record_measures()
             if job:
-                job["step"] = next_step
-                job["attempt"] = 0  # Step completed. Start next job fresh
+                job = self._next_step(job, next_step)
             else:
                 log.info("Finished %s (%s)" % (self.key, self.filename))
                 # if self.data['is_last']:
@@ -113,7 +234,8 @@ class BaseUploadJob(BaseJob):
 
 class ImageJob(BaseUploadJob):
     steps = {  # Step function, Next job
-        "upload_and_store": ("local_process", "flickr"),
+        # Flickr and Gphotos uploads don't depend on each other
+        "upload_and_store": ("local_process", Parallel(["flickr", "gphotos"], "finish")),
         "flickr": ("flickr_upload", "gphotos"),
         "gphotos": ("gphotos_upload", "finish"),
         "finish": ("finish_job", None),
@@ -123,12 +245,33 @@ class ImageJob(BaseUploadJob):
         thumbs = base.generate_thumbnails(self.full_filepath, self.settings.THUMBS_FOLDER)
         self.data["data"]["thumbs"] = thumbs
 
+    def _stream_thumbs(self):
+        """
+        Makes the thumbnails in memory and uploads them with the original,
+        as it is in the upload folder, without writing anything to disk.
+        """
+        exif = self.data["data"]["exif"]
+        path = "%s/%s" % (exif["year"], exif["month"])
+        names = base.thumbnail_names(self.full_filepath)
+        objects = {"original": (names["original"], self.full_filepath)}
+        for thumb_name, data in base.encode_thumbnails(self.full_filepath).items():
+            objects[thumb_name] = (names[thumb_name], data)
+        with self._service("s3"):
+            s3_urls = s3.upload_objects(self.settings, objects, path)
+        self._moved(*[body for name, body in objects.values()])
+        self.data["data"]["thumbs"] = {}  # Nothing to clean up
+        self.data["data"]["s3_urls"] = s3_urls
+
     def flickr_upload(self):
         if not self.settings.FLICKR_ENABLED:
             return self.data
         tags = self.data["tags"]
         key = self.key
-        flickr_url, photo_id = flickr.upload(self.settings, self.filename, self.full_filepath, tags)
+        with self._service("flickr"):
+            flickr_url, photo_id = flickr.upload(
+                self.settings, self.filename, self.full_filepath, tags
+            )
+        self._moved(self.full_filepath)
         self.db.pictures.update(key, "flickr", json.dumps({"url": flickr_url, "id": photo_id}))
         log.info("Uploaded %s to Flickr" % key)
         return self.data
@@ -140,9 +283,11 @@ class ImageJob(BaseUploadJob):
         if batch_id:
             base.batch_2_album(batch_id, self.settings, section="feed")
         s3_original_url = self.data["data"]["s3_urls"].get("original")
-        gphotos_data = gphotos.upload_photo(
-            self.settings, self.full_filepath, self.filename, s3_original_url
-        )
+        with self._service("gphotos"):
+            gphotos_data = gphotos.upload_photo(
+                self.settings, self.full_filepath, self.filename, s3_original_url
+            )
+        self._moved(self.full_filepath)
         self.db.pictures.update(self.key, "gphotos", json.dumps({"json": gphotos_data}))
         log.info("Uploaded %s to Gphotos" % self.key)
         return self.data
@@ -152,17 +297,14 @@ class ImageJob(BaseUploadJob):
         Collapses quick jobs so each picture doesn't get queued up in case of
         long batches
         """
-        base_file = self.original_filename
-        key = self.key
-        log.info("Processing %s - Step: read_exif (%s)" % (key, base_file))
-        self._read_exif()
-        log.info("Processing %s - Step: thumbs (%s)" % (key, base_file))
-        self._generate_thumbs()
-        log.info("Processing %s - Step: s3_upload (%s)" % (key, base_file))
-        self._s3_upload()
-        log.info("Processing %s - Step: local_store (%s)" % (key, base_file))
-        self._local_store()
-        return self.data
+        if setting(self.settings, "THUMBS_IN_MEMORY"):
+            # Thumbnails are remade if the upload fails, they aren't kept
+            thumbnails = [("thumbs_s3", self._stream_thumbs)]
+        else:
+            thumbnails = [("thumbs", self._generate_thumbs), ("s3_upload", self._s3_upload)]
+        return self._run_substeps(
+            [("read_exif", self._read_exif)] + thumbnails + [("local_store", self._local_store)]
+        )
 
 
 class VideoJob(BaseUploadJob):
@@ -173,22 +315,34 @@ class VideoJob(BaseUploadJob):
         "finish": ("finish_job", None),
     }
 
+    def _probe(self):
+        # {} when ffprobe can't read it, so it isn't probed again
+        self.data["data"]["probe"] = base.probe_video(self.settings, self.full_filepath) or {}
+
     def _generate_thumbnail(self):
+        duration = self.data["data"].get("probe", {}).get("duration") or 0
         thumbs, output_dir = base.get_video_thumbnail(
-            self.settings, self.full_filepath, self.filename, self.key
+            self.settings, self.full_filepath, self.filename, self.key, duration
         )
         self.data["output_dir"] = output_dir
         self.data["data"]["thumbs"] = thumbs
 
-    def _s3_video_upload(self):
-        job = self.data
-        exif = job["data"]["exif"]
-        path = "%s/%s" % (exif["year"], exif["month"])
+    def _s3_path(self):
+        exif = self.data["data"]["exif"]
+        return "%s/%s" % (exif["year"], exif["month"])
+
+    def _s3_thumbs_upload(self):
         thumbs = self.data["data"]["thumbs"]
-        uploaded_thumbs = s3.upload_thumbs(self.settings, thumbs, path)
-        video = s3.upload_video(self.settings, self.full_filepath, path)
-        uploaded_thumbs["video"] = video
-        job["data"]["s3_urls"] = uploaded_thumbs
+        with self._service("s3"):
+            s3_urls = s3.upload_thumbs(self.settings, thumbs, self._s3_path())
+        self._moved(*thumbs.values())
+        self.data["data"]["s3_urls"] = s3_urls
+
+    def _s3_video_upload(self):
+        with self._service("s3"):
+            video = s3.upload_video(self.settings, self.full_filepath, self._s3_path())
+        self._moved(self.full_filepath)
+        self.data["data"]["s3_urls"]["video"] = video
 
     def _local_store(self):
         job = self.data
@@ -220,15 +374,18 @@ class VideoJob(BaseUploadJob):
             upload_date,
             self.metadata_full_filepath,
             thumbnail,
+            self.data["data"].get("probe"),
         )
         self.data["data"]["exif"] = exif
 
     def gphotos_upload(self):
         mime = self.data["data"]["exif"]["mime"]
         s3_original_url = self.data["data"]["s3_urls"].get("original")
-        gphotos_data = gphotos.upload_video(
-            self.settings, self.full_filepath, self.filename, mime, s3_original_url
-        )
+        with self._service("gphotos"):
+            gphotos_data = gphotos.upload_video(
+                self.settings, self.full_filepath, self.filename, mime, s3_original_url
+            )
+        self._moved(self.full_filepath)
         self.db.pictures.update(self.key, "gphotos", json.dumps({"xml": gphotos_data}))
         log.info("Uploaded %s to Gphotos" % self.key)
         return self.data
@@ -248,18 +405,16 @@ class VideoJob(BaseUploadJob):
         """
         Generate thumbnails and upload raw video to S3
         """
-        base_file = self.original_filename
-        key = self.key
-        log.info("Processing %s - Obtaining thumbnail (%s)" % (key, base_file))
-        self._generate_thumbnail()
-        log.info("Processing %s - Read metadata (%s)" % (key, base_file))
-        self._read_exif()
-        log.info("Processing %s - Upload file (%s)" % (key, base_file))
-        self._s3_video_upload()
-        log.info("Processing %s - local_store (%s)" % (key, base_file))
-        self._local_store()
-        log.info("Processing %s - Stored (%s)" % (key, base_file))
-        return self.data
+        return self._run_substeps(
+            [
+                ("probe", self._probe),
+                ("thumbnail", self._generate_thumbnail),
+                ("read_exif", self._read_exif),
+                ("s3_thumbs_upload", self._s3_thumbs_upload),
+                ("s3_video_upload", self._s3_video_upload),
+                ("local_store", self._local_store),
+            ]
+        )
 
 
 class RawFileJob(BaseUploadJob):
@@ -306,7 +461,9 @@ class RawFileJob(BaseUploadJob):
         job = self.data
         exif = job["data"]["exif"]
         path = "%s/%s" % (exif["year"], exif["month"])
-        s3_urls = s3.upload_thumbs(self.settings, {"original": self.full_filepath}, path)
+        with self._service("s3"):
+            s3_urls = s3.upload_thumbs(self.settings, {"original": self.full_filepath}, path)
+        self._moved(self.full_filepath)
         job["data"]["s3_urls"] = s3_urls
 
     def _copy_thumbs(self):
@@ -327,17 +484,15 @@ class RawFileJob(BaseUploadJob):
         Collapses quick jobs so each picture doesn't get queued up in case of
         long batches
         """
-        base_file = self.original_filename
-        key = self.key
-        log.info("Processing %s - Step: read_exif (%s)" % (key, base_file))
-        self._read_exif()
         # We don't generate thumbnails for RAW files
-        log.info("Processing %s - Step: s3_upload (%s)" % (key, base_file))
-        self._s3_upload()
-        self._copy_thumbs()
-        log.info("Processing %s - Step: local_store (%s)" % (key, base_file))
-        self._local_store()
-        return self.data
+        return self._run_substeps(
+            [
+                ("read_exif", self._read_exif),
+                ("s3_upload", self._s3_upload),
+                ("copy_thumbs", self._copy_thumbs),
+                ("local_store", self._local_store),
+            ]
+        )
 
 
 class TagDayJob(BaseJob):
@@ -444,14 +599,26 @@ job_types = {
 }
 
 
-def prepare_job(job, db, settings):
+def job_class(job):
     if job.get("type", "upload") == "upload":
-        filename = job_fname(job["filename"], settings)
-        name, ext = os.path.splitext(filename)
+        name, ext = os.path.splitext(job["filename"])
         ext = ext.lstrip(".").lower()
         for cls, types in upload_formats:
             if ext in types:
-                return cls(job, db, settings)
+                return cls
+
+    return job_types[job["type"]]
+
 
-    cls = job_types[job["type"]]
+def prepare_job(job, db, settings):
+    cls = job_class(job)
     return cls(job, db, settings)
+
+
+def retry_delay(job):
+    """Seconds to wait before retrying a failed job, depends on its type"""
+    try:
+        cls = job_class(job)
+    except KeyError:
+        cls = BaseJob
+    return cls.retry_delay(job["attempt"])
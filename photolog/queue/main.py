@@ -1,54 +1,157 @@
 import sys
+import asyncio
+import argparse
 import traceback
 
 import os
 from photolog.db import DB
 from photolog.settings import Settings
-from photolog.squeue import SqliteQueue
-from photolog.queue.jobs import prepare_job
+from photolog.squeue import SqliteQueue, Heartbeat, worker_id
+from photolog.limits import ServiceUnavailable
+from photolog.queue.jobs import prepare_job, retry_delay, split_branches
+from photolog.queue.pool import Supervisor
+from photolog.queue.memory import MemoryBudget
 from photolog import queue_logger as log, settings_file
 
 
-def daemon(db, settings, queue):
-    log.info("Starting daemon")
+def run_job(db, settings, queue, worker, item_id, job):
+    """
+    Processes a job claimed from the queue and acks it, queueing whatever
+    comes next for it: its next step, a retry or the bad jobs table.
+    """
+    try:
+        next_job = prepare_job(job, db, settings).process()
+    except ServiceUnavailable as ex:
+        # Not the job's fault, it doesn't use up an attempt
+        log.info("Deferring job %s: %s" % (job["key"], ex))
+        owned = queue.release(item_id, worker, job, ex.delay, str(ex))
+    except Exception:
+        ex_type, ex, tb = sys.exc_info()
+        traceback.print_tb(tb)
+        error = "%s: %s" % (ex_type.__name__, ex)
+        if job["attempt"] <= settings.MAX_QUEUE_ATTEMPTS:
+            delay = retry_delay(job)
+            log.info("Retrying job %s in %.0fs" % (job["key"], delay))
+            job["attempt"] += 1
+            owned = queue.retry(item_id, worker, job, delay, error)
+        else:
+            # What should it do? Send a notification, record an error?
+            # Don't lose the task
+            log.info("Adding job %s to bad jobs" % job["key"])
+            owned = queue.bury(item_id, worker, job, error)
+    else:
+        if next_job and next_job.get("branches"):
+            owned = queue.fork(item_id, worker, *split_branches(next_job))
+        elif next_job:
+            owned = queue.advance(item_id, worker, next_job)
+        else:
+            owned = queue.ack(item_id, worker)
+    if not owned:
+        # Took too long without heartbeat, another worker has it now.
+        log.warning("Job %s lease expired while processing it" % job["key"])
+
+
+def daemon(db, settings, queue, stages=None):
+    """
+    Processes jobs as they come. If `stages` is given only jobs at those stages
+    are processed, so CPU bound and network bound steps can have their own
+    workers. Returns between jobs once the worker's memory budget is used up,
+    to be started again by the supervisor.
+    """
+    log.info("Starting daemon%s" % (" for stages: %s" % ", ".join(stages) if stages else ""))
+    worker = worker_id()
+    lease_time = settings.QUEUE_LEASE_TIME
+    heartbeat = Heartbeat(queue, worker, lease_time)
+    budget = MemoryBudget.from_settings(settings)
     daemon_started = True
     while daemon_started:
-        job = queue.popleft(100)
         try:
-            next_job = prepare_job(job, db, settings).process()
-        except KeyboardInterrupt:
+            item_id, job = queue.claim(worker, lease_time, stages=stages)
+        except (KeyboardInterrupt, SystemExit):
             log.info("Daemon interrupted")
-            queue.append(job)
-            daemon_started = False
-        except SystemExit:
-            # If job was interrupted, don't toss job.
-            queue.append(job)
+            break
+        heartbeat.add(item_id)
+        budget.start_job()
+        try:
+            run_job(db, settings, queue, worker, item_id, job)
+            budget.finish_job(job["key"])
+            exceeded = budget.exceeded()
+            if exceeded:
+                log.info("Recycling worker, it %s" % exceeded)
+                daemon_started = False
+        except (KeyboardInterrupt, SystemExit):
+            # If job was interrupted, don't toss job. Give it back so it is
+            # picked up again right away.
             log.info("Daemon interrupted")
+            queue.release(item_id, worker, job)
             daemon_started = False
-        except Exception:
-            ex_type, ex, tb = sys.exc_info()
-            traceback.print_tb(tb)
-            if job["attempt"] <= settings.MAX_QUEUE_ATTEMPTS:
-                job["attempt"] += 1
-                queue.append(job)
-            else:
-                # What should it do? Send a notification, record an error?
-                # Don't lose the task
-                log.info("Adding job %s to bad jobs" % job["key"])
-                queue.append_bad(job)
-        else:
-            if next_job:
-                queue.append(next_job)
+        finally:
+            heartbeat.discard(item_id)
+    heartbeat.stop()
 
     log.info("Finishing daemon")
 
 
+def parse_stages(stages):
+    return [stage.strip() for stage in (stages or "").split(",") if stage.strip()]
+
+
 def start():
+    parser = argparse.ArgumentParser(description="Process the Photolog job queue")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Worker processes to run, restarted if they die. QUEUE_WORKERS (1) by default",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Jobs each worker keeps in flight, for the network bound stages given with "
+        "--stages (e.g. flickr,gphotos). QUEUE_CONCURRENCY (1) by default",
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        help="Comma separated stages to process, e.g. local_process or flickr,gphotos. "
+        "All stages by default",
+    )
+    parsed = parser.parse_args()
+    stages = parse_stages(parsed.stages)
     settings = Settings.load(settings_file)
+    workers = parsed.workers or settings.QUEUE_WORKERS
+    concurrency = parsed.concurrency or settings.QUEUE_CONCURRENCY
+    if concurrency > 1 and not stages:
+        log.warning(
+            "Concurrency %s only applies with --stages, e.g. flickr,gphotos. "
+            "Processing all stages one job at a time" % concurrency
+        )
+    ensure_thumbs_folder(settings)
+    # Workers recycled for their memory budget need somebody to restart them
+    if workers > 1 or MemoryBudget.from_settings(settings).enabled:
+        Supervisor(run_worker, (settings_file, stages, concurrency), workers).run()
+    else:
+        run_worker(settings_file, stages, concurrency)
+
+
+def uses_network_executor(stages, concurrency):
+    """
+    Concurrent jobs are only for stages given explicitly, a worker for all
+    stages runs them one at a time so local_process and finish aren't left out
+    """
+    return concurrency > 1 and bool(stages)
+
+
+def run_worker(settings_path, stages, concurrency=1):
+    """Runs the daemon, in this process or in one of the supervised ones"""
+    settings = Settings.load(settings_path)
     db = DB(settings.DB_FILE)
     queue = SqliteQueue(settings.DB_FILE)
-    ensure_thumbs_folder(settings)
-    daemon(db, settings, queue)
+    if uses_network_executor(stages, concurrency):
+        from photolog.queue.network import NetworkExecutor  # It imports run_job from here
+
+        asyncio.run(NetworkExecutor(db, settings, queue, concurrency, stages).run())
+    else:
+        daemon(db, settings, queue, stages)
 
 
 def ensure_thumbs_folder(settings):
@@ -0,0 +1,100 @@
+"""
+Memory use of worker processes. Decoding big images and reading whole videos
+leaves the heap of a long running worker fragmented, so its RSS only grows.
+A MemoryBudget makes the worker exit between jobs once it has run too many or
+grown too big, for the supervisor to start a fresh one.
+"""
+
+import os
+import sys
+import resource
+
+from photolog import queue_logger as log
+from photolog.settings import setting
+
+MB = 1024 * 1024
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def _status_kb(field):
+    """Memory figure from /proc/self/status, in bytes, if there is procfs"""
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def rss():
+    """Resident memory of this process, in bytes"""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return peak_rss()  # No procfs (macOS), the peak is the closest we have
+
+
+def peak_rss():
+    """Highest resident memory since started, or since `reset_peak`, in bytes"""
+    peak = _status_kb("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":  # Linux reports KB, macOS bytes
+            peak *= 1024
+    return peak
+
+
+def reset_peak():
+    """
+    Starts measuring the peak from the current RSS, so it can be told per
+    job. Only possible on Linux, elsewhere the peak is the process one.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        return False
+    return True
+
+
+class MemoryBudget(object):
+    """
+    Keeps track of the jobs a worker runs and its memory. `exceeded` tells why
+    the worker should be recycled: after `max_jobs` jobs or once its RSS goes
+    over `max_rss_mb`. Zero disables either limit.
+    """
+
+    def __init__(self, max_jobs=0, max_rss_mb=0):
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss_mb * MB
+        self.jobs = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(setting(settings, "WORKER_MAX_JOBS"), setting(settings, "WORKER_MAX_RSS_MB"))
+
+    @property
+    def enabled(self):
+        return bool(self.max_jobs or self.max_rss)
+
+    def start_job(self):
+        reset_peak()
+
+    def finish_job(self, key):
+        """Counts the job and logs the memory it took"""
+        self.jobs += 1
+        log.info(
+            "Job %s peak memory %.0fMB, worker RSS %.0fMB" % (key, peak_rss() / MB, rss() / MB)
+        )
+
+    def exceeded(self):
+        if self.max_jobs and self.jobs >= self.max_jobs:
+            return "ran %s jobs" % self.jobs
+        if self.max_rss:
+            current = rss()
+            if current > self.max_rss:
+                return "RSS of %.0fMB over %.0fMB" % (current / MB, self.max_rss / MB)
+        return None
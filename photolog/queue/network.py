@@ -0,0 +1,135 @@
+import signal
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from photolog.squeue import Heartbeat, worker_id
+from photolog.queue.main import run_job
+from photolog.queue.memory import MemoryBudget
+from photolog.settings import setting
+from photolog import queue_logger as log
+
+# Steps that only wait on remote services. S3 uploads happen during
+# local_process, together with the CPU bound thumbnailing.
+NETWORK_STAGES = ["flickr", "gphotos"]
+
+
+class NetworkExecutor(object):
+    """
+    Processes network bound jobs concurrently from a single process.
+
+    Jobs are claimed while there are free slots, up to `concurrency` in
+    flight, and each one runs in a thread of a pool (the service clients are
+    blocking) scheduled from an asyncio loop. Every stage (service) is also
+    limited by `SERVICE_CONCURRENCY`, so one busy service can't starve the
+    rest nor get hammered beyond its rate limits. Running jobs are let finish
+    when stopping, which also happens once the worker's memory budget is used
+    up. A single heartbeat thread keeps the leases of all the claimed jobs
+    alive.
+    """
+
+    # Seconds between checks for new jobs while there are free slots
+    POLL_INTERVAL = 1
+
+    def __init__(self, db, settings, queue, concurrency, stages=None):
+        self.db = db
+        self.settings = settings
+        self.queue = queue
+        self.stages = stages or NETWORK_STAGES
+        self.concurrency = concurrency
+        limits = setting(settings, "SERVICE_CONCURRENCY")
+        self.limits = {stage: limits.get(stage, self.concurrency) for stage in self.stages}
+        self.worker = worker_id()
+        self.lease_time = settings.QUEUE_LEASE_TIME
+        self.budget = MemoryBudget.from_settings(settings)
+        self._running = {stage: 0 for stage in self.stages}
+        self._tasks = set()
+        self._stopping = False
+
+    def stop(self):
+        log.info("Network executor interrupted")
+        self._stopping = True
+        self._changed.set()
+
+    def _free_slots(self, stage):
+        """Jobs of the stage that can be started now"""
+        free = self.concurrency - len(self._tasks)
+        return min(free, self.limits[stage] - self._running[stage])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+        self._changed = asyncio.Event()
+        # One extra thread so claiming never waits behind the jobs
+        self._pool = ThreadPoolExecutor(self.concurrency + 1, thread_name_prefix="network")
+        self._heartbeat = Heartbeat(self.queue, self.worker, self.lease_time)
+        log.info(
+            "Starting network executor for stages: %s (%s concurrent)"
+            % (", ".join(self.stages), self.concurrency)
+        )
+        try:
+            await self._claim_loop(loop)
+            if self._tasks:
+                log.info("Waiting for %s jobs in flight" % len(self._tasks))
+                await asyncio.gather(*self._tasks)
+        finally:
+            self._heartbeat.stop()
+            self._pool.shutdown()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(signum)
+        log.info("Finishing network executor")
+
+    async def _claim_loop(self, loop):
+        while not self._stopping:
+            claimed = False
+            # Claimed stage by stage, so jobs don't sit leased waiting for
+            # their service while other workers could take them.
+            for stage in self.stages:
+                slots = self._free_slots(stage)
+                if slots <= 0:
+                    continue
+                claim = partial(
+                    self.queue.claim_many,
+                    self.worker,
+                    slots,
+                    self.lease_time,
+                    sleep_wait=False,
+                    stages=[stage],
+                )
+                for item_id, job in await loop.run_in_executor(self._pool, claim):
+                    self._start(stage, item_id, job)
+                    claimed = True
+            if not claimed:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), self.POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _start(self, stage, item_id, job):
+        self._running[stage] += 1
+        self._heartbeat.add(item_id)
+        task = asyncio.ensure_future(self._process(stage, item_id, job))
+        self._tasks.add(task)
+        task.add_done_callback(partial(self._finished, stage, item_id))
+
+    def _finished(self, stage, item_id, task):
+        self._tasks.discard(task)
+        self._running[stage] -= 1
+        self._heartbeat.discard(item_id)
+        self._changed.set()
+        # Jobs overlap, so there is no per job peak to tell, only the total
+        self.budget.jobs += 1
+        exceeded = self.budget.exceeded()
+        if exceeded and not self._stopping:
+            log.info("Recycling worker, it %s" % exceeded)
+            self._stopping = True
+        if not task.cancelled() and task.exception():
+            log.error("Job %s failed unexpectedly: %r" % (item_id, task.exception()))
+
+    async def _process(self, stage, item_id, job):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self._pool, run_job, self.db, self.settings, self.queue, self.worker, item_id, job
+        )
@@ -0,0 +1,123 @@
+import signal
+import multiprocessing
+from multiprocessing.connection import wait
+from time import time
+
+from photolog import queue_logger as log
+
+
+def _interrupt(signum, frame):
+    raise SystemExit(0)
+
+
+def worker_entry(target, args):
+    """
+    Runs `target` in a pool process. SIGTERM interrupts it like Ctrl+C does a
+    foreground daemon, so the job at hand is given back to the queue. SIGINT
+    is left to the supervisor, which relays it as SIGTERM.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _interrupt)
+    target(*args)
+
+
+class Supervisor(object):
+    """
+    Keeps `size` processes running `target(*args)`, restarting those that
+    exit, until it gets SIGINT or SIGTERM. Then it asks every worker to stop
+    and waits for them to give back their jobs.
+
+    Workers share nothing but the queue database, which already handles
+    concurrent consumers, so each one opens its own connections.
+    """
+
+    # Workers that die sooner than this after starting are crashing, so they
+    # are restarted with an increasing delay instead of right away.
+    MIN_UPTIME = 10
+    MAX_RESTART_DELAY = 60
+    STOP_TIMEOUT = 60
+
+    def __init__(self, target, args=(), size=1):
+        self.target = target
+        self.args = args
+        self.size = size
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = {}  # slot: (process, started)
+        self._delays = {}  # slot: current restart delay
+        self._stopping = False
+
+    def start_worker(self, slot):
+        process = self._context.Process(
+            target=worker_entry,
+            args=(self.target, self.args),
+            name="photolog-worker-%s" % slot,
+        )
+        process.start()
+        self._workers[slot] = (process, time())
+        log.info("Started worker %s (pid %s)" % (slot, process.pid))
+
+    def stop(self, signum=None, frame=None):
+        self._stopping = True
+
+    def _restart_delay(self, slot, uptime, exitcode):
+        if exitcode == 0 or uptime >= self.MIN_UPTIME:
+            self._delays.pop(slot, None)
+            return 0
+        delay = min(self.MAX_RESTART_DELAY, self._delays.get(slot, 0.5) * 2)
+        self._delays[slot] = delay
+        return delay
+
+    def run(self):
+        handlers = {
+            signum: signal.signal(signum, self.stop) for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            self._run()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def _run(self):
+        log.info("Starting %s workers" % self.size)
+        for slot in range(self.size):
+            self.start_worker(slot)
+        pending = {}  # slot: restart time
+        while not self._stopping:
+            sentinels = [process.sentinel for process, started in self._workers.values()]
+            wait(sentinels, timeout=1)
+            now = time()
+            for slot, (process, started) in list(self._workers.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                del self._workers[slot]
+                delay = self._restart_delay(slot, now - started, process.exitcode)
+                if process.exitcode == 0:
+                    # Recycled, e.g. for its memory budget
+                    log.info("Worker %s (pid %s) finished, restarting it" % (slot, process.pid))
+                else:
+                    log.warning(
+                        "Worker %s (pid %s) exited with code %s, restarting in %ss"
+                        % (slot, process.pid, process.exitcode, delay)
+                    )
+                pending[slot] = now + delay
+            for slot, restart_at in list(pending.items()):
+                if restart_at <= now and not self._stopping:
+                    del pending[slot]
+                    self.start_worker(slot)
+        self.shutdown()
+
+    def shutdown(self):
+        log.info("Stopping %s workers" % len(self._workers))
+        for process, started in self._workers.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM, the worker releases its job
+        deadline = time() + self.STOP_TIMEOUT
+        for process, started in self._workers.values():
+            process.join(max(0, deadline - time()))
+            if process.is_alive():
+                log.warning("Worker pid %s did not stop, killing it" % process.pid)
+                process.kill()
+                process.join()
+        self._workers.clear()
+        log.info("All workers stopped")
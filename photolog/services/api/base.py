@@ -1,20 +1,24 @@
 import os
 import re
+import json
+import math
 import random
 import string
 import piexif
 import shutil
 import exifread
-import subprocess
 import unicodedata
-from hashlib import md5
-from functools import partial
+from io import BytesIO
 from datetime import datetime
 from time import time, mktime
 from PIL import Image, ExifTags, ImageFile
 from urllib.parse import urlparse, urljoin
 from os.path import splitext, basename, join
 
+from photolog import queue_logger as log
+from photolog.checksum import file_checksum  # noqa: F401
+from photolog.media_tools import get_media_tools, MediaToolError
+
 from .. import VIDEO_PLACEHOLDER
 from ..gphotos import create_album, clear_album
 
@@ -24,6 +28,16 @@ THUMBNAILS = {"thumb": 100, "medium": 320, "web": 1200, "large": 2048}
 KEEP_EXIF = {"large"}  # Keep exif data on these sizes
 
 THUMB_QUALITY = 85
+# JPEGs are decoded scaled down by 1/2, 1/4 or 1/8 (DCT scaling), as much as
+# possible while staying this many times the biggest thumbnail. None decodes
+# them at full size.
+DRAFT_MARGIN = 1.0
+# Same as Image.rotate(degrees, expand=True), without resampling
+ROTATIONS = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
 ORIENTATION_EXIF = 274  # Default
 # Lookup the right orientation exif tag
 for orientation in ExifTags.TAGS.keys():
@@ -53,39 +67,125 @@ def read_rotation(img_data):
     return 0
 
 
-def generate_thumbnails(filename, thumbs_folder, base_name=None):
-    base = basename(filename)
-    name, ext = splitext(base)
+def thumb_size(size, dim):
+    """
+    Size of an image of `size` shrunk to fit in a dim x dim box, rounded the
+    same way Image.thumbnail does. Images are never scaled up.
+    """
+    width, height = size
+    if dim >= width and dim >= height:
+        return size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if aspect <= 1:
+        return round_aspect(dim * aspect, key=lambda n: abs(aspect - n / dim)), dim
+    return dim, round_aspect(dim / aspect, key=lambda n: 0 if n == 0 else abs(aspect - dim / n))
+
+
+def draft(image, size, margin=DRAFT_MARGIN):
+    """
+    Sets up a JPEG `image` to be decoded at the smallest DCT scale that keeps
+    it at least `size` times `margin`. Returns the scale, 1 if the image isn't
+    a JPEG or is already loaded.
+    """
+    if margin is None:
+        return 1
+    requested = (math.ceil(size[0] * margin), math.ceil(size[1] * margin))
+    width = image.size[0]
+    if image.draft(None, requested) is None:
+        return 1
+    return width / image.size[0]
+
+
+def thumbnail_names(filename, base_name=None):
+    """File names for a copy of the original and each of its THUMBNAILS"""
+    name, ext = splitext(basename(filename))
     name = splitext(base_name)[0] if base_name else name
-    secret = random_string()
     # Also add random to original
-    new_original = join(thumbs_folder, "%s-%s%s" % (name, secret, ext))
-    shutil.copyfile(filename, new_original)
-    generated = {"original": new_original}
-    for thumb_name, dim in THUMBNAILS.items():
-        secret = random_string()
+    names = {"original": "%s-%s%s" % (name, random_string(), ext)}
+    for thumb_name in THUMBNAILS:
         # I want each thumbnail have a different random string so you cannot
         # guess the other size from the URL
-        out_name = join(thumbs_folder, "%s--%s-%s%s" % (name, thumb_name, secret, ext))
+        names[thumb_name] = "%s--%s-%s%s" % (name, thumb_name, random_string(), ext)
+    return names
+
 
-        orig = Image.open(new_original)
+def render_thumbnails(filename, margin=DRAFT_MARGIN):
+    """
+    Yields the name and image of each of the THUMBNAILS, biggest first. The
+    image is decoded once, scaled down by the JPEG decoder if the thumbnails
+    are small enough (see `draft`), and each size is scaled down from the
+    previous, bigger one. Sizes in KEEP_EXIF are left as stored, for the
+    original EXIF orientation to apply, the rest are rotated as it says.
+    """
+    with Image.open(filename) as orig:
         rotation = read_rotation(orig)
-        orig.thumbnail((dim, dim))
-        if thumb_name not in KEEP_EXIF:
-            # Only rotate those that don't have exif copied
-            orig = orig.rotate(rotation, expand=True)
+        full_size = orig.size
+        draft(orig, thumb_size(full_size, max(THUMBNAILS.values())), margin)
+        image = orig
+        rotated = False
+        # Biggest first, KEEP_EXIF sizes have to be before any rotated one
+        for thumb_name, dim in sorted(THUMBNAILS.items(), key=lambda t: t[1], reverse=True):
+            size = thumb_size(full_size, dim)
+            if thumb_name not in KEEP_EXIF and rotation and not rotated:
+                image = image.transpose(ROTATIONS[rotation])
+                rotated = True
+            if rotated and rotation != 180:
+                size = size[::-1]
+            if image.size != size:
+                image = image.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+            yield thumb_name, image
+
+
+def _transplant_exif(source, image, new_file=None):
+    try:
+        piexif.transplant(source, image, new_file)
+    except ValueError:
+        # Original did not have EXIF to transplant
+        return False
+    return True
 
-        orig.save(out_name, format="JPEG", quality=THUMB_QUALITY, progressive=True)
-        generated[thumb_name] = out_name
+
+def generate_thumbnails(filename, thumbs_folder, base_name=None, margin=DRAFT_MARGIN):
+    """
+    Copies the original and writes its THUMBNAILS next to it, see
+    `render_thumbnails`. Sizes in KEEP_EXIF get the original EXIF.
+    """
+    generated = {
+        size: join(thumbs_folder, name)
+        for size, name in thumbnail_names(filename, base_name).items()
+    }
+    new_original = generated["original"]
+    shutil.copyfile(filename, new_original)
+    for thumb_name, image in render_thumbnails(new_original, margin):
+        out_name = generated[thumb_name]
+        image.save(out_name, format="JPEG", quality=THUMB_QUALITY, progressive=True)
         if thumb_name in KEEP_EXIF:
-            try:
-                piexif.transplant(new_original, out_name)
-            except ValueError:
-                # Original did not have EXIF to transplant
-                pass
+            _transplant_exif(new_original, out_name)
     return generated
 
 
+def encode_thumbnails(filename, margin=DRAFT_MARGIN):
+    """
+    THUMBNAILS of the image as JPEG bytes, for them to be uploaded without
+    going through the disk. Sizes in KEEP_EXIF get the original EXIF.
+    """
+    encoded = {}
+    for thumb_name, image in render_thumbnails(filename, margin):
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=THUMB_QUALITY, progressive=True)
+        data = buffer.getvalue()
+        if thumb_name in KEEP_EXIF:
+            with_exif = BytesIO()
+            if _transplant_exif(filename, data, with_exif):
+                data = with_exif.getvalue()
+        encoded[thumb_name] = data
+    return {thumb_name: encoded[thumb_name] for thumb_name in THUMBNAILS}
+
+
 TIME_FORMAT = "%Y:%m:%d %H:%M:%S"
 DAY_FORMAT = "%Y-%m-%d"
 
@@ -180,7 +280,13 @@ def delete_dir(filename):
 
 
 def read_exif(filename, upload_date, is_image):
-    exif = exifread.process_file(open(filename, "rb"))
+    with open(filename, "rb") as fh:
+        # Only standard tags are stored, skip maker notes and the thumbnail
+        exif = exifread.process_file(fh, details=False, extract_thumbnail=False)
+        if is_image:
+            fh.seek(0)
+            dims = Image.open(fh).size  # Only reads the header
+        size = os.fstat(fh.fileno()).st_size
     timestamp = None
     year, month, day = upload_date.year, upload_date.month, upload_date.day
     exif_read = bool(exif)
@@ -190,9 +296,7 @@ def read_exif(filename, upload_date, is_image):
         year, month, day = timestamp.split(" ")[0].split(":")
         year, month, day = int(year), int(month), int(day)
 
-    if is_image:
-        dims = Image.open(filename).size
-    else:
+    if not is_image:
         # Read from video metadata
         w = exif.get("EXIF ExifImageWidth")
         h = exif.get("EXIF ExifImageLength")
@@ -210,7 +314,7 @@ def read_exif(filename, upload_date, is_image):
         "orientation": str(exif.get("Image Orientation", "Horizontal (normal)")),
         "width": dims[0],
         "height": dims[1],
-        "size": os.stat(filename).st_size,
+        "size": size,
         "exif_read": exif_read,
     }
 
@@ -248,15 +352,6 @@ def end_batch(batch_id, settings):
     # delete_album(album_url, settings)
 
 
-# http://stackoverflow.com/a/7829658/43490
-def file_checksum(filename):
-    with open(filename, "rb") as fh:
-        d = md5()
-        for buf in iter(partial(fh.read, 1024), b""):
-            d.update(buf)
-    return d.hexdigest()
-
-
 def slugify(text):
     """
     Slugify inspired in Django's slugify
@@ -268,31 +363,120 @@ def slugify(text):
 
 
 FFMPEG_PATH = "ffmpeg"
+FFPROBE_PATH = "ffprobe"
+POSTER_NAME = "poster.jpg"
 
 
-def get_video_thumbnail(settings, full_filepath, filename, key):
+def _probe_time(value):
+    """ISO date from the container, e.g. 2019-03-04T10:11:12.000000Z, as TIME_FORMAT"""
+    try:
+        dt = datetime.strptime(value[:19].replace("T", " "), "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+    if dt.year < 1980:  # Cameras without a clock write 1970 or 1904
+        return None
+    return dt.strftime(TIME_FORMAT)
+
+
+def _probe_rotation(stream):
+    rotation = stream.get("tags", {}).get("rotate")
+    for side_data in stream.get("side_data_list", []):
+        if "rotation" in side_data:  # Newer ffprobe, counter clockwise
+            rotation = -int(side_data["rotation"])
+    try:
+        return int(rotation or 0) % 360
+    except ValueError:
+        return 0
+
+
+def probe_video(settings, full_filepath):
+    """
+    Reads container, codecs, duration, dimensions, rotation and creation
+    time of the video with a single ffprobe call. None if it can't be read.
+    Width and height are the displayed ones, rotation applied.
+    """
+    cmd = [
+        FFPROBE_PATH,
+        "-v",
+        "error",
+        "-print_format",
+        "json",
+        "-show_format",
+        "-show_streams",
+        full_filepath,
+    ]
+    try:
+        proc = get_media_tools(settings).run(cmd)
+        info = json.loads(proc.stdout.decode("utf-8"))
+    except (MediaToolError, ValueError) as ex:
+        log.warning("Could not probe %s: %s" % (full_filepath, ex))
+        return None
+    fmt = info.get("format")
+    if not fmt:
+        return None
+
+    streams = info.get("streams", [])
+    video = next((st for st in streams if st.get("codec_type") == "video"), {})
+    tags = fmt.get("tags", {})
+    rotation = _probe_rotation(video)
+    width, height = video.get("width"), video.get("height")
+    if rotation in (90, 270):
+        width, height = height, width
+    try:
+        duration = float(fmt.get("duration") or video.get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    # QuickTime keeps the local time, creation_time is in UTC
+    created = tags.get("com.apple.quicktime.creationdate") or tags.get("creation_time")
+    return {
+        "container": fmt.get("format_name", ""),
+        "codecs": [st["codec_name"] for st in streams if st.get("codec_name")],
+        "duration": duration,
+        "width": width,
+        "height": height,
+        "rotation": rotation,
+        "creation_time": _probe_time(created),
+    }
+
+
+def video_duration(settings, full_filepath):
+    """Length of the video in seconds, None if ffprobe can't tell"""
+    probe = probe_video(settings, full_filepath)
+    return probe["duration"] if probe else None
+
+
+def get_video_thumbnail(settings, full_filepath, filename, key, duration=None):
     dirname = os.path.dirname(full_filepath)
     output_dir = os.path.join(dirname, key)
+    poster = os.path.join(output_dir, POSTER_NAME)
 
+    # Seeking before the input jumps to the keyframe before the middle of the
+    # video and decodes from there, a single frame whatever its length
+    if duration is None:
+        duration = video_duration(settings, full_filepath)
+    middle = duration / 2 if duration else 0
     cmd = [
         FFMPEG_PATH,
+        "-ss",
+        "%.3f" % middle,
         "-i",
         full_filepath,
-        "-r",
-        "1/1",
-        "%s/%%03d.jpg" % output_dir,
+        "-frames:v",
+        "1",
+        "-y",
+        poster,
     ]
     try:
         os.mkdir(output_dir)
     except FileExistsError:
         # Dir already created
         pass
-    subprocess.call(cmd, stderr=subprocess.PIPE)
-    result = os.listdir(output_dir)
-    if result:
-        result = sorted(result)
-        center_frame = result[int(len(result) / 2)]  # Roughly center frame
-        thumbnail = os.path.join(output_dir, center_frame)
+    try:
+        get_media_tools(settings).run(cmd)
+    except MediaToolError as ex:
+        log.warning("Could not extract a frame of %s: %s" % (full_filepath, ex))
+    if os.path.exists(poster) and os.path.getsize(poster):
+        thumbnail = poster
     else:
         placeholder = os.path.join(output_dir, "bare-thumb.png")
         with open(placeholder, "wb") as fh:
@@ -313,23 +497,13 @@ VIDEO_MIMES = [
 ]
 
 
-def video_encoding(full_filepath):
-    cmd = [
-        FFMPEG_PATH,
-        "-i",
-        full_filepath,
-    ]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output, err = proc.communicate()
-    lines = output.decode("utf-8").splitlines()
-    for line in lines:
-        if line.startswith("Input") and full_filepath in line:
-            # This is the line that indicates the formats
-            formats = set(line.split(",", 1)[1].strip().split(" ")[0].strip(",").split(","))
-            for fmt, mime in VIDEO_MIMES:
-                if fmt in formats:
-                    return "video/%s" % mime
-    # Failed to find the line we wanted from ffmpeg output
+def video_mime(full_filepath, container=""):
+    """MIME type from the container formats ffprobe reports, e.g. mov,mp4,m4a"""
+    formats = set(container.split(","))
+    for fmt, mime in VIDEO_MIMES:
+        if fmt in formats:
+            return "video/%s" % mime
+    # ffprobe could not read it
     if full_filepath.lower().endswith(("mpg", "mpeg")):
         # Last attempt if its an mpeg file
         return "video/mpeg"
@@ -337,22 +511,35 @@ def video_encoding(full_filepath):
     return "video/avi"
 
 
-def video_exif(settings, full_filepath, upload_date, metadata_full_filepath, thumbnail):
-    video_enc = video_encoding(full_filepath)
+def video_exif(settings, full_filepath, upload_date, metadata_full_filepath, thumbnail, probe=None):
+    """
+    Builds the video metadata from its probe, done here if not given. A .THM
+    sidecar, when there is one, has the camera data. The thumbnail is only
+    read for dimensions the probe didn't have.
+    """
+    if probe is None:
+        probe = probe_video(settings, full_filepath) or {}
     if metadata_full_filepath:
         exif = read_exif(metadata_full_filepath, upload_date, is_image=False)
+        if not exif["width"] and probe.get("width"):
+            exif["width"], exif["height"] = probe["width"], probe["height"]
     else:
-        exif = read_exif(thumbnail, upload_date, is_image=True)
-        # Should be obtained from the video somehow
         year, month, day = upload_date.year, upload_date.month, upload_date.day
+        timestamp = probe.get("creation_time")
+        if timestamp:
+            year, month, day = (int(n) for n in timestamp.split(" ")[0].split(":"))
+        width, height = probe.get("width"), probe.get("height")
+        if not width:
+            dims = read_exif(thumbnail, upload_date, is_image=True)
+            width, height = dims["width"], dims["height"]
         exif = {
             "year": year,
             "month": month,
             "day": day,
-            "width": exif["width"],
-            "height": exif["height"],
+            "width": width,
+            "height": height,
             "size": os.stat(full_filepath).st_size,
-            "timestamp": upload_date,
+            "timestamp": timestamp or upload_date,
         }
-    exif["mime"] = video_enc
+    exif["mime"] = video_mime(full_filepath, probe.get("container", ""))
     return exif
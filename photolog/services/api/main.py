@@ -2,12 +2,17 @@ import os
 import uuid
 import binascii
 from hashlib import md5
+from functools import partial
 from datetime import datetime
 
 from werkzeug.utils import secure_filename
 
+from photolog.squeue import PRIORITY_NORMAL
 from photolog.services.api.base import random_string
 
+# Uploads are copied to disk in chunks this big, instead of whole in memory
+CHUNK_SIZE = 1024 * 1024
+
 
 # Expected MIME types for file extensions
 MIME_TYPES = {
@@ -62,15 +67,66 @@ def unique_filename(filename, salt, path):
     return final_filename
 
 
-def crc(file):
-    buf = file.read()
-    file.seek(0)
-    return "%08X" % (binascii.crc32(buf) & 0xFFFFFFFF)
+def save_upload(uploaded_file, path):
+    """
+    Saves an uploaded file in `path`, reading it once to compute its CRC, which
+    seasons its name, and MD5 checksum while it is written. Returns the name
+    it was saved with and the checksum.
+    """
+    digest, crc = md5(), 0
+    partial_name = os.path.join(path, ".upload-%s" % uuid.uuid4().hex)
+    try:
+        with open(partial_name, "wb") as fh:
+            for chunk in iter(partial(uploaded_file.read, CHUNK_SIZE), b""):
+                digest.update(chunk)
+                crc = binascii.crc32(chunk, crc)
+                fh.write(chunk)
+        filename = unique_filename(
+            secure_filename(uploaded_file.filename), "%08X" % (crc & 0xFFFFFFFF), path
+        )
+        os.rename(partial_name, os.path.join(path, filename))
+    except BaseException:
+        if os.path.exists(partial_name):
+            os.remove(partial_name)
+        raise
+    return filename, digest.hexdigest()
+
 
+def upload_job(
+    _settings,
+    uploaded_file,
+    metadata_file,
+    tags,
+    skip,
+    batch_id,
+    is_last,
+    target_date,
+):
+    """
+    Stores the uploaded file (and its metadata file, if any) and returns the
+    job that will process it.
+    """
+    filename, checksum = save_upload(uploaded_file, _settings.UPLOAD_FOLDER)
 
-def filename_for_file(uploaded_file, filename, path):
-    _crc = crc(uploaded_file)
-    return unique_filename(secure_filename(filename), _crc, path)
+    if metadata_file:
+        metadata_filename, _ = save_upload(metadata_file, _settings.UPLOAD_FOLDER)
+    return {
+        "type": "upload",
+        "key": uuid.uuid4().hex,
+        "filename": filename,
+        "tags": tags,
+        "original_filename": uploaded_file.filename,
+        "metadata_filename": metadata_filename if metadata_file else None,
+        "uploaded_at": datetime.now(),
+        "target_date": target_date,
+        "step": "upload_and_store",  # First thing to do to the pics,
+        # Store additional parameters, the checksum spares hashing it again
+        "data": {"checksum": checksum},
+        "attempt": 0,  # Records how many times this step has been attempted
+        "skip": skip,
+        "batch_id": batch_id,
+        "is_last": bool(is_last),
+    }
 
 
 def queue_file(
@@ -84,33 +140,24 @@ def queue_file(
     is_last,
     target_date,
 ):
-    filename = filename_for_file(uploaded_file, uploaded_file.filename, _settings.UPLOAD_FOLDER)
-    uploaded_file.save(os.path.join(_settings.UPLOAD_FOLDER, filename))
-
-    if metadata_file:
-        metadata_filename = filename_for_file(
-            metadata_file, metadata_file.filename, _settings.UPLOAD_FOLDER
-        )
-        metadata_file.save(os.path.join(_settings.UPLOAD_FOLDER, metadata_filename))
-    _queue.append(
-        {
-            "type": "upload",
-            "key": uuid.uuid4().hex,
-            "filename": filename,
-            "tags": tags,
-            "original_filename": uploaded_file.filename,
-            "metadata_filename": metadata_filename if metadata_file else None,
-            "uploaded_at": datetime.now(),
-            "target_date": target_date,
-            "step": "upload_and_store",  # First thing to do to the pics,
-            "data": {},  # Store additional parameters,
-            "attempt": 0,  # Records how many times this step has been attempted
-            "skip": skip,
-            "batch_id": batch_id,
-            "is_last": bool(is_last),
-        }
+    job = upload_job(
+        _settings, uploaded_file, metadata_file, tags, skip, batch_id, is_last, target_date
     )
-    return filename
+    _queue.append(job, priority=PRIORITY_NORMAL)
+    return job["filename"]
+
+
+def queue_files(_settings, _queue, uploaded_files, tags, skip, batch_id, is_last, target_date):
+    """
+    Queues several uploaded files at once, in a single queue transaction.
+    Metadata files are only supported on single file uploads.
+    """
+    jobs = [
+        upload_job(_settings, uploaded_file, None, tags, skip, batch_id, is_last, target_date)
+        for uploaded_file in uploaded_files
+    ]
+    _queue.append_many(jobs, priority=PRIORITY_NORMAL)
+    return [job["filename"] for job in jobs]
 
 
 def valid_secret(secret_from_header, api_secret):
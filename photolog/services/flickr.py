@@ -1,7 +1,11 @@
+import threading
+
 import flickrapi
 import flickrapi.shorturl
 import flickrapi.auth
 
+from photolog.limits import ServiceError
+
 """
 
 Need to create an app type "Desktop application"
@@ -26,6 +30,9 @@ FLICKR_APP_SECRET = api.flickr_oauth.oauth.client.resource_owner_secret
 
 KEY_LOOKUP_USER = "Photolog"
 
+# FlickrAPI keeps an HTTP session, one per thread so connections are reused
+_local = threading.local()
+
 
 def build(settings):
     token = flickrapi.auth.FlickrAccessToken(
@@ -43,11 +50,20 @@ def build(settings):
     return api
 
 
+def get_api(settings):
+    """API client for this thread, built once"""
+    api = getattr(_local, "api", None)
+    if api is None or _local.token != settings.FLICKR_APP_TOKEN:
+        api = _local.api = build(settings)
+        _local.token = settings.FLICKR_APP_TOKEN
+    return api
+
+
 def upload(settings, title, filename, tags):
     """
     Uploads the given file to Flickr and returns its url
     """
-    api = build(settings)
+    api = get_api(settings)
     uploaded = api.upload(
         filename=filename,
         tags=" ".join(tags),
@@ -61,6 +77,6 @@ def upload(settings, title, filename, tags):
     # https://secure.flickr.com/services/api/response.rest.html
     stat = dict(uploaded.items()).get("stat")
     if stat != "ok":
-        raise ValueError("Error uploading photo to Flickr")
+        raise ServiceError("Error uploading photo to Flickr")
     photo_id = uploaded.find("photoid").text
     return flickrapi.shorturl.url(photo_id), photo_id
@@ -1,15 +1,21 @@
-import os
-from time import time, sleep
+import threading
+from time import time
 import xml.etree.ElementTree as etree
 
 import requests
 from photolog.db import TokensDB
+from photolog.limits import Throttled, ServiceError
 from photolog import queue_logger as log
 
 SERVICE = "gphotos"
 UPLOAD_ENDPOINT = "https://photoslibrary.googleapis.com/v1/uploads"
 ITEM_ENDPOINT = "https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate"
 EXCHANGE_TOKEN_ENDPOINT = "https://www.googleapis.com/oauth2/v4/token"
+# Seconds to back off on RESOURCE_EXHAUSTED when no Retry-After is sent
+THROTTLE_DELAY = 60
+
+# requests sessions aren't thread safe, keep one per thread to reuse connections
+_local = threading.local()
 
 etree.register_namespace("", "http://www.w3.org/2005/Atom")
 etree.register_namespace("gphoto", "http://schemas.google.com/photos/2007")
@@ -18,17 +24,27 @@ etree.register_namespace("app", "http://www.w3.org/2007/app")
 etree.register_namespace("gd", "http://schemas.google.com/g/2005")
 
 
+def get_session():
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
 def refresh_access_token(tokens, client_id, secret, refresh_token):
-    response = requests.post(
-        EXCHANGE_TOKEN_ENDPOINT,
-        data={
-            "refresh_token": refresh_token,
-            "client_id": client_id,
-            "client_secret": secret,
-            "grant_type": "refresh_token",
-            "access_type": "offline",
-        },
-    ).json()
+    response = (
+        get_session()
+        .post(
+            EXCHANGE_TOKEN_ENDPOINT,
+            data={
+                "refresh_token": refresh_token,
+                "client_id": client_id,
+                "client_secret": secret,
+                "grant_type": "refresh_token",
+                "access_type": "offline",
+            },
+        )
+        .json()
+    )
     if "access_token" in response:
         tokens.update_token(
             SERVICE,
@@ -40,7 +56,7 @@ def refresh_access_token(tokens, client_id, secret, refresh_token):
     else:
         # Some error
         log.error("Error refreshing %s token: %s" % (SERVICE, response))
-        raise ValueError("Error refreshing %s token: %s" % (SERVICE, response))
+        raise ServiceError("Error refreshing %s token: %s" % (SERVICE, response))
 
 
 def _get_file_bytes(filename, fallback_s3_url):
@@ -53,7 +69,7 @@ def _get_file_bytes(filename, fallback_s3_url):
             raise
 
         log.info("Local file not found, fetching from S3: %s" % fallback_s3_url)
-        response = requests.get(fallback_s3_url)
+        response = get_session().get(fallback_s3_url)
         response.raise_for_status()
         return response.content
 
@@ -97,31 +113,37 @@ def _upload_video(filename, name, access_token, token_type, mime, fallback_s3_ur
     return do_upload(files, headers)
 
 
-def do_upload(files, headers, retry=True):
+def _throttled(response):
+    """RESOURCE_EXHAUSTED, waits what the service asks for if it says"""
+    try:
+        delay = float(response.headers.get("Retry-After", THROTTLE_DELAY))
+    except ValueError:  # Could be an HTTP date, rarely sent by Google
+        delay = THROTTLE_DELAY
+    log.info("%s is throttling, backing off %.0fs" % (SERVICE, delay))
+    return Throttled(SERVICE, delay, response.text)
+
+
+def do_upload(files, headers):
     """
     Follows the steps described in:
         https://developers.google.com/photos/library/guides/upload-media
+    Raises Throttled when rate limited, the job is retried later instead of
+    holding the worker.
     :param files: The bytes to upload
     :param headers: dict of headers to upload containing the Authorization
-    :param retry: Boolean to indicate if we should backoff/retry
     :return: media item ID
     """
     try:
-        response = requests.post(UPLOAD_ENDPOINT, data=files, headers=headers)
+        response = get_session().post(UPLOAD_ENDPOINT, data=files, headers=headers)
     except Exception as err:
         log.exception(err)
         raise
 
     if response.status_code == 429:
-        # RESOURCE_EXHAUSTED
-        if retry:
-            log.info("Sleeping for 60s")
-            sleep(60)  # Wait a minute
-            log.info("Retrying")
-            return do_upload(files, headers, retry=False)
+        raise _throttled(response)
     elif response.status_code > 300:
         log.error("Failed obtain upload token: %s" % response.text)
-        raise ValueError(response.text)
+        raise ServiceError(response.text)
     upload_token = response.text
 
     new_items = {
@@ -133,7 +155,7 @@ def do_upload(files, headers, retry=True):
         ]
     }
     try:
-        item_response = requests.post(
+        item_response = get_session().post(
             ITEM_ENDPOINT,
             json=new_items,
             headers={
@@ -146,15 +168,10 @@ def do_upload(files, headers, retry=True):
         raise
 
     if item_response.status_code == 429:
-        # RESOURCE_EXHAUSTED
-        if retry:
-            log.info("Sleeping for 60s")
-            sleep(60)  # Wait a minute
-            log.info("Retrying")
-            return do_upload(files, headers, retry=False)
+        raise _throttled(item_response)
     elif item_response.status_code > 300:
         log.error("Failed to upload: %s" % item_response.text)
-        raise ValueError(item_response.text)
+        raise ServiceError(item_response.text)
 
     new_items_resp = item_response.json()
     return new_items_resp["newMediaItemResults"][0]["mediaItem"]
@@ -2,44 +2,81 @@
 
 import os
 import math
-import boto3
+import threading
 from os.path import basename
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
 
 from photolog import queue_logger as log
 
 
+# Connections kept open per client, shared by all the threads using it
+MAX_CONNECTIONS = 32
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(settings):
+    """
+    S3 client for the configured credentials. boto3 clients are thread safe,
+    so a single one is shared to reuse its connections between uploads.
+    """
+    credentials = (settings.S3_ACCESS_KEY, settings.S3_SECRET_KEY)
+    with _clients_lock:
+        if credentials not in _clients:
+            _clients[credentials] = boto3.client(
+                "s3",
+                aws_access_key_id=settings.S3_ACCESS_KEY,
+                aws_secret_access_key=settings.S3_SECRET_KEY,
+                config=Config(max_pool_connections=MAX_CONNECTIONS),
+            )
+        return _clients[credentials]
+
+
 def upload_thumbs(settings, thumbs, path):
     """
     Receives an object with a list of thumbnails, uploads them to s3 and returns
      another object with the s3 urls of those files
     """
-    s3_client = boto3.client(
-        "s3",
-        aws_access_key_id=settings.S3_ACCESS_KEY,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
-    )
-    uploaded = {}
-    for thumb_name, full_filename in thumbs.items():
-        filename = basename(full_filename)
-        key = f"{path}/{filename}"
+    objects = {size: (basename(filename), filename) for size, filename in thumbs.items()}
+    return upload_objects(settings, objects, path)
+
+
+def upload_objects(settings, objects, path):
+    """
+    Uploads {size: (name, body)} under `path` and returns {size: url}. A body
+    is either the name of a file, read as it is sent, or the bytes to store,
+    so thumbnails made in memory don't have to be written to disk first.
+    """
+    s3_client = get_client(settings)
+
+    def upload(item):
+        name, body = item
+        key = f"{path}/{name}"
+        if isinstance(body, bytes):
+            s3_client.put_object(Bucket=settings.S3_BUCKET, Key=key, Body=body, ACL="public-read")
+        else:
+            with open(body, "rb") as f:
+                s3_client.put_object(Bucket=settings.S3_BUCKET, Key=key, Body=f, ACL="public-read")
 
-        with open(full_filename, "rb") as f:
-            s3_client.put_object(Bucket=settings.S3_BUCKET, Key=key, Body=f, ACL="public-read")
+        return f"https://{settings.S3_BUCKET}.s3.amazonaws.com/{key}"
 
-        url = f"https://{settings.S3_BUCKET}.s3.amazonaws.com/{key}"
-        uploaded[thumb_name] = url
-    return uploaded
+    if not objects:
+        return {}
+    # All sizes go up at once instead of one after another
+    with ThreadPoolExecutor(max_workers=len(objects)) as pool:
+        urls = pool.map(upload, objects.values())
+        return dict(zip(objects.keys(), urls))
 
 
 CHUNK_SIZE = int(5e3 * 2**20)
 
 
 def upload_video(settings, video_full_filename, path):
-    s3_client = boto3.client(
-        "s3",
-        aws_access_key_id=settings.S3_ACCESS_KEY,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
-    )
+    s3_client = get_client(settings)
     video_filename = basename(video_full_filename)
     key = f"{path}/{video_filename}"
 
@@ -3,7 +3,8 @@ import json
 import uuid
 import xml.etree.ElementTree as etree
 from io import StringIO
-from datetime import datetime
+
+from photolog.squeue import PRIORITY_HIGH
 
 
 def human_size(size):
@@ -114,10 +115,6 @@ def tag_day_job(queue, year: int, month: int, day: int, tags):
             "day": day,
             "tags": tags,
             "attempt": 0,
-        }
+        },
+        priority=PRIORITY_HIGH,
     )
-
-
-def serial_job(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
@@ -1,5 +1,6 @@
 import os
 import yaml
+import tempfile
 
 
 class Settings(object):
@@ -8,7 +9,32 @@ class Settings(object):
     DB_FILE = os.path.join(PROJECT_DIR, "photos.db")
     UPLOAD_FOLDER = os.path.join(PROJECT_DIR, "media")
     THUMBS_FOLDER = os.path.join(UPLOAD_FOLDER, "thumbs")
+    # Make photo thumbnails in memory and send them straight to S3, together
+    # with the original from UPLOAD_FOLDER, instead of through THUMBS_FOLDER
+    THUMBS_IN_MEMORY = False
     MAX_QUEUE_ATTEMPTS = 3
+    QUEUE_LEASE_TIME = 300  # Seconds before a dead worker's job is picked up again
+    QUEUE_RETRY_RATE = 1  # Bad jobs per second released back when retrying them all
+    QUEUE_WORKERS = 1  # Worker processes started by start_queue
+    QUEUE_CONCURRENCY = 1  # Network bound jobs each worker keeps in flight
+    # Max jobs in flight per stage and worker, within QUEUE_CONCURRENCY
+    SERVICE_CONCURRENCY = {"flickr": 4, "gphotos": 8}
+    # (calls per second, burst) per service, shared by all the workers
+    SERVICE_RATE_LIMITS = {"s3": (20, 40), "flickr": (1, 3), "gphotos": (2, 5)}
+    CIRCUIT_BREAKER_FAILURES = 5  # Failed calls in a row that pause a service
+    CIRCUIT_BREAKER_COOLDOWN = 60  # Seconds a paused service waits, doubling each time
+    METRICS_ENABLED = True  # Record the time taken by every job step
+    METRICS_MAX_ROWS = 50000  # Step timings kept, older ones are dropped
+    # Workers exit between jobs after this many jobs or over this RSS, to be
+    # started afresh by the supervisor. 0 disables each limit.
+    WORKER_MAX_JOBS = 500
+    WORKER_MAX_RSS_MB = 1024
+    # ffmpeg and ffprobe run at most this many at once on the box, across
+    # all workers, holding a lock file in MEDIA_TOOLS_LOCK_DIR
+    MEDIA_TOOLS_CONCURRENCY = 2
+    MEDIA_TOOLS_LOCK_DIR = os.path.join(tempfile.gettempdir(), "photolog-media-tools")
+    MEDIA_TOOLS_TIMEOUT = 300  # Seconds before a media tool is killed
+    MEDIA_TOOLS_NICE = 10  # CPU niceness of media tools, 0 runs them as usual
 
     @classmethod
     def load(cls, settings_file):
@@ -18,3 +44,8 @@ class Settings(object):
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
             setattr(self, k, v)
+
+
+def setting(settings, name):
+    """`name` from a settings object, or its Settings default if not set"""
+    return getattr(settings, name, getattr(Settings, name))
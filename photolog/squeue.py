@@ -1,9 +1,21 @@
 # Snippet from: http://flask.pocoo.org/snippets/88/
 
 import os
+import json
+import zlib
+import errno
+import select
+import socket
 import sqlite3
-from pickle import loads, dumps
-from time import sleep
+import tempfile
+import threading
+import pickle
+from hashlib import md5
+from datetime import datetime
+from time import sleep, time
+
+from photolog import queue_logger as log
+from photolog.db import dict_factory
 
 try:
     from _thread import get_ident
@@ -11,38 +23,455 @@ except ImportError:
     from _dummy_thread import get_ident
 
 
+class Wakeup(object):
+    """
+    Local wake-up channel so idle consumers don't have to poll the database.
+
+    Every waiting thread binds a unix datagram socket inside a directory shared
+    by all the processes using the same queue file. Producers send one byte to
+    each socket found there after committing. If unix sockets are not
+    available the channel is disabled and `wait` just sleeps.
+    """
+
+    def __init__(self, path, enabled=True):
+        digest = md5(path.encode("utf-8")).hexdigest()[:12]
+        self.dir = os.path.join(tempfile.gettempdir(), "photolog-queue-%s" % digest)
+        self.enabled = enabled and hasattr(socket, "AF_UNIX")
+        self._sockets = {}
+
+    def listen(self):
+        """
+        Starts receiving notifications for this thread. Must happen before
+        checking the queue so no notification can be missed in between.
+        """
+        _id = get_ident()
+        if not self.enabled or _id in self._sockets:
+            return
+        address = os.path.join(self.dir, "%s-%s" % (os.getpid(), _id))
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            if os.path.exists(address):
+                os.remove(address)  # Left behind by a dead process with same pid
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(address)
+            sock.setblocking(False)
+        except OSError:
+            # Path too long, read only tmp, etc. Fallback to polling
+            self.enabled = False
+            return
+        self._sockets[_id] = sock
+
+    def wait(self, timeout):
+        sock = self._sockets.get(get_ident())
+        if sock is None:
+            sleep(timeout)
+            return
+        select.select([sock], [], [], timeout)
+        try:
+            while sock.recv(64):  # Drain, one wake up is enough
+                pass
+        except BlockingIOError:
+            pass
+
+    def notify(self):
+        """
+        Best effort, the item is committed already and consumers poll anyway,
+        so errors are logged and never raised.
+        """
+        if not self.enabled:
+            return
+        try:
+            listeners = os.listdir(self.dir)
+        except FileNotFoundError:
+            return  # Nobody ever waited
+        except OSError as err:
+            log.warning("Can't wake up consumers in %s: %s" % (self.dir, err))
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            for name in listeners:
+                address = os.path.join(self.dir, name)
+                try:
+                    sock.sendto(b"1", address)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Consumer is gone, clean up after it
+                    try:
+                        os.remove(address)
+                    except OSError:
+                        pass
+                except OSError as err:
+                    # Buffer full means there are wake ups pending already
+                    if err.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                        # E.g. a consumer of another user, it will poll
+                        log.warning("Can't wake up consumer %s: %s" % (address, err))
+
+
+class PickleCodec(object):
+    """
+    Original payload format. Only kept to read rows queued by older versions,
+    pickle payloads can't be inspected without executing them.
+    """
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, 2)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JsonCodec(object):
+    """
+    Compact JSON payloads with explicit codecs for the non JSON types jobs
+    carry: datetimes and sets (tuples come back as lists).
+
+    Payloads start with a two bytes header: `J` or `Z` (zlib compressed)
+    followed by the format version. Pickled rows from older versions start
+    with the pickle protocol marker and are still readable.
+    """
+
+    VERSION = 1
+    COMPRESS_OVER = 1024  # Payload bytes
+    _plain = b"J"
+    _compressed = b"Z"
+    _pickled = 0x80  # Pickle protocol >= 2 opcode
+
+    def __init__(self, compress_over=COMPRESS_OVER):
+        self.compress_over = compress_over
+        self._encoder = json.JSONEncoder(
+            separators=(",", ":"), ensure_ascii=False, default=self._encode
+        )
+        self._decoder = json.JSONDecoder(object_hook=self._decode)
+        self._legacy = PickleCodec()
+
+    @staticmethod
+    def _encode(obj):
+        if isinstance(obj, datetime):
+            return {"__dt__": obj.isoformat()}
+        if isinstance(obj, (set, frozenset)):
+            return {"__set__": list(obj)}
+        raise TypeError("Cannot serialize %s in a queue payload" % type(obj).__name__)
+
+    @staticmethod
+    def _decode(obj):
+        if len(obj) == 1:
+            if "__dt__" in obj:
+                return datetime.fromisoformat(obj["__dt__"])
+            if "__set__" in obj:
+                return set(obj["__set__"])
+        return obj
+
+    def dumps(self, obj):
+        data = self._encoder.encode(obj).encode("utf-8")
+        version = bytes([self.VERSION])
+        if len(data) > self.compress_over:
+            return self._compressed + version + zlib.compress(data)
+        return self._plain + version + data
+
+    def loads(self, data):
+        data = bytes(data)
+        if data[0] == self._pickled:
+            return self._legacy.loads(data)
+        kind, version, body = data[:1], data[1], data[2:]
+        if version > self.VERSION:
+            raise ValueError("Unsupported queue payload version %s" % version)
+        if kind == self._compressed:
+            body = zlib.decompress(body)
+        elif kind != self._plain:
+            raise ValueError("Unknown queue payload format %r" % kind)
+        return self._decoder.decode(body.decode("utf-8"))
+
+
+def worker_id():
+    """Identifies this process as owner of the items it claims"""
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+class Heartbeat(object):
+    """
+    Keeps extending the leases of the items a worker is processing, from a
+    background thread, so long running steps don't get their job reclaimed.
+    """
+
+    def __init__(self, queue, worker, lease_time):
+        self.queue = queue
+        self.worker = worker
+        self.lease_time = lease_time
+        self._items = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="queue-heartbeat", daemon=True)
+        self._thread.start()
+
+    def add(self, item_id):
+        with self._lock:
+            self._items.add(item_id)
+
+    def discard(self, item_id):
+        with self._lock:
+            self._items.discard(item_id)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.lease_time / 3):
+            with self._lock:
+                items = list(self._items)
+            for item_id in items:
+                if not self.queue.heartbeat(item_id, self.worker, self.lease_time):
+                    log.warning("Lost lease of queue item %s" % item_id)
+                    self.discard(item_id)
+
+
+# Lower goes first. Interactive jobs shouldn't wait behind upload batches.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+
+# Upload steps are named after their outcome; the first one runs local_process
+STEP_STAGES = {"upload_and_store": "local_process"}
+
+
+def job_stage(obj):
+    """
+    Stage a queued job is at, so workers can be dedicated to some stages only.
+    That's the step for uploads (local_process, flickr, gphotos, finish) and
+    the job type for everything else.
+    """
+    if not isinstance(obj, dict):
+        return None
+    if obj.get("type", "upload") == "upload":
+        step = obj.get("step")
+        return STEP_STAGES.get(step, step)
+    return obj.get("type")
+
+
+def job_meta(obj):
+    """
+    Columns stored next to a job's payload, so the queue can be listed,
+    counted and searched with plain SQL without decoding any payload.
+    Matches `SqliteQueue._meta_columns`.
+    """
+    if not isinstance(obj, dict):
+        return job_stage(obj), None, None, None, None, None
+    return (
+        job_stage(obj),
+        obj.get("key"),
+        obj.get("type"),
+        obj.get("step"),
+        obj.get("attempt"),
+        obj.get("filename"),
+    )
+
+
 class SqliteQueue(object):
+    # Max seconds an idle consumer waits before checking the queue anyway, in
+    # case a notification got lost (e.g. rows inserted by an external tool)
+    POLL_FALLBACK = 5
+    # Seconds a claimed item stays invisible to other workers without heartbeat
+    LEASE_TIME = 300
+
     _create = [
-        ("CREATE TABLE IF NOT EXISTS queue (  id INTEGER PRIMARY KEY AUTOINCREMENT,  item BLOB)"),
+        (
+            "CREATE TABLE IF NOT EXISTS queue "
+            "("
+            "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  item BLOB,"
+            "  worker TEXT,"
+            "  lease_expires REAL,"
+            "  priority INTEGER NOT NULL DEFAULT %(normal)s,"
+            "  stage TEXT,"
+            "  not_before REAL NOT NULL DEFAULT 0,"
+            "  key TEXT,"
+            "  type TEXT,"
+            "  step TEXT,"
+            "  attempt INTEGER,"
+            "  filename TEXT,"
+            "  enqueued_at REAL,"
+            "  error TEXT,"
+            "  parent INTEGER,"
+            "  pending INTEGER NOT NULL DEFAULT 0"
+            ")"
+        )
+        % {"normal": PRIORITY_NORMAL},
         (
             "CREATE TABLE IF NOT EXISTS bad_jobs "
             "("
             "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
-            "  item BLOB"
+            "  item BLOB,"
+            "  priority INTEGER NOT NULL DEFAULT %(normal)s,"
+            "  stage TEXT,"
+            "  key TEXT,"
+            "  type TEXT,"
+            "  step TEXT,"
+            "  attempt INTEGER,"
+            "  filename TEXT,"
+            "  enqueued_at REAL,"
+            "  error TEXT,"
+            "  parent INTEGER"
             ")"
-        ),
+        )
+        % {"normal": PRIORITY_NORMAL},
+    ]
+    # Columns added after the tables were first created, so older databases
+    # get upgraded in place.
+    _upgrade = (
+        [
+            ("queue", "worker", "TEXT"),
+            ("queue", "lease_expires", "REAL"),
+            ("queue", "priority", "INTEGER NOT NULL DEFAULT %s" % PRIORITY_NORMAL),
+            ("bad_jobs", "priority", "INTEGER NOT NULL DEFAULT %s" % PRIORITY_NORMAL),
+            ("queue", "stage", "TEXT"),
+            ("bad_jobs", "stage", "TEXT"),
+            ("queue", "not_before", "REAL NOT NULL DEFAULT 0"),
+        ]
+        + [
+            (table, column, definition)
+            for table in ("queue", "bad_jobs")
+            for column, definition in (
+                ("key", "TEXT"),
+                ("type", "TEXT"),
+                ("step", "TEXT"),
+                ("attempt", "INTEGER"),
+                ("filename", "TEXT"),
+                ("enqueued_at", "REAL"),
+                ("error", "TEXT"),
+                ("parent", "INTEGER"),
+            )
+        ]
+        + [
+            ("queue", "pending", "INTEGER NOT NULL DEFAULT 0"),
+        ]
+    )
+    # Branches of a job keep the place in line of the job they come from
+    _line = "priority, COALESCE(parent, id), id"
+    _indexes = [
+        "DROP INDEX IF EXISTS queue_priority",  # Replaced by queue_line
+        "CREATE INDEX IF NOT EXISTS queue_line ON queue (%s)" % _line,
+        "CREATE INDEX IF NOT EXISTS queue_stage ON queue (stage, priority, id)",
+        "CREATE INDEX IF NOT EXISTS queue_not_before ON queue (not_before)",
+        "CREATE INDEX IF NOT EXISTS queue_key ON queue (key)",
+        "CREATE INDEX IF NOT EXISTS queue_type ON queue (type)",
+        "CREATE INDEX IF NOT EXISTS queue_step ON queue (step)",
+        "CREATE INDEX IF NOT EXISTS bad_jobs_key ON bad_jobs (key)",
+        "CREATE INDEX IF NOT EXISTS bad_jobs_type ON bad_jobs (type)",
     ]
+    # Derived from the payload by `job_meta`, in this order
+    _meta_columns = "stage, key, type, step, attempt, filename"
+    # Columns jobs can be counted by
+    _countable = ("type", "step", "stage")
+    _table_info = "PRAGMA table_info(%s)"
+    _add_column = "ALTER TABLE %s ADD COLUMN %s %s"
+    _all_items = "SELECT id, item FROM %s"
+    _set_meta = (
+        "UPDATE %s SET stage = ?, key = ?, type = ?, step = ?, attempt = ?, filename = ?"
+        " WHERE id = ?"
+    )
     _count = "SELECT COUNT(*) count FROM queue"
     _count_bad = "SELECT COUNT(*) count FROM bad_jobs"
     _iterate = "SELECT id, item FROM queue"
-    _append = "INSERT INTO queue (item) VALUES (?)"
-    _append_bad = "INSERT INTO bad_jobs (item) VALUES (?)"
+    _append = (
+        "INSERT INTO queue (item, %s, priority, not_before, enqueued_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % _meta_columns
+    )
+    _append_bad = (
+        "INSERT INTO bad_jobs (item, %s, priority, enqueued_at, error)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % _meta_columns
+    )
     _bad_jobs = "SELECT item FROM bad_jobs ORDER BY id DESC LIMIT ?"
     _bad_jobs_raw = "SELECT * FROM bad_jobs"
     _write_lock = "BEGIN IMMEDIATE"
-    _popleft_get = "SELECT id, item FROM queue ORDER BY id LIMIT 1"
+    _popleft_get = (
+        "SELECT id, item, worker FROM queue"
+        " WHERE (lease_expires IS NULL OR lease_expires < ?) AND not_before <= ?"
+        " AND pending = 0%%s ORDER BY %s LIMIT ?" % _line
+    )
+    _next_due = "SELECT MIN(not_before) FROM queue WHERE not_before > ? AND pending = 0%s"
     _popleft_del = "DELETE FROM queue WHERE id = ?"
-    _peek = "SELECT item FROM queue ORDER BY id LIMIT ?"
-    _retry = "INSERT INTO queue(item) SELECT item FROM bad_jobs"
-    _drop_bad = "DELETE FROM bad_jobs"
-    _purge_bad = "DELETE from bad_jobs WHERE id=?"
+    _claim = "UPDATE queue SET worker = ?, lease_expires = ? WHERE id = ?"
+    _heartbeat = "UPDATE queue SET lease_expires = ? WHERE id = ? AND worker = ?"
+    _ack = "DELETE FROM queue WHERE id = ? AND worker = ?"
+    # A finished branch lets its parent go on once all the others finished too
+    _join = (
+        "UPDATE queue SET pending = pending - 1"
+        " WHERE id = (SELECT parent FROM queue WHERE id = ? AND worker = ?)"
+    )
+    _fork_branch = (
+        "INSERT INTO queue (item, %s, priority, enqueued_at, parent)"
+        " SELECT ?, ?, ?, ?, ?, ?, ?, priority, enqueued_at, id FROM queue"
+        " WHERE id = ? AND worker = ?" % _meta_columns
+    )
+    _fork = (
+        "UPDATE queue SET item = ?, stage = ?, key = ?, type = ?, step = ?, attempt = ?,"
+        " filename = ?, worker = NULL, lease_expires = NULL, error = NULL, pending = ?"
+        " WHERE id = ? AND worker = ?"
+    )  # Follow up items keep the priority of the item they come from
+    _bury = (
+        "INSERT INTO bad_jobs (item, %s, priority, enqueued_at, error, parent)"
+        " SELECT ?, ?, ?, ?, ?, ?, ?, priority, enqueued_at, ?, parent FROM queue"
+        " WHERE id = ? AND worker = ?" % _meta_columns
+    )
+    _release = (
+        "UPDATE queue SET item = ?, stage = ?, key = ?, type = ?, step = ?, attempt = ?,"
+        " filename = ?, worker = NULL, lease_expires = NULL, not_before = ?, error = ?"
+        " WHERE id = ? AND worker = ?"
+    )
+    _peek = "SELECT item FROM queue ORDER BY %s LIMIT ?" % _line
+    _retry = (
+        "INSERT INTO queue (item, %(meta)s, priority, enqueued_at, error, parent, not_before)"
+        " SELECT item, %(meta)s, priority, enqueued_at, error, parent, ? FROM bad_jobs"
+        " WHERE id = ?" % {"meta": _meta_columns}
+    )
+    _list = (
+        "SELECT id, %s, priority, enqueued_at, not_before, worker, error, parent, pending"
+        " FROM queue ORDER BY %s LIMIT ?" % (_meta_columns, _line)
+    )
+    _list_bad = (
+        "SELECT id, %s, priority, enqueued_at, error FROM bad_jobs"
+        " ORDER BY id DESC LIMIT ?" % _meta_columns
+    )
+    _count_by = "SELECT %(column)s, COUNT(*) count FROM %(table)s GROUP BY %(column)s"
+    _bad_ids = "SELECT id FROM bad_jobs ORDER BY id"
+    _drop_bad = "DELETE FROM bad_jobs WHERE id = ?"
+    _purge_bad = "DELETE FROM bad_jobs WHERE %s"
+    # Giving up on a failed branch lets its parent job finish without it
+    _abandon_branches = (
+        "UPDATE queue SET pending = pending -"
+        " (SELECT COUNT(*) FROM bad_jobs WHERE parent = queue.id AND %(where)s)"
+        " WHERE id IN (SELECT parent FROM bad_jobs WHERE %(where)s)"
+    )
 
-    def __init__(self, path):
+    def __init__(self, path, wakeup=True, codec=None):
         self.path = os.path.abspath(path)
+        self.codec = codec or JsonCodec()
         self._connection_cache = {}
+        self._wakeup = Wakeup(self.path, enabled=wakeup)
         with self._get_conn() as conn:
+            conn.execute(self._write_lock)  # Other processes may be upgrading too
             for table in self._create:
                 conn.execute(table)
+            upgraded = set()
+            for table, column, definition in self._upgrade:
+                columns = {row[1] for row in conn.execute(self._table_info % table)}
+                if column not in columns:
+                    conn.execute(self._add_column % (table, column, definition))
+                    upgraded.add(table)
+            for table in upgraded:
+                self._refresh_meta(conn, table)
+            for index in self._indexes:
+                conn.execute(index)
+
+    def _pack(self, obj):
+        """Serialized object and the columns derived from it, as stored"""
+        return (memoryview(self.codec.dumps(obj)),) + job_meta(obj)
+
+    def _refresh_meta(self, conn, table):
+        """Fills the derived columns of rows stored before they existed"""
+        rows = conn.execute(self._all_items % table).fetchall()
+        conn.executemany(
+            self._set_meta % table,
+            [job_meta(self.codec.loads(item)) + (_id,) for _id, item in rows],
+        )
 
     def __len__(self):
         with self._get_conn() as conn:
@@ -52,7 +481,7 @@ class SqliteQueue(object):
     def __iter__(self):
         with self._get_conn() as conn:
             for id, obj_buffer in conn.execute(self._iterate):
-                yield loads(str(obj_buffer))
+                yield self.codec.loads(obj_buffer)
 
     def _get_conn(self):
         _id = get_ident()
@@ -60,75 +489,258 @@ class SqliteQueue(object):
             self._connection_cache[_id] = sqlite3.Connection(self.path, timeout=60)
         return self._connection_cache[_id]
 
-    def append(self, obj):
-        obj_buffer = memoryview(dumps(obj, 2))
+    def append(self, obj, priority=PRIORITY_NORMAL, delay=0):
+        """Queues `obj`, not to be taken before `delay` seconds if given"""
+        now = time()
         with self._get_conn() as conn:
-            conn.execute(self._append, (obj_buffer,))
+            conn.execute(self._append, self._pack(obj) + (priority, now + delay, now))
+        self._wakeup.notify()
 
-    def append_bad(self, obj):
-        obj_buffer = memoryview(dumps(obj, 2))
+    def append_many(self, objs, priority=PRIORITY_NORMAL):
+        """Queues all the given objects in a single transaction"""
+        now = time()
+        rows = [self._pack(obj) + (priority, now, now) for obj in objs]
+        if not rows:
+            return
         with self._get_conn() as conn:
-            conn.execute(self._append_bad, (obj_buffer,))
+            conn.executemany(self._append, rows)
+        self._wakeup.notify()
+
+    def append_bad(self, obj, priority=PRIORITY_NORMAL, error=None):
+        with self._get_conn() as conn:
+            conn.execute(self._append_bad, self._pack(obj) + (priority, time(), error))
 
     def get_bad_jobs(self, limit=20):
         with self._get_conn() as conn:
-            return [loads(obj_buffer[0]) for obj_buffer in conn.execute(self._bad_jobs, [limit])]
+            return [
+                self.codec.loads(obj_buffer[0])
+                for obj_buffer in conn.execute(self._bad_jobs, [limit])
+            ]
 
     def get_bad_jobs_raw(self):
         with self._get_conn() as conn:
             return [
-                (obj_buffer[0], loads(obj_buffer[1]))
+                (obj_buffer[0], self.codec.loads(obj_buffer[1]))
                 for obj_buffer in conn.execute(self._bad_jobs_raw)
             ]
 
+    def _purge_bad_where(self, where, params):
+        with self._get_conn() as conn:
+            conn.execute(self._abandon_branches % {"where": where}, params + params)
+            purged = conn.execute(self._purge_bad % where, params).rowcount
+        self._wakeup.notify()
+        return purged
+
     def purge_bad_job(self, item_id):
+        self._purge_bad_where("id = ?", [item_id])
+
+    def purge_bad_key(self, key):
+        """Removes the bad jobs with the given job key. Returns how many"""
+        return self._purge_bad_where("key = ?", [key])
+
+    def _rows(self, query, params):
         with self._get_conn() as conn:
-            conn.execute(self._purge_bad, [item_id])
+            cursor = conn.cursor()
+            cursor.row_factory = dict_factory
+            return cursor.execute(query, params).fetchall()
 
-    def purge_all_bad(self):
+    def list_jobs(self, limit=20):
+        """
+        Queued jobs in processing order, as dicts with their metadata columns
+        (key, type, step, attempt, filename, error...). Payloads aren't read.
+        """
+        return self._rows(self._list, [limit])
+
+    def list_bad_jobs(self, limit=20):
+        """Like `list_jobs` for bad jobs, newest first"""
+        return self._rows(self._list_bad, [limit])
+
+    def count_by(self, column, bad=False):
+        """Number of queued (or bad) jobs per type, step or stage, as a dict"""
+        if column not in self._countable:
+            raise ValueError("Cannot count jobs by %s" % column)
+        table = "bad_jobs" if bad else "queue"
         with self._get_conn() as conn:
-            conn.execute(self._drop_bad)
+            return dict(conn.execute(self._count_by % {"column": column, "table": table}))
+
+    def purge_all_bad(self):
+        self._purge_bad_where("1", [])
 
     def total_bad_jobs(self):
         with self._get_conn() as conn:
             return conn.execute(self._count_bad).fetchone()[0]
 
-    def popleft(self, sleep_wait=True):
-        keep_pooling = True
+    def _take(self, sleep_wait, size=1, worker=None, lease_time=None, stages=None):
+        """
+        Waits for the next available items, up to `size`, and either deletes
+        them or, if a worker is given, leases them to that worker. Items whose
+        lease expired are available again, their worker is assumed dead.
+        If `stages` is given only items at those stages are considered.
+        Returns a list of (item_id, obj).
+        """
+        if sleep_wait:
+            self._wakeup.listen()
+        where, params = "", []
+        if stages:
+            params = list(stages)
+            where = " AND stage IN (%s)" % ",".join("?" * len(params))
         wait = 0.1
         max_wait = 2
         tries = 0
         with self._get_conn() as conn:
-            _id = None
-            while keep_pooling:
+            while True:
                 conn.execute(self._write_lock)
-                cursor = conn.execute(self._popleft_get)
-                try:
-                    _id, obj_buffer = next(cursor)
-                    keep_pooling = False
-                except StopIteration:
-                    conn.commit()  # unlock the database
-                    if not sleep_wait:
-                        keep_pooling = False
-                        continue
+                now = time()
+                query = self._popleft_get % where
+                rows = conn.execute(query, [now, now] + params + [size]).fetchall()
+                if rows:
+                    break
+                conn.commit()  # unlock the database
+                if not sleep_wait:
+                    return []
+                if self._wakeup.enabled:
+                    timeout = self.POLL_FALLBACK
+                else:
                     tries += 1
-                    sleep(wait)
+                    timeout = wait
                     wait = min(max_wait, tries / 10 + wait)
-            if _id:
-                conn.execute(self._popleft_del, (_id,))
-                return loads(obj_buffer)
-        return None
+                # Don't oversleep a delayed item that becomes due meanwhile
+                due = conn.execute(self._next_due % where, [now] + params).fetchone()[0]
+                if due is not None:
+                    timeout = min(timeout, due - now)
+                self._wakeup.wait(timeout)
+            for _id, obj_buffer, owner in rows:
+                if owner:
+                    log.warning("Reclaiming queue item %s, lease of %s expired" % (_id, owner))
+            if worker:
+                lease = (worker, now + lease_time)
+                conn.executemany(self._claim, [lease + (row[0],) for row in rows])
+            else:
+                conn.executemany(self._popleft_del, [(row[0],) for row in rows])
+            return [(_id, self.codec.loads(obj_buffer)) for _id, obj_buffer, owner in rows]
+
+    def popleft(self, sleep_wait=True):
+        taken = self._take(sleep_wait)
+        return taken[0][1] if taken else None
+
+    def pop_many(self, size, sleep_wait=True):
+        """
+        Removes and returns up to `size` items in a single transaction. Waits
+        for at least one unless `sleep_wait` is False.
+        """
+        return [obj for _id, obj in self._take(sleep_wait, size)]
+
+    def claim(self, worker, lease_time=None, sleep_wait=True, stages=None):
+        """
+        Leases the next item to `worker` instead of removing it. The item stays
+        in the queue until acked, so it is not lost if the worker dies; it
+        becomes available again once the lease expires.
+        Only items at the given `stages` are claimed, if any given.
+        Returns (item_id, obj), or (None, None) if the queue is empty and not
+        waiting.
+        """
+        taken = self._take(sleep_wait, 1, worker, lease_time or self.LEASE_TIME, stages)
+        return taken[0] if taken else (None, None)
+
+    def claim_many(self, worker, size, lease_time=None, sleep_wait=True, stages=None):
+        """Like `claim` for up to `size` items. Returns a list of (item_id, obj)"""
+        return self._take(sleep_wait, size, worker, lease_time or self.LEASE_TIME, stages)
+
+    def heartbeat(self, item_id, worker, lease_time=None):
+        """
+        Extends the lease of a claimed item. Returns False if the worker does
+        not own the item anymore.
+        """
+        lease_expires = time() + (lease_time or self.LEASE_TIME)
+        with self._get_conn() as conn:
+            return conn.execute(self._heartbeat, (lease_expires, item_id, worker)).rowcount == 1
+
+    def ack(self, item_id, worker):
+        """
+        Removes a claimed item once processed. Jobs with a next step use
+        `advance` instead. Returns False if the lease was lost to another
+        worker meanwhile.
+        """
+        with self._get_conn() as conn:
+            joined = conn.execute(self._join, (item_id, worker)).rowcount == 1
+            owned = conn.execute(self._ack, (item_id, worker)).rowcount == 1
+        if owned and joined:
+            self._wakeup.notify()
+        return owned
+
+    def fork(self, item_id, worker, obj, branches):
+        """
+        Splits a claimed item into `branches`, items processed independently
+        (and concurrently) of each other, each with its own attempts. The item
+        itself is updated to `obj` and waits until every branch is acked;
+        branches that end up in bad jobs hold it until retried or purged.
+        Returns False if the lease was lost.
+        """
+        with self._get_conn() as conn:
+            rows = [self._pack(branch) + (item_id, worker) for branch in branches]
+            conn.executemany(self._fork_branch, rows)
+            params = self._pack(obj) + (len(branches), item_id, worker)
+            owned = conn.execute(self._fork, params).rowcount == 1
+        if owned:
+            self._wakeup.notify()
+        return owned
+
+    def advance(self, item_id, worker, obj):
+        """
+        Moves a claimed item on to its next step in place: the row is updated
+        instead of queued again at the tail, so multi step jobs keep their
+        place in line. The lease is released so the next step goes to whichever
+        worker handles its stage. Returns False if the lease was lost.
+        """
+        return self.release(item_id, worker, obj)
+
+    def bury(self, item_id, worker, obj, error=None):
+        """Moves a claimed item to bad jobs, recording the `error` that failed it"""
+        with self._get_conn() as conn:
+            conn.execute(self._bury, self._pack(obj) + (error, item_id, worker))
+            owned = conn.execute(self._ack, (item_id, worker)).rowcount == 1
+        return owned
+
+    def retry(self, item_id, worker, obj, delay, error=None):
+        """
+        Gives a claimed item back to be retried after `delay` seconds, keeping
+        its place in line. `obj` replaces the stored item and `error` is
+        recorded as its last error.
+        """
+        return self.release(item_id, worker, obj, delay, error)
+
+    def release(self, item_id, worker, obj, delay=0, error=None):
+        """
+        Gives a claimed item back without processing it, keeping its place in
+        line. `obj` replaces the stored item.
+        """
+        with self._get_conn() as conn:
+            params = self._pack(obj) + (time() + delay, error, item_id, worker)
+            owned = conn.execute(self._release, params).rowcount == 1
+        if owned:
+            self._wakeup.notify()
+        return owned
 
     def peek(self, size=1):
         with self._get_conn() as conn:
             cursor = conn.execute(self._peek, [size])
             try:
                 for row in cursor:
-                    yield loads(row[0])
+                    yield self.codec.loads(row[0])
             except StopIteration:
                 return None
 
-    def retry_jobs(self):
+    def retry_jobs(self, rate=None):
+        """
+        Moves all bad jobs back to the queue. If a `rate` (jobs per second) is
+        given they are released gradually instead of all at once.
+        """
+        now = time()
         with self._get_conn() as conn:
-            conn.execute(self._retry)
-            conn.execute(self._drop_bad)
+            # Jobs buried while moving these wait for the next retry
+            conn.execute(self._write_lock)
+            ids = [row[0] for row in conn.execute(self._bad_ids)]
+            spacing = 1 / rate if rate else 0
+            conn.executemany(self._retry, [(now + n * spacing, _id) for n, _id in enumerate(ids)])
+            conn.executemany(self._drop_bad, [(_id,) for _id in ids])
+        self._wakeup.notify()
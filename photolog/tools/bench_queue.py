@@ -0,0 +1,258 @@
+"""
+Measures SqliteQueue throughput and latency, so changes to squeue.py can be
+compared between releases.
+
+Runs producer and consumer threads (or processes) against a throw away queue
+file, once per payload size, and reports append and dequeue throughput,
+dequeue latency percentiles and the time spent waiting for the database write
+lock as JSON.
+"""
+
+import os
+import sys
+import json
+import queue
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import multiprocessing
+from time import time, perf_counter
+from uuid import uuid4
+
+from photolog.squeue import SqliteQueue, PRIORITY_NORMAL
+from photolog.metrics import percentile
+
+# Lower priority than the jobs, so consumers only get it once all are taken
+STOP = {"type": "bench-stop"}
+STOP_PRIORITY = PRIORITY_NORMAL + 1
+_writes = ("BEGIN", "INSERT", "UPDATE", "DELETE")
+
+
+class TimedConnection(object):
+    """
+    Wraps a sqlite3 connection to add up the time spent in the statements
+    that acquire the write lock: an explicit BEGIN, or the first write of an
+    implicit transaction. Statements themselves are cheap next to waiting.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.lock_wait = 0.0
+
+    def _timed(self, method, sql, *args):
+        if self._conn.in_transaction or not sql.lstrip().upper().startswith(_writes):
+            return method(sql, *args)
+        started = perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            self.lock_wait += perf_counter() - started
+
+    def execute(self, sql, *args):
+        return self._timed(self._conn.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(self._conn.executemany, sql, *args)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class TimedQueue(SqliteQueue):
+    """SqliteQueue that keeps track of its write lock waits"""
+
+    def _get_conn(self):
+        conn = super()._get_conn()
+        if not isinstance(conn, TimedConnection):
+            conn = self._connection_cache[threading.get_ident()] = TimedConnection(conn)
+        return conn
+
+    @property
+    def lock_wait(self):
+        return sum(conn.lock_wait for conn in self._connection_cache.values())
+
+
+def produce(path, jobs, payload_size, batch):
+    q = TimedQueue(path)
+    padding = os.urandom(payload_size // 2).hex()  # Hex, so it doesn't compress
+    started = perf_counter()
+    for start in range(0, jobs, batch):
+        objs = [
+            {"type": "bench", "key": uuid4().hex, "data": padding, "sent": time()}
+            for _ in range(min(batch, jobs - start))
+        ]
+        if batch == 1:
+            q.append(objs[0])
+        else:
+            q.append_many(objs)
+    return {
+        "role": "producer",
+        "jobs": jobs,
+        "elapsed": perf_counter() - started,
+        "lock_wait": q.lock_wait,
+    }
+
+
+def consume(path, batch, mode):
+    q = TimedQueue(path)
+    worker = "bench-%s" % uuid4().hex[:8]
+    latencies = []
+    first = last = None
+    stopping = False
+    while not stopping:
+        if mode == "claim":
+            taken = q.claim_many(worker, batch)
+        else:
+            taken = [(None, obj) for obj in q.pop_many(batch)]
+        received = time()
+        stops = 0
+        for item_id, obj in taken:
+            if item_id is not None:
+                q.ack(item_id, worker)
+            if obj == STOP:
+                stops += 1
+            else:
+                latencies.append(received - obj["sent"])
+        if stops < len(taken):
+            first = first or received
+            last = received
+        if stops:
+            stopping = True
+            for _ in range(stops - 1):  # Took somebody else's stop too
+                q.append(STOP, STOP_PRIORITY)
+    return {
+        "role": "consumer",
+        "jobs": len(latencies),
+        "first": first,
+        "last": last,
+        "lock_wait": q.lock_wait,
+        "latencies": latencies,
+    }
+
+
+def _report(target, args, results):
+    results.put(target(*args))
+
+
+def run_scenario(path, options, payload_size):
+    if options.processes:
+        context = multiprocessing.get_context("spawn")
+        results, spawn = context.Queue(), context.Process
+    else:
+        results, spawn = queue.Queue(), threading.Thread
+    SqliteQueue(path)  # Create tables before anybody races for it
+    consumers = [
+        spawn(target=_report, args=(consume, (path, options.batch, options.mode), results))
+        for _ in range(options.consumers)
+    ]
+    producers = [
+        spawn(
+            target=_report,
+            args=(produce, (path, options.jobs, payload_size, options.batch), results),
+        )
+        for _ in range(options.producers)
+    ]
+    started = perf_counter()
+    for worker in consumers + producers:
+        worker.start()
+    for worker in producers:
+        worker.join()
+    SqliteQueue(path).append_many([STOP] * options.consumers, STOP_PRIORITY)
+    reports = [results.get() for _ in consumers + producers]
+    elapsed = perf_counter() - started
+    for worker in consumers:
+        worker.join()
+
+    produced = [r for r in reports if r["role"] == "producer"]
+    consumed = [r for r in reports if r["role"] == "consumer"]
+    total = sum(r["jobs"] for r in produced)
+    latencies = sorted(lat for r in consumed for lat in r["latencies"])
+    append_time = max(r["elapsed"] for r in produced)
+    # From the first job taken to the last one, by any consumer
+    received = [r for r in consumed if r["jobs"]]
+    dequeue_time = 0
+    if received:
+        dequeue_time = max(r["last"] for r in received) - min(r["first"] for r in received)
+    return {
+        "payload_size": payload_size,
+        "jobs": total,
+        "dequeued": len(latencies),
+        "elapsed": elapsed,
+        "append_per_sec": total / append_time if append_time else None,
+        "dequeue_per_sec": len(latencies) / dequeue_time if dequeue_time else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": latencies[-1] if latencies else None,
+        "producer_lock_wait": sum(r["lock_wait"] for r in produced),
+        "consumer_lock_wait": sum(r["lock_wait"] for r in consumed),
+    }
+
+
+def parse_sizes(sizes):
+    return [int(size) for size in sizes.split(",") if size.strip()]
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Photolog job queue")
+    parser.add_argument("--producers", type=int, default=1, help="Producers (default 1)")
+    parser.add_argument("--consumers", type=int, default=1, help="Consumers (default 1)")
+    parser.add_argument(
+        "--jobs", type=int, default=1000, help="Jobs queued by each producer (default 1000)"
+    )
+    parser.add_argument(
+        "--payload-sizes",
+        type=str,
+        default="200,2000,20000",
+        help="Comma separated payload sizes in bytes, one run each (default 200,2000,20000)",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=1,
+        help="Use append_many/pop_many with this batch size (default 1: append/popleft)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["popleft", "claim"],
+        default="popleft",
+        help="Dequeue by removing items, or by claiming and acking them as workers do",
+    )
+    parser.add_argument(
+        "--processes", action="store_true", help="Run producers and consumers as processes"
+    )
+    parser.add_argument("--output", type=str, help="File to write the JSON results to")
+    options = parser.parse_args(argv)
+
+    results = []
+    for payload_size in parse_sizes(options.payload_sizes):
+        workdir = tempfile.mkdtemp(prefix="photolog-bench-")
+        try:
+            path = os.path.join(workdir, "queue.db")
+            results.append(run_scenario(path, options, payload_size))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "options": {key: value for key, value in vars(options).items() if key not in ("output",)},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as fh:
+            fh.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return report
@@ -0,0 +1,122 @@
+"""
+Compares thumbnail generation with JPEG draft (DCT scaled) decoding against
+the full size decode, so DRAFT_MARGIN can be chosen with numbers.
+
+For each image and draft margin, thumbnails are generated a few times and
+the median time is reported, together with the PSNR of every size against
+the ones from the full decode, as JSON. Without images a synthetic one is
+used, real photos give more meaningful quality figures.
+"""
+
+import os
+import sys
+import json
+import math
+import shutil
+import argparse
+import platform
+import tempfile
+from statistics import median
+from time import perf_counter
+
+import PIL
+from PIL import Image, ImageChops, ImageStat
+
+from photolog.services.api.base import generate_thumbnails, THUMBNAILS
+
+FULL = "full"
+
+
+def psnr(reference, other):
+    """Peak signal to noise ratio in dB between two same sized images"""
+    diff = ImageChops.difference(reference.convert("RGB"), other.convert("RGB"))
+    pixels = diff.size[0] * diff.size[1]
+    mse = sum(ImageStat.Stat(diff).sum2) / (pixels * 3)
+    if not mse:
+        return None  # Identical
+    return 10 * math.log10(255**2 / mse)
+
+
+def synthetic_image(path, size):
+    """Detailed and smooth areas, closer to a photo than plain noise"""
+    detail = Image.effect_mandelbrot(size, (-2.2, -1.4, 0.8, 1.4), 200)
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 24)
+    Image.merge("RGB", (detail, gradient, noise)).save(path, format="JPEG", quality=92)
+    return path
+
+
+def parse_margins(margins):
+    return [None if m.strip() == FULL else float(m) for m in margins.split(",") if m.strip()]
+
+
+def bench_image(path, margins, repeat):
+    workdir = tempfile.mkdtemp(prefix="photolog-thumbs-")
+    try:
+        outputs = {}
+        results = []
+        for margin in [None] + [m for m in margins if m is not None]:
+            times = []
+            for n in range(repeat):
+                folder = os.path.join(workdir, "%s-%s" % (margin or FULL, n))
+                os.makedirs(folder)
+                started = perf_counter()
+                thumbs = generate_thumbnails(path, folder, margin=margin)
+                times.append(perf_counter() - started)
+            outputs[margin] = {name: Image.open(thumbs[name]) for name in THUMBNAILS}
+            results.append({"margin": margin or FULL, "seconds": median(times)})
+
+        full_time = results[0]["seconds"]
+        for result, margin in zip(results, outputs):
+            result["speedup"] = full_time / result["seconds"]
+            result["psnr"] = {
+                name: psnr(outputs[None][name], outputs[margin][name]) for name in THUMBNAILS
+            }
+        with Image.open(path) as image:
+            size = image.size
+        return {"image": path, "size": size, "results": results}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Photolog thumbnail decoding")
+    parser.add_argument("images", nargs="*", help="JPEG files to use (default a synthetic one)")
+    parser.add_argument(
+        "--margins",
+        type=str,
+        default="2,1",
+        help="Comma separated draft margins to compare with the full decode (default 2,1)",
+    )
+    parser.add_argument(
+        "--size", type=str, default="6000x4000", help="Synthetic image size (default 6000x4000)"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per margin (default 3)")
+    parser.add_argument("--output", type=str, help="File to write the JSON results to")
+    options = parser.parse_args(argv)
+
+    margins = parse_margins(options.margins)
+    workdir = tempfile.mkdtemp(prefix="photolog-bench-")
+    try:
+        images = options.images
+        if not images:
+            size = tuple(int(n) for n in options.size.split("x"))
+            images = [synthetic_image(os.path.join(workdir, "synthetic.jpg"), size)]
+        results = [bench_image(path, margins, options.repeat) for path in images]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "thumbnails": THUMBNAILS,
+        "images": results,
+    }
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as fh:
+            fh.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return report
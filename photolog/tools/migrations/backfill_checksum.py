@@ -9,7 +9,7 @@ other environments.
 import os
 from os.path import join
 from photolog.db import DB
-from photolog.services.api.base import file_checksum
+from photolog.checksum import checksum_many
 
 
 BASE_PATH = os.environ["BASE_PATH"]
@@ -21,6 +21,7 @@ def migrate(conn):
 
     total_ok, total_bad = 0, 0
     updates = []
+    pictures, candidates = [], []
     for picture in conn.execute("SELECT * FROM pictures"):
         local_path = join(
             BASE_PATH,
@@ -28,19 +29,17 @@ def migrate(conn):
             "%s%s" % (picture["month"], picture["day"]),
         )
         name = picture["name"]
-
         tries = [join(local_path, name), join(local_path, name.upper())]
-        found, found_file, checksum = True, None, None
-        for file in tries:
-            try:
-                checksum = file_checksum(file)
-                found_file = file
-                break
-            except FileNotFoundError:
-                pass
-            found = False
-
-        if found:
+        found_file = next((file for file in tries if os.path.isfile(file)), None)
+        pictures.append((picture, local_path, found_file))
+        if found_file:
+            candidates.append(found_file)
+
+    # Hash all the files at once, spread over processes
+    checksums = dict(checksum_many(candidates))
+    for picture, local_path, found_file in pictures:
+        checksum = checksums.get(found_file)
+        if checksum:
             total_ok += 1
             print("Checksum for: %s: %s" % (found_file, checksum))
             updates.append((picture["id"], checksum))
@@ -0,0 +1,44 @@
+"""
+Prints how long each job step and sub step takes, from the timings the queue
+workers record, as a table or as JSON.
+"""
+
+import sys
+import json
+import argparse
+from time import time
+
+from photolog import settings_file
+from photolog.settings import Settings
+from photolog.metrics import MetricsDB
+
+ROW = (
+    "%(job_type)-10s %(step)-16s %(substep)-16s %(count)6s %(errors)6s %(deferred)8s"
+    " %(wall_p50)8.2f %(wall_p95)8.2f %(wall_max)8.2f %(cpu_p50)8.2f %(cpu_p95)8.2f %(bytes)14s"
+)
+# Same columns, numbers as their names
+HEADER = ROW.replace(".2f", "s")
+
+
+def format_table(steps):
+    if not steps:
+        return "No step timings recorded"
+    header = HEADER % {name: name for name in steps[0]}
+    return "\n".join([header] + [ROW % step for step in steps])
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Show the time spent in each job step")
+    parser.add_argument("--hours", type=float, default=24, help="Look back (default 24 hours)")
+    parser.add_argument("--type", type=str, help="Only jobs of this type: image, video or raw")
+    parser.add_argument("--json", action="store_true", help="Print JSON instead of a table")
+    parser.add_argument("--db", type=str, help="Database file (default DB_FILE from SETTINGS)")
+    options = parser.parse_args(argv)
+
+    path = options.db or Settings.load(settings_file).DB_FILE
+    steps = MetricsDB(path).summary(time() - options.hours * 3600, options.type)
+    if options.json:
+        sys.stdout.write(json.dumps(steps, indent=2) + "\n")
+    else:
+        sys.stdout.write(format_table(steps) + "\n")
+    return steps
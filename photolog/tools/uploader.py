@@ -5,7 +5,7 @@ import argparse
 from time import time
 from hashlib import md5
 from urllib.parse import urljoin
-from photolog.services.api.base import file_checksum
+from photolog.checksum import file_checksum, checksum_many
 from photolog import (
     cli_logger as log,
     ALLOWED_FILES,
@@ -16,6 +16,10 @@ from photolog import (
 
 BATCH_SIZE = 1999  # Max Gphotos album is 2000
 UPLOAD_ATTEMPTS = 3
+# Photos are sent several per request, the API queues them in one go. Below
+# the API's 64MB request limit; videos and bigger files go one by one.
+GROUP_FILES = 20
+GROUP_BYTES = 48 * 1024 * 1024
 
 MIME_TYPES = {
     "jpg": "image/jpeg",
@@ -64,17 +68,18 @@ def start_batch(endpoint, secret):
     return batch_id
 
 
-def verify_exists(host, full_filepath, secret) -> bool:
+def verify_exists(host, full_filepath, secret, checksum=None) -> bool:
     """
     If this returns True means the file has already been uploaded.
     We do this by the API call. It will return 204 if it exists, otherwise 404
     :param host: Host of the API endpoint
     :param full_filepath: File to check
     :param secret: API secret
+    :param checksum: MD5 of the file if already known
     :return: bool
     """
     verification = urljoin(host, "/photos/verify/")
-    checksum = file_checksum(full_filepath)
+    checksum = checksum or file_checksum(full_filepath)
     filename = os.path.basename(full_filepath)
     response = requests.get(
         verification,
@@ -111,73 +116,34 @@ def find_metadata_file(full_filename):
     assert False
 
 
-def handle_file(host, full_file, secret, tags, skip, halt, target_date):
+def uploaded(response, full_files):
     """
-    :param host: Host to upload data to
-    :param full_file: Full file path in local machine
-    :param secret: API secret
-    :param tags: Tags to use for file
-    :param skip: Steps for job to skip
-    :param halt: If True, will wait for user input to resume after attempts
-    :return: Returns if the file was uploaded or not
+    Tells if the API queued the uploaded files, it answers 202. Logs why
+    otherwise, the files would be missing silently.
     """
+    if response.status_code == 202:
+        return True
+    log.error(
+        "Upload of %s failed with %s: %s"
+        % (", ".join(full_files), response.status_code, response.text[:500])
+    )
+    return False
+
 
+def with_retries(host, halt, call):
+    """
+    Returns what `call` returns, retrying it on connection errors. With
+    `halt`, waits for user input to resume after the attempts.
+    """
     answer = "Y"
     while answer == "Y":
         attempt = 1
         while attempt < UPLOAD_ATTEMPTS:
             try:
-                validate_file(full_file)
-                file_exists = verify_exists(host, full_file, secret)
-                endpoint = urljoin(host, "/photos/")
-                if file_exists:
-                    log.info("File %s already uploaded" % full_file)
-                    return False
-                else:
-                    post_data = {
-                        "tags": tags,
-                        "skip": skip,
-                        # 'batch_id': None,
-                        # 'is_last': False,  # n == total_files
-                    }
-                    photo_fh = open(full_file, "rb")
-                    metadata_fh = None
-                    files = {
-                        "photo_file": (
-                            os.path.basename(full_file),
-                            photo_fh,
-                            get_mime_type(full_file),
-                        )
-                    }
-                    if target_date:
-                        post_data["target_date"] = target_date
-                    else:
-                        metadata_file = find_metadata_file(full_file)
-                        if metadata_file:
-                            metadata_fh = open(metadata_file, "rb")
-                            files["metadata_file"] = (
-                                os.path.basename(metadata_file),
-                                metadata_fh,
-                                get_mime_type(metadata_file),
-                            )
-
-                    response = requests.post(
-                        endpoint,
-                        data=post_data,
-                        files=files,
-                        headers={"X-PHOTOLOG-SECRET": secret},
-                    )
-                    photo_fh.close()
-                    if metadata_fh:
-                        metadata_fh.close()
-                    return response.status_code == 201
+                return call()
             except requests.ConnectionError:
                 attempt += 1
                 log.warning("Attempt %s. Failed to connect. Retrying" % attempt)
-            except OSError:
-                log.warning("Invalid file: %s - Skipping" % full_file)
-                return False
-
         if halt:
             answer = input("Problem connecting, Continue? [Y, n]") or "Y"
         else:
@@ -185,7 +151,136 @@ def handle_file(host, full_file, secret, tags, skip, halt, target_date):
     raise requests.ConnectionError("Could not connect to %s" % host)
 
 
-def upload_directories(targets, filelist, host, secret, tags, skip, halt, target_date):
+def handle_file(host, full_file, secret, tags, skip, halt, target_date, checksum=None):
+    """
+    :param host: Host to upload data to
+    :param full_file: Full file path in local machine
+    :param secret: API secret
+    :param tags: Tags to use for file
+    :param skip: Steps for job to skip
+    :param halt: If True, will wait for user input to resume after attempts
+    :param checksum: MD5 of the file if already known
+    :return: Returns if the file was uploaded or not
+    """
+
+    def upload():
+        try:
+            validate_file(full_file)
+            file_exists = verify_exists(host, full_file, secret, checksum)
+            endpoint = urljoin(host, "/photos/")
+            if file_exists:
+                log.info("File %s already uploaded" % full_file)
+                return False
+            else:
+                post_data = {
+                    "tags": tags,
+                    "skip": skip,
+                    # 'batch_id': None,
+                    # 'is_last': False,  # n == total_files
+                }
+                photo_fh = open(full_file, "rb")
+                metadata_fh = None
+                files = {
+                    "photo_file": (
+                        os.path.basename(full_file),
+                        photo_fh,
+                        get_mime_type(full_file),
+                    )
+                }
+                if target_date:
+                    post_data["target_date"] = target_date
+                else:
+                    metadata_file = find_metadata_file(full_file)
+                    if metadata_file:
+                        metadata_fh = open(metadata_file, "rb")
+                        files["metadata_file"] = (
+                            os.path.basename(metadata_file),
+                            metadata_fh,
+                            get_mime_type(metadata_file),
+                        )
+
+                response = requests.post(
+                    endpoint,
+                    data=post_data,
+                    files=files,
+                    headers={"X-PHOTOLOG-SECRET": secret},
+                )
+                photo_fh.close()
+                if metadata_fh:
+                    metadata_fh.close()
+                return uploaded(response, [full_file])
+        except requests.ConnectionError:
+            raise  # Retried
+        except OSError:
+            log.warning("Invalid file: %s - Skipping" % full_file)
+            return False
+
+    return with_retries(host, halt, upload)
+
+
+def handle_files(host, full_files, secret, tags, skip, halt, target_date, checksums=None):
+    """
+    Uploads several photos in a single request, leaving out the invalid ones
+    and those already uploaded. Files that need a metadata file (videos) must
+    go through `handle_file`.
+    :param checksums: MD5 of each file, if already known
+    :return: How many files were uploaded
+    """
+    checksums = checksums or [None] * len(full_files)
+    to_send = []
+    for full_file, checksum in zip(full_files, checksums):
+        try:
+            validate_file(full_file)
+        except OSError:
+            log.warning("Invalid file: %s - Skipping" % full_file)
+            continue
+        if with_retries(host, halt, lambda: verify_exists(host, full_file, secret, checksum)):
+            log.info("File %s already uploaded" % full_file)
+        else:
+            to_send.append(full_file)
+    if not to_send:
+        return 0
+
+    post_data = {"tags": tags, "skip": skip}
+    if target_date:
+        post_data["target_date"] = target_date
+
+    def post():
+        handles = [open(full_file, "rb") for full_file in to_send]
+        try:
+            files = [
+                ("photo_file", (os.path.basename(full_file), fh, get_mime_type(full_file)))
+                for full_file, fh in zip(to_send, handles)
+            ]
+            return requests.post(
+                urljoin(host, "/photos/"),
+                data=post_data,
+                files=files,
+                headers={"X-PHOTOLOG-SECRET": secret},
+            )
+        finally:
+            for fh in handles:
+                fh.close()
+
+    response = with_retries(host, halt, post)
+    return len(to_send) if uploaded(response, to_send) else 0
+
+
+def group_size(full_file):
+    """Size of the file if it can be sent along others, otherwise None"""
+    ext = os.path.splitext(full_file)[1].lstrip(".").lower()
+    try:
+        size = os.path.getsize(full_file)
+    except OSError:
+        return None  # handle_file reports it
+    if ext in VIDEO_FILES or size >= GROUP_BYTES:
+        return None
+    return size
+
+
+def upload_directories(
+    targets, filelist, host, secret, tags, skip, halt, target_date, hash_workers=None
+):
     start = time()
     first_batch, second_batch, third_batch = [], [], []
     for target in targets:
@@ -231,19 +326,51 @@ def upload_directories(targets, filelist, host, secret, tags, skip, halt, target
     n, skipped = 1, 0
     total_files = len(first_batch) + len(second_batch) + len(third_batch)
     log.info("Found %s files" % total_files)
+
+    def send(group):
+        nonlocal n, skipped
+        full_files = [full_file for full_file, checksum in group]
+        last = n + len(group) - 1
+        log.info("Uploading %s [%s-%s/%s]" % (", ".join(full_files), n, last, total_files))
+        file_start = time()
+        if len(group) == 1:
+            full_file, checksum = group[0]
+            uploaded = handle_file(
+                host, full_file, secret, tags, skip, halt, target_date, checksum=checksum
+            )
+            uploaded = 1 if uploaded else 0
+        else:
+            checksums = [checksum for full_file, checksum in group]
+            uploaded = handle_files(
+                host, full_files, secret, tags, skip, halt, target_date, checksums
+            )
+        skipped += len(group) - uploaded
+        pct = 100 * last / total_files
+        log.info("Done in %0.2fs [%0.1f%%]" % (time() - file_start, pct))
+        n = last + 1
+
     for batch in chunks(
         sorted(first_batch) + sorted(second_batch) + sorted(third_batch),
         BATCH_SIZE,
     ):
         # batch_id = start_batch(endpoint, secret)
-        for file, full_file in batch:
-            log.info("Uploading %s [%s/%s]" % (full_file, n, total_files))
-            file_start = time()
-            uploaded = handle_file(host, full_file, secret, tags, skip, halt, target_date)
-            skipped += 1 if not uploaded else 0
-            pct = 100 * n / total_files
-            log.info("Done in %0.2fs [%0.1f%%]" % (time() - file_start, pct))
-            n += 1
+        # Files are hashed ahead in other processes while the previous ones upload
+        checksums = checksum_many([full_file for file, full_file in batch], hash_workers)
+        group, group_bytes = [], 0
+        for (file, full_file), (_, checksum) in zip(batch, checksums):
+            size = group_size(full_file)
+            if group and (
+                size is None or len(group) == GROUP_FILES or group_bytes + size > GROUP_BYTES
+            ):
+                send(group)
+                group, group_bytes = [], 0
+            if size is None:
+                send([(full_file, checksum)])
+            else:
+                group.append((full_file, checksum))
+                group_bytes += size
+        if group:
+            send(group)
     elapsed = time() - start
     log.info("Skipped files: %s" % skipped)
     log.info("Uploaded %s files in %.2fs" % (total_files, elapsed))
@@ -272,6 +399,9 @@ def run():
     parser.add_argument("--host", metavar="H", nargs="?", type=str, help="Host to upload")
     parser.add_argument("--skip", nargs="?", type=str, help="steps to skip")
     parser.add_argument("--target_date", nargs="?", type=str, help="Media date")
+    parser.add_argument(
+        "--hash_workers", type=int, help="Processes hashing files ahead of the upload"
+    )
     parsed = parser.parse_args()
     directories = [os.path.realpath(d) for d in (parsed.directories or [])]
     halt = config.get("halt", False)
@@ -281,7 +411,9 @@ def run():
     skip = parsed.skip or ""
     target_date = parsed.target_date or None
     filelist = read_filelist(parsed.filelist)
-    upload_directories(directories, filelist, host, secret, tags, skip, halt, target_date)
+    upload_directories(
+        directories, filelist, host, secret, tags, skip, halt, target_date, parsed.hash_workers
+    )
 
 
 if __name__ == "__main__":
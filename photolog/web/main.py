@@ -25,8 +25,9 @@ from flask_wtf.csrf import CSRFProtect
 
 from photolog import web_logger as log, settings_file
 from photolog.db import DB
+from photolog.metrics import MetricsDB
 from photolog.settings import Settings
-from photolog.squeue import SqliteQueue
+from photolog.squeue import SqliteQueue, PRIORITY_HIGH
 from photolog.services.api import base
 from photolog.services.web import main as web_service
 
@@ -36,6 +37,7 @@ INDIEAUTH_ENDPOINT = "https://indieauth.com/auth"
 settings = Settings.load(settings_file)
 db = DB(settings.DB_FILE)
 queue = SqliteQueue(settings.DB_FILE)
+metrics = MetricsDB(settings.DB_FILE)
 app = Flask(__name__)
 app.secret_key = settings.SECRET_KEY
 
@@ -212,7 +214,8 @@ def mass_tag():
                     "keys": keys,
                     "tags": new_tags,
                     "attempt": 0,
-                }
+                },
+                priority=PRIORITY_HIGH,
             )
         return redirect("/")
 
@@ -256,7 +259,8 @@ def edit_dates():
                     "key": uuid.uuid4().hex,
                     "changes": changes,
                     "attempt": 0,
-                }
+                },
+                priority=PRIORITY_HIGH,
             )
         return redirect("/edit/dates/")
 
@@ -283,7 +287,8 @@ def change_date():
                 "origin": origin,
                 "target": target,
                 "attempt": 0,
-            }
+            },
+            priority=PRIORITY_HIGH,
         )
         return redirect(url_for("view_day", year=target.year, month=target.month, day=target.day))
 
@@ -421,30 +426,38 @@ def tag_day(year, month, day):
 @app.route("/jobs/")
 @login_required
 def view_queue():
-    result = queue.peek(500)
+    result = queue.list_jobs(500)
     size = len(queue)
-    return render_template("jobs.html", jobs=result, size=size)
+    stages = queue.count_by("stage")
+    return render_template("jobs.html", jobs=result, size=size, stages=stages)
+
+
+@app.route("/jobs/metrics/")
+@login_required
+def view_metrics():
+    hours = request.args.get("hours", 24, type=int)
+    job_type = request.args.get("type") or None
+    since = (datetime.now() - timedelta(hours=hours)).timestamp()
+    steps = metrics.summary(since, job_type)
+    for step in steps:
+        step["size"] = web_service.human_size(step["bytes"]) if step["bytes"] else ""
+    return render_template("metrics.html", steps=steps, hours=hours, job_type=job_type)
 
 
 @app.route("/jobs/bad/", methods=["POST"])
 @login_required
 def retry_jobs():
-    queue.retry_jobs()
+    queue.retry_jobs(settings.QUEUE_RETRY_RATE)
     return redirect("/jobs/")
 
 
 @app.route("/jobs/bad/", methods=["GET"])
 @login_required
 def bad_jobs():
-    result = queue.get_bad_jobs()
+    result = queue.list_bad_jobs()
     total_jobs = queue.total_bad_jobs()
-    return render_template(
-        "bad_jobs.html",
-        bad_jobs=[
-            (job, json.dumps(job, indent=2, default=web_service.serial_job)) for job in result
-        ],
-        total_jobs=total_jobs,
-    )
+    types = queue.count_by("type", bad=True)
+    return render_template("bad_jobs.html", bad_jobs=result, total_jobs=total_jobs, types=types)
 
 
 @app.route("/jobs/bad/purge/", methods=["GET"])
@@ -463,11 +476,7 @@ def purge_all():
 @app.route("/jobs/bad/purge/", methods=["POST"])
 @login_required
 def purge_bad_job():
-    key = request.form["job_key"]
-    for bj in queue.get_bad_jobs_raw():
-        if bj[1]["key"] == key:
-            queue.purge_bad_job(bj[0])
-            break
+    queue.purge_bad_key(request.form["job_key"])
     return redirect("/jobs/bad/")
 
 
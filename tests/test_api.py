@@ -1,3 +1,5 @@
+import os
+import binascii
 from hashlib import md5
 from io import BytesIO
 
@@ -5,7 +7,7 @@ import pytest
 from unittest.mock import patch
 
 from photolog.api.main import app, queue, db as api_db
-from tests.conftest import TEST_API_SECRET
+from tests.conftest import TEST_API_SECRET, TEST_FILES
 
 VALID_HASH = md5(TEST_API_SECRET.encode("utf-8")).hexdigest()
 
@@ -227,3 +229,59 @@ def test_add_photo_duplicate_always_queued(client):
             headers={"X-PHOTOLOG-SECRET": VALID_HASH},
         )
         assert response.status_code == 202
+
+
+def test_add_photo_multiple_files(client):
+    data = {
+        "photo_file": [
+            (BytesIO(b"fake image one"), "multi1.jpg"),
+            (BytesIO(b"fake image two"), "multi2.jpg"),
+        ],
+        "tags": "tag1",
+    }
+    response = client.post(
+        "/photos/",
+        data=data,
+        content_type="multipart/form-data",
+        headers={"X-PHOTOLOG-SECRET": VALID_HASH},
+    )
+    assert response.status_code == 202
+    queued = queue.pop_many(10, sleep_wait=False)
+    assert [job["original_filename"] for job in queued] == ["multi1.jpg", "multi2.jpg"]
+    assert all(job["tags"] == ["tag1"] for job in queued)
+
+
+def test_add_photo_multiple_files_with_metadata(client):
+    data = {
+        "photo_file": [
+            (BytesIO(b"fake image one"), "multi3.jpg"),
+            (BytesIO(b"fake image two"), "multi4.jpg"),
+        ],
+        "metadata_file": (BytesIO(b"meta"), "multi.THM"),
+    }
+    response = client.post(
+        "/photos/",
+        data=data,
+        content_type="multipart/form-data",
+        headers={"X-PHOTOLOG-SECRET": VALID_HASH},
+    )
+    assert response.status_code == 400
+    assert len(queue) == 0
+
+
+def test_add_photo_is_saved_in_one_pass_with_its_checksum(client):
+    content = b"fake image data to hash" * 1000
+    with patch("photolog.services.api.main.CHUNK_SIZE", 1000):
+        response = client.post(
+            "/photos/",
+            data={"photo_file": (BytesIO(content), "hashed.jpg"), "tags": "tag1"},
+            content_type="multipart/form-data",
+            headers={"X-PHOTOLOG-SECRET": VALID_HASH},
+        )
+    assert response.status_code == 202
+    (job,) = queue.pop_many(10, sleep_wait=False)
+    assert job["data"]["checksum"] == md5(content).hexdigest()
+    assert job["filename"] == "hashed-%08X.jpg" % (binascii.crc32(content) & 0xFFFFFFFF)
+    with open(os.path.join(TEST_FILES, job["filename"]), "rb") as fh:
+        assert fh.read() == content
+    assert not [f for f in os.listdir(TEST_FILES) if f.startswith(".upload-")]
@@ -0,0 +1,48 @@
+import os
+from hashlib import md5
+from unittest.mock import patch
+
+from photolog import checksum
+from photolog.checksum import file_checksum, checksum_many
+
+
+def _write(path, content):
+    with open(path, "wb") as fh:
+        fh.write(content)
+    return str(path)
+
+
+def test_file_checksum_buffered(tmp_path):
+    content = os.urandom(3 * 1024 + 17)
+    path = _write(tmp_path / "small.bin", content)
+    assert file_checksum(path, buffer_size=1024) == md5(content).hexdigest()
+
+
+def test_file_checksum_memory_mapped(tmp_path):
+    content = os.urandom(256 * 1024)
+    path = _write(tmp_path / "big.bin", content)
+    with patch.object(checksum, "MMAP_THRESHOLD", 1024):
+        assert file_checksum(path) == md5(content).hexdigest()
+
+
+def test_file_checksum_empty_file(tmp_path):
+    path = _write(tmp_path / "empty.bin", b"")
+    assert file_checksum(path) == md5(b"").hexdigest()
+
+
+def test_checksum_many_in_processes_keeps_order(tmp_path):
+    contents = [os.urandom(1024 * n) for n in range(1, 6)]
+    paths = [_write(tmp_path / ("%s.bin" % n), c) for n, c in enumerate(contents)]
+    missing = str(tmp_path / "missing.bin")
+
+    result = list(checksum_many(paths + [missing], workers=2))
+
+    expected = [(p, md5(c).hexdigest()) for p, c in zip(paths, contents)]
+    assert result == expected + [(missing, None)]
+
+
+def test_checksum_many_inline_with_one_worker(tmp_path):
+    path = _write(tmp_path / "one.bin", b"photolog")
+    with patch.object(checksum, "ProcessPoolExecutor") as pool:
+        assert list(checksum_many([path], workers=4)) == [(path, md5(b"photolog").hexdigest())]
+    pool.assert_not_called()
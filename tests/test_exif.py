@@ -0,0 +1,32 @@
+from datetime import datetime
+from unittest.mock import patch
+
+import piexif
+from PIL import Image
+
+from photolog.services.api.base import read_exif
+
+
+def test_read_exif_reads_the_file_once(tmp_path):
+    path = str(tmp_path / "exif.jpg")
+    exif = piexif.dump(
+        {
+            "0th": {
+                piexif.ImageIFD.Make: b"Sony",
+                piexif.ImageIFD.Model: b"A7",
+                piexif.ImageIFD.Orientation: 6,
+            },
+            "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2019:03:04 10:11:12"},
+        }
+    )
+    Image.new("RGB", (640, 480)).save(path, format="JPEG", exif=exif)
+
+    with patch("builtins.open", wraps=open) as opened:
+        data = read_exif(path, datetime(2020, 1, 1), True)
+    assert opened.call_count == 1
+    assert (data["year"], data["month"], data["day"]) == (2019, 3, 4)
+    assert data["timestamp"] == "2019:03:04 10:11:12"
+    assert data["camera"] == "Sony A7"
+    assert data["orientation"] == "Rotated 90 CW"
+    assert (data["width"], data["height"]) == (640, 480)
+    assert data["exif_read"]
@@ -1,6 +1,7 @@
 from datetime import datetime
+from unittest.mock import patch
 
-from photolog.queue.jobs import prepare_job
+from photolog.queue.jobs import prepare_job, retry_delay, split_branches, ImageJob, TagDayJob
 from tests.conftest import make_db
 
 
@@ -178,3 +179,78 @@ def test_edit_picture_dates():
     assert pictures["3"]["year"] == 2015
     assert pictures["3"]["month"] == 12
     assert pictures["3"]["day"] == 25
+
+
+def test_retry_delay_backs_off_exponentially():
+    job = {"type": "tag-day", "key": "x", "attempt": 0}
+    delays = []
+    for attempt in range(4):
+        job["attempt"] = attempt
+        delays.append(retry_delay(job))
+    for attempt, delay in enumerate(delays):
+        full = TagDayJob.retry_base * 2**attempt
+        assert full / 2 <= delay <= full
+
+
+def test_retry_delay_depends_on_job_type():
+    upload = {"type": "upload", "filename": "a.jpg", "key": "x", "attempt": 20}
+    assert ImageJob.retry_cap / 2 <= retry_delay(upload) <= ImageJob.retry_cap
+    unknown = {"type": "unknown", "key": "x", "attempt": 0}
+    assert retry_delay(unknown) <= 5
+
+
+class UploadSettings:
+    UPLOAD_FOLDER = "/tmp"
+
+
+def _image_job(**kwargs):
+    job = {
+        "type": "upload",
+        "key": "k",
+        "filename": "a.jpg",
+        "original_filename": "a.jpg",
+        "step": "upload_and_store",
+        "data": {},
+        "attempt": 0,
+        "skip": [],
+    }
+    job.update(kwargs)
+    return job
+
+
+def test_image_job_forks_remote_uploads():
+    job = ImageJob(_image_job(), make_db("test_job_steps.db"), UploadSettings)
+    with patch.object(ImageJob, "local_process", return_value=job.data):
+        next_job = job.process()
+    parent, branches = split_branches(next_job)
+    assert parent["step"] == "finish"
+    assert "branches" not in parent
+    assert [(b["step"], b["branch"]) for b in branches] == [
+        ("flickr", "flickr"),
+        ("gphotos", "gphotos"),
+    ]
+
+
+def test_skipped_branches_are_not_forked():
+    job = ImageJob(_image_job(skip=["flickr"]), make_db("test_job_steps.db"), UploadSettings)
+    with patch.object(ImageJob, "local_process", return_value=job.data):
+        assert job.process()["branches"] == ["gphotos"]
+    job = ImageJob(
+        _image_job(skip=["flickr", "gphotos"]), make_db("test_job_steps.db"), UploadSettings
+    )
+    with patch.object(ImageJob, "local_process", return_value=job.data):
+        next_job = job.process()
+    assert next_job["step"] == "finish"
+    assert "branches" not in next_job
+
+
+def test_branch_ends_after_its_step():
+    job = ImageJob(
+        _image_job(step="flickr", branch="flickr"), make_db("test_job_steps.db"), UploadSettings
+    )
+    with patch.object(ImageJob, "flickr_upload", return_value=job.data):
+        assert job.process() is None
+    # Jobs queued before the uploads ran in parallel go on in sequence
+    job = ImageJob(_image_job(step="flickr"), make_db("test_job_steps.db"), UploadSettings)
+    with patch.object(ImageJob, "flickr_upload", return_value=job.data):
+        assert job.process()["step"] == "gphotos"
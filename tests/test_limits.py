@@ -0,0 +1,88 @@
+import os
+from time import sleep
+from unittest.mock import patch, Mock
+
+import pytest
+
+from photolog.limits import ServiceLimits, ServiceUnavailable, Throttled, ServiceError
+from photolog.services import gphotos
+from tests.conftest import TEST_FILES
+
+
+def make_limits(name, **kwargs):
+    return ServiceLimits(os.path.join(TEST_FILES, name), **kwargs)
+
+
+def test_token_bucket_limits_calls():
+    limits = make_limits("test_limits_bucket.db", rates={"flickr": (10, 2)})
+    assert limits.acquire("flickr") == 0
+    assert limits.acquire("flickr") == 0
+    wait = limits.acquire("flickr")
+    assert 0 < wait <= 0.1
+    sleep(wait)
+    assert limits.acquire("flickr") == 0
+    # Services without a rate aren't limited
+    assert all(limits.acquire("s3") == 0 for _ in range(10))
+
+
+def test_limits_are_shared_between_processes():
+    path = "test_limits_shared.db"
+    make_limits(path, rates={"gphotos": (0.01, 1)}).acquire("gphotos")
+    assert make_limits(path, rates={"gphotos": (0.01, 1)}).acquire("gphotos") > 0
+
+
+def test_circuit_opens_after_failures_and_probes_once():
+    limits = make_limits("test_limits_breaker.db", max_failures=2, cooldown=0.2)
+    limits.failure("s3")
+    assert limits.acquire("s3") == 0
+    limits.failure("s3")
+    assert limits.acquire("s3") > 0
+    sleep(0.2)
+    # Half open, only one call goes through
+    assert limits.acquire("s3") == 0
+    assert limits.acquire("s3") > 0
+    limits.failure("s3")
+    assert limits.status("s3")["cooldown"] == 0.4
+    sleep(0.4)
+    assert limits.acquire("s3") == 0
+    limits.success("s3")
+    assert limits.acquire("s3") == 0
+    assert limits.status("s3")["failures"] == 0
+
+
+def test_guard_defers_throttled_service():
+    limits = make_limits("test_limits_guard.db")
+    with pytest.raises(Throttled):
+        with limits.guard("gphotos"):
+            raise Throttled("gphotos", 30)
+    with pytest.raises(ServiceUnavailable) as err:
+        with limits.guard("gphotos"):
+            pytest.fail("Throttled service was called")
+    assert 29 < err.value.delay <= 30
+    # Other services keep working
+    with limits.guard("flickr"):
+        pass
+
+
+def test_gphotos_throttling_raises_instead_of_sleeping():
+    response = Mock(status_code=429, headers={"Retry-After": "12"}, text="RESOURCE_EXHAUSTED")
+    session = Mock(post=Mock(return_value=response))
+    with patch("photolog.services.gphotos.get_session", return_value=session):
+        with pytest.raises(Throttled) as err:
+            gphotos.do_upload(b"bytes", {"Authorization": "Bearer x"})
+    assert err.value.delay == 12
+    assert session.post.call_count == 1
+
+
+def test_guard_only_counts_service_errors():
+    limits = make_limits("test_limits_local_errors.db", max_failures=1, cooldown=60)
+    with pytest.raises(FileNotFoundError):
+        with limits.guard("s3"):
+            open(os.path.join(TEST_FILES, "missing-thumb.jpg"), "rb")
+    assert limits.status("s3")["failures"] == 0
+    assert limits.acquire("s3") == 0
+
+    with pytest.raises(ServiceError):
+        with limits.guard("s3"):
+            raise ServiceError("500 Internal Server Error")
+    assert limits.acquire("s3") > 0
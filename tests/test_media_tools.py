@@ -0,0 +1,80 @@
+import os
+import sys
+import fcntl
+from time import time
+from unittest.mock import patch
+
+import pytest
+
+from photolog import media_tools
+from photolog.limits import ServiceUnavailable
+from photolog.media_tools import MediaTools, MediaToolError, MediaToolTimeout
+from photolog.settings import Settings
+
+
+def _python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_run_captures_output(tmp_path):
+    tools = MediaTools(str(tmp_path))
+    proc = tools.run(_python("import sys; print('out'); print('err', file=sys.stderr)"))
+    assert proc.stdout.strip() == b"out"
+    assert proc.stderr.strip() == b"err"
+
+
+def test_run_with_low_priority(tmp_path):
+    tools = MediaTools(str(tmp_path), nice=5)
+    before = os.nice(0)
+    proc = tools.run(_python("import os; print(os.nice(0))"))
+    assert int(proc.stdout) == min(19, before + 5)
+    assert os.nice(0) == before  # Only the tool is niced
+
+
+def test_run_failure_keeps_stderr(tmp_path):
+    tools = MediaTools(str(tmp_path), nice=0)
+    with pytest.raises(MediaToolError) as err:
+        tools.run(_python("import sys; sys.exit('Invalid data found')"))
+    assert err.value.returncode == 1
+    assert b"Invalid data found" in err.value.stderr
+    assert "Invalid data found" in str(err.value)
+
+
+def test_run_timeout_kills_the_tool(tmp_path):
+    tools = MediaTools(str(tmp_path), timeout=0.5, nice=0)
+    started = time()
+    with pytest.raises(MediaToolTimeout):
+        tools.run(_python("import time; time.sleep(30)"))
+    assert time() - started < 5
+
+
+def test_run_releases_its_slot(tmp_path):
+    tools = MediaTools(str(tmp_path), concurrency=1, nice=0)
+    with pytest.raises(MediaToolError):
+        tools.run(_python("import sys; sys.exit(1)"))
+    assert tools.run(_python("print(1)")).stdout.strip() == b"1"
+
+
+def test_run_defers_when_all_slots_are_busy(tmp_path):
+    tools = MediaTools(str(tmp_path), concurrency=1, nice=0)
+    # Another process, or thread, holding the only slot
+    fd = os.open(os.path.join(str(tmp_path), "slot-0.lock"), os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        with patch.object(media_tools, "SLOT_WAIT", 0.2), patch("subprocess.run") as run:
+            with pytest.raises(ServiceUnavailable) as err:
+                tools.run(_python("print(1)"))
+        run.assert_not_called()
+        assert err.value.service == media_tools.SERVICE
+    finally:
+        os.close(fd)
+
+
+def test_get_media_tools_defaults_from_settings(tmp_path):
+    class PartialSettings(object):
+        MEDIA_TOOLS_LOCK_DIR = str(tmp_path)
+        MEDIA_TOOLS_TIMEOUT = 5
+
+    tools = media_tools.get_media_tools(PartialSettings())
+    assert tools.timeout == 5
+    assert tools.concurrency == Settings.MEDIA_TOOLS_CONCURRENCY
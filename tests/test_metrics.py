@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from photolog.limits import Throttled
+from photolog.metrics import MetricsDB, measure, OK, ERROR, DEFERRED
+from tests.conftest import TEST_FILES
+
+
+def make_metrics(name, **kwargs):
+    return MetricsDB(os.path.join(TEST_FILES, name), **kwargs)
+
+
+def test_measure_records_outcome():
+    measures = []
+    with measure(measures, "upload", "flickr") as current:
+        current.bytes += 10
+    with pytest.raises(ValueError):
+        with measure(measures, "upload", "local_process", "thumbs"):
+            raise ValueError("Broken image")
+    with pytest.raises(Throttled):
+        with measure(measures, "upload", "gphotos"):
+            raise Throttled("gphotos", 60)
+    assert [m.outcome for m in measures] == [OK, ERROR, DEFERRED]
+    assert measures[0].bytes == 10
+    assert all(m.wall >= 0 and m.cpu >= 0 for m in measures)
+
+
+def test_only_the_latest_rows_are_kept():
+    metrics = make_metrics("test_metrics_ring.db", max_rows=5)
+    for n in range(3):
+        measures = []
+        for _ in range(3):
+            with measure(measures, "upload", "step%s" % n):
+                pass
+        metrics.record(measures)
+    summary = metrics.summary()
+    assert [(s["step"], s["count"]) for s in summary] == [("step1", 2), ("step2", 3)]
+
+
+def test_summary_percentiles_per_step():
+    metrics = make_metrics("test_metrics_summary.db")
+    measures = []
+    for n in range(1, 21):
+        with measure(measures, "upload", "local_process", "thumbs") as current:
+            current.bytes = 100
+        current.wall = n / 10
+    with measure(measures, "video", "local_process", "thumbs"):
+        pass
+    metrics.record(measures)
+
+    (thumbs,) = metrics.summary(job_type="upload")
+    assert thumbs["count"] == 20
+    assert thumbs["wall_p50"] == 1.0
+    assert thumbs["wall_p95"] == 1.9
+    assert thumbs["wall_max"] == 2.0
+    assert thumbs["bytes"] == 2000
+    assert len(metrics.summary()) == 2
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+from time import sleep
+from unittest.mock import patch
+
+from photolog.queue.network import NetworkExecutor
+from photolog.queue.main import run_worker
+from tests.conftest import make_queue
+
+
+class FakeSettings:
+    DB_FILE = ":memory:"
+    QUEUE_LEASE_TIME = 300
+    SERVICE_CONCURRENCY = {"flickr": 2, "gphotos": 3}
+
+
+class Recorder(object):
+    """Stands for run_job, keeping track of how many jobs run at once"""
+
+    def __init__(self, duration=0.1):
+        self.duration = duration
+        self.running = {}
+        self.peak = {}
+        self.done = []
+        self._lock = threading.Lock()
+
+    def _count(self, stage, delta):
+        with self._lock:
+            self.running[stage] = self.running.get(stage, 0) + delta
+            total = sum(self.running.values())
+            self.peak[stage] = max(self.peak.get(stage, 0), self.running[stage])
+            self.peak["total"] = max(self.peak.get("total", 0), total)
+
+    def __call__(self, db, settings, queue, worker, item_id, job):
+        self._count(job["step"], 1)
+        sleep(self.duration)
+        self._count(job["step"], -1)
+        queue.ack(item_id, worker)
+        self.done.append(job["key"])
+
+
+def run_until(executor, condition):
+    async def main():
+        task = asyncio.ensure_future(executor.run())
+        while not condition():
+            await asyncio.sleep(0.02)
+        executor.stop()
+        await task
+
+    asyncio.run(main())
+
+
+def upload_job(key, step):
+    return {"type": "upload", "key": key, "filename": "a.jpg", "step": step, "attempt": 0}
+
+
+def test_runs_jobs_concurrently_within_service_limits():
+    queue = make_queue("test_network_limits_q.db")
+    for n in range(6):
+        queue.append(upload_job("f%s" % n, "flickr"))
+        queue.append(upload_job("g%s" % n, "gphotos"))
+    queue.append(upload_job("local", "upload_and_store"))
+    recorder = Recorder()
+    executor = NetworkExecutor(None, FakeSettings(), queue, concurrency=4)
+    with patch("photolog.queue.network.run_job", recorder):
+        run_until(executor, lambda: len(recorder.done) == 12)
+
+    assert recorder.peak["flickr"] == 2
+    assert 2 <= recorder.peak["gphotos"] <= 3
+    assert recorder.peak["total"] == 4
+    # Other stages are left for other workers
+    assert [job["key"] for job in queue.list_jobs()] == ["local"]
+
+
+def test_stopping_lets_running_jobs_finish():
+    queue = make_queue("test_network_stop_q.db")
+    for n in range(5):
+        queue.append(upload_job("g%s" % n, "gphotos"))
+    recorder = Recorder(duration=0.3)
+    executor = NetworkExecutor(None, FakeSettings(), queue, concurrency=8)
+    with patch("photolog.queue.network.run_job", recorder):
+        run_until(executor, lambda: recorder.running.get("gphotos"))
+
+    assert len(recorder.done) == 3
+    assert len(queue) == 2
+    # Nothing is left leased
+    assert len(queue.claim_many("other", 5, sleep_wait=False)) == 2
+
+
+def test_executor_stops_once_memory_budget_is_used_up():
+    queue = make_queue("test_network_budget_q.db")
+    for n in range(6):
+        queue.append(upload_job("f%s" % n, "flickr"))
+    settings = FakeSettings()
+    settings.WORKER_MAX_JOBS = 2
+    recorder = Recorder(duration=0.05)
+    executor = NetworkExecutor(None, settings, queue, concurrency=1)
+    with patch("photolog.queue.network.run_job", recorder):
+        asyncio.run(executor.run())
+
+    assert len(recorder.done) == 2
+    assert len(queue) == 4
+
+
+def test_worker_without_stages_runs_every_stage_one_at_a_time():
+    with (
+        patch("photolog.queue.main.Settings.load", return_value=FakeSettings()),
+        patch("photolog.queue.main.DB"),
+        patch("photolog.queue.main.SqliteQueue"),
+        patch("photolog.queue.main.daemon") as daemon,
+        patch("photolog.queue.network.NetworkExecutor.run") as executor,
+    ):
+        run_worker("settings.conf", None, concurrency=4)
+        daemon.assert_called_once()
+        assert daemon.call_args.args[3] is None
+        executor.assert_not_called()
+
+        run_worker("settings.conf", ["flickr", "gphotos"], concurrency=4)
+        executor.assert_called_once()
@@ -0,0 +1,110 @@
+import os
+import threading
+from time import sleep, time
+from unittest.mock import MagicMock, patch
+
+from photolog.squeue import SqliteQueue
+from photolog.queue.main import daemon
+from photolog.queue.pool import Supervisor
+from photolog.queue.memory import MemoryBudget, rss, peak_rss, reset_peak
+from photolog.settings import Settings
+
+
+class FastSupervisor(Supervisor):
+    MIN_UPTIME = 0  # Restart crashed workers right away
+    STOP_TIMEOUT = 10
+
+
+def crash_once(directory):
+    """First worker crashes, the rest run until told to stop"""
+    path = os.path.join(directory, str(os.getpid()))
+    open(path, "w").close()
+    if len(os.listdir(directory)) == 1:
+        raise RuntimeError("Crash")
+    try:
+        while True:
+            sleep(0.05)
+    except SystemExit:
+        with open(path, "w") as fh:
+            fh.write("released")
+        raise
+
+
+def stop_when(supervisor, condition, timeout=20):
+    def check():
+        deadline = time() + timeout
+        while not condition() and time() < deadline:
+            sleep(0.05)
+        supervisor.stop()
+
+    thread = threading.Thread(target=check)
+    thread.start()
+    return thread
+
+
+def test_supervisor_restarts_crashed_worker_and_stops_gracefully(tmp_path):
+    directory = str(tmp_path)
+    supervisor = FastSupervisor(crash_once, (directory,), size=1)
+    checker = stop_when(supervisor, lambda: len(os.listdir(directory)) == 2)
+    supervisor.run()
+    checker.join()
+
+    contents = []
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name)) as fh:
+            contents.append(fh.read())
+    # The crashed worker was replaced, and the replacement was interrupted
+    # instead of killed.
+    assert sorted(contents) == ["", "released"]
+
+
+def test_daemon_stops_when_interrupted_while_waiting():
+    queue = MagicMock()
+    queue.claim.side_effect = SystemExit
+    settings = MagicMock(QUEUE_LEASE_TIME=300)
+    daemon(None, settings, queue)
+    queue.release.assert_not_called()
+
+
+def test_memory_budget_limits():
+    budget = MemoryBudget(max_jobs=2)
+    budget.start_job()
+    budget.finish_job("a")
+    assert budget.exceeded() is None
+    budget.finish_job("b")
+    assert budget.exceeded() == "ran 2 jobs"
+    assert not MemoryBudget().enabled
+    # Any running Python is over a megabyte
+    assert MemoryBudget(max_rss_mb=1).exceeded().startswith("RSS of")
+
+
+def test_peak_memory_is_measured_per_job():
+    assert rss() > 0
+    reset_peak()
+    ballast = b"x" * (64 * 1024 * 1024)  # Touches every page
+    peak = peak_rss()
+    del ballast
+    assert peak >= 64 * 1024 * 1024
+
+
+def test_daemon_is_recycled_after_max_jobs(tmp_path):
+    queue = SqliteQueue(str(tmp_path / "queue.db"))
+    for n in range(3):
+        queue.append({"type": "tag-day", "key": "k%s" % n, "attempt": 0})
+    settings = MagicMock(QUEUE_LEASE_TIME=300, WORKER_MAX_JOBS=2, WORKER_MAX_RSS_MB=0)
+
+    def ack(db, settings, queue, worker, item_id, job):
+        queue.ack(item_id, worker)
+
+    with patch("photolog.queue.main.run_job", ack):
+        daemon(None, settings, queue)
+    assert [job["key"] for job in queue.list_jobs()] == ["k2"]
+
+
+def test_memory_budget_defaults_from_settings():
+    class PartialSettings(object):
+        WORKER_MAX_JOBS = 10
+
+    budget = MemoryBudget.from_settings(PartialSettings())
+    assert budget.max_jobs == 10
+    assert budget.max_rss == Settings.WORKER_MAX_RSS_MB * 1024 * 1024
@@ -4,10 +4,17 @@ Integration tests for the job queue pipeline.
 External services (S3, Flickr, GPhotos) are mocked; the real DB and queue are used.
 """
 
+import os
 from datetime import datetime
+from time import sleep
 from unittest.mock import patch
 
-from photolog.queue.jobs import prepare_job
+from PIL import Image
+
+from photolog.queue.jobs import prepare_job, split_branches
+from photolog.queue.main import run_job
+from photolog.limits import Throttled
+from photolog.metrics import MetricsDB
 from tests.conftest import make_db, make_queue, TEST_FILES
 
 
@@ -27,6 +34,16 @@ FAKE_EXIF = {
     "mime": "video/mp4",
 }
 
+FAKE_PROBE = {
+    "container": "mov,mp4,m4a,3gp,3g2,mj2",
+    "codecs": ["h264", "aac"],
+    "duration": 12.5,
+    "width": 800,
+    "height": 600,
+    "rotation": 0,
+    "creation_time": None,
+}
+
 FAKE_THUMBS = {
     "original": "/tmp/fake-orig.jpg",
     "thumb": "/tmp/fake-thumb.jpg",
@@ -77,6 +94,10 @@ def _run_to_completion(job_data, db, settings):
     job = job_data
     while job:
         job = prepare_job(job, db, settings).process()
+        if job and job.get("branches"):
+            job, branches = split_branches(job)
+            for branch in branches:
+                _run_to_completion(branch, db, settings)
 
 
 # ---------------------------------------------------------------------------
@@ -183,6 +204,7 @@ def test_video_job_full_pipeline():
             return_value=(FAKE_THUMBS, "/tmp/fake_caps/"),
         ),
         patch("photolog.services.api.base.video_exif", return_value=FAKE_EXIF),
+        patch("photolog.services.api.base.probe_video", return_value=FAKE_PROBE),
         patch("photolog.services.s3.upload_thumbs", return_value=FAKE_S3_URLS),
         patch(
             "photolog.services.s3.upload_video",
@@ -397,3 +419,296 @@ def test_retry_jobs_requeues_bad_job_for_processing():
     assert len(queue) == 1
     requeued = queue.popleft(sleep_wait=False)
     assert requeued["key"] == "requeue_key"
+
+
+def test_run_job_retries_and_buries_claimed_job():
+    db = make_db("test_run_job_retry.db")
+    queue = make_queue("test_run_job_retry_q.db")
+    settings = FakeSettings()
+    settings.MAX_QUEUE_ATTEMPTS = 1
+
+    queue.append(_make_upload_job("leasekey", "nonexistent3.jpg"))
+    with patch("photolog.queue.main.retry_delay", return_value=0):
+        for attempt in range(2):
+            item_id, job = queue.claim("worker-1", sleep_wait=False)
+            assert job["attempt"] == attempt
+            run_job(db, settings, queue, "worker-1", item_id, job)
+            assert len(queue) == 1
+        item_id, job = queue.claim("worker-1", sleep_wait=False)
+        run_job(db, settings, queue, "worker-1", item_id, job)
+
+    assert len(queue) == 0
+    assert queue.get_bad_jobs()[0]["key"] == "leasekey"
+    assert queue.list_bad_jobs()[0]["error"].startswith("FileNotFoundError")
+
+
+def test_job_of_dead_worker_is_processed_by_another():
+    db = make_db("test_dead_worker.db")
+    queue = make_queue("test_dead_worker_q.db")
+    settings = FakeSettings()
+    queue.append(
+        {
+            "type": "tag-day",
+            "key": "tagjob",
+            "year": 2020,
+            "month": 1,
+            "day": 1,
+            "tags": ["x"],
+            "attempt": 0,
+        }
+    )
+    # First worker claims the job and dies without acking it
+    queue.claim("dead-worker", lease_time=0.1, sleep_wait=False)
+    sleep(0.2)
+
+    item_id, job = queue.claim("worker-2", sleep_wait=False)
+    assert job["key"] == "tagjob"
+    run_job(db, settings, queue, "worker-2", item_id, job)
+    assert len(queue) == 0
+    assert queue.total_bad_jobs() == 0
+
+
+def test_upload_jobs_finish_before_next_upload_starts():
+    db = make_db("test_in_place_steps.db")
+    queue = make_queue("test_in_place_steps_q.db")
+    settings = FakeSettings()
+    queue.append(_make_upload_job("first", "first.jpg"))
+    queue.append(_make_upload_job("second", "second.jpg"))
+
+    processed = []
+    with (
+        patch("photolog.services.api.base.read_exif", return_value=FAKE_EXIF),
+        patch("photolog.services.api.base.generate_thumbnails", return_value=FAKE_THUMBS),
+        patch("photolog.services.s3.upload_thumbs", return_value=FAKE_S3_URLS),
+        patch("photolog.services.api.base.file_checksum", return_value="abc"),
+        patch("photolog.services.api.base.delete_file"),
+        patch("photolog.services.flickr.upload", return_value=("url", "1")),
+        patch("photolog.services.gphotos.upload_photo", return_value={}),
+    ):
+        while True:
+            item_id, job = queue.claim("worker-1", sleep_wait=False)
+            if job is None:
+                break
+            processed.append((job["key"], job["step"]))
+            run_job(db, settings, queue, "worker-1", item_id, job)
+
+    steps = ["upload_and_store", "flickr", "gphotos", "finish"]
+    assert processed == [("first", s) for s in steps] + [("second", s) for s in steps]
+
+
+def test_failed_job_is_retried_with_backoff():
+    db = make_db("test_retry_backoff.db")
+    queue = make_queue("test_retry_backoff_q.db")
+    settings = FakeSettings()
+    queue.append(_make_upload_job("backoffkey", "nonexistent4.jpg"))
+
+    item_id, job = queue.claim("worker-1", sleep_wait=False)
+    with patch("photolog.queue.main.retry_delay", return_value=0.3):
+        run_job(db, settings, queue, "worker-1", item_id, job)
+    # Not available until the delay passes
+    assert queue.claim("worker-1", sleep_wait=False) == (None, None)
+    sleep(0.3)
+    item_id, job = queue.claim("worker-1", sleep_wait=False)
+    assert job["key"] == "backoffkey"
+    assert job["attempt"] == 1
+
+
+def test_failed_branch_does_not_redo_the_other_one():
+    db = make_db("test_branches.db")
+    queue = make_queue("test_branches_q.db")
+    settings = FakeSettings()
+    queue.append(_make_upload_job("branchy", "branchy.jpg"))
+
+    flickr_results = [ValueError("Flickr is down"), ("url", "1")]
+    with (
+        patch("photolog.services.api.base.read_exif", return_value=FAKE_EXIF),
+        patch("photolog.services.api.base.generate_thumbnails", return_value=FAKE_THUMBS),
+        patch("photolog.services.s3.upload_thumbs", return_value=FAKE_S3_URLS),
+        patch("photolog.services.api.base.file_checksum", return_value="abc"),
+        patch("photolog.services.api.base.delete_file") as delete_file,
+        patch("photolog.services.flickr.upload", side_effect=flickr_results),
+        patch("photolog.services.gphotos.upload_photo", return_value={}) as gphotos,
+        patch("photolog.queue.main.retry_delay", return_value=0),
+    ):
+        item_id, job = queue.claim("worker-1", sleep_wait=False)
+        run_job(db, settings, queue, "worker-1", item_id, job)
+        # Both uploads are available at once, the job waits for them
+        branches = queue.claim_many("worker-1", 5, sleep_wait=False)
+        assert sorted(job["step"] for _, job in branches) == ["flickr", "gphotos"]
+        for branch_id, branch in branches:
+            run_job(db, settings, queue, "worker-1", branch_id, branch)
+        assert delete_file.call_count == 0
+
+        # Only the failed Flickr upload is retried
+        item_id, job = queue.claim("worker-1", sleep_wait=False)
+        assert (job["step"], job["attempt"]) == ("flickr", 1)
+        run_job(db, settings, queue, "worker-1", item_id, job)
+        item_id, job = queue.claim("worker-1", sleep_wait=False)
+        assert job["step"] == "finish"
+        run_job(db, settings, queue, "worker-1", item_id, job)
+
+    assert gphotos.call_count == 1
+    assert delete_file.call_count == 1
+    assert len(queue) == 0
+
+
+def test_retry_resumes_local_process_at_failed_substep():
+    db = make_db("test_substeps.db")
+    queue = make_queue("test_substeps_q.db")
+    settings = FakeSettings()
+    queue.append(_make_upload_job("resume", "resume.jpg"))
+
+    with (
+        patch("photolog.services.api.base.read_exif", return_value=FAKE_EXIF),
+        patch("photolog.services.api.base.generate_thumbnails", return_value=FAKE_THUMBS) as thumbs,
+        patch("photolog.services.s3.upload_thumbs", return_value=FAKE_S3_URLS) as upload,
+        patch("photolog.services.api.base.file_checksum", return_value="abc"),
+        patch(
+            "photolog.services.api.base.store_photo", side_effect=[IOError("locked"), None]
+        ) as store,
+        patch("photolog.queue.main.retry_delay", return_value=0),
+    ):
+        for _ in range(2):
+            item_id, job = queue.claim("worker-1", sleep_wait=False)
+            assert job["step"] == "upload_and_store"
+            run_job(db, settings, queue, "worker-1", item_id, job)
+
+    assert thumbs.call_count == 1
+    assert upload.call_count == 1
+    assert store.call_count == 2
+    item_id, job = queue.claim("worker-1", sleep_wait=False)
+    assert job["step"] in ("flickr", "gphotos")
+    assert "done" not in job["data"]
+
+
+def test_video_retry_does_not_upload_video_again():
+    db = make_db("test_video_substeps.db")
+    settings = FakeSettings()
+    job_data = _make_upload_job("vidresume", "resume.mp4")
+
+    with (
+        patch(
+            "photolog.services.api.base.get_video_thumbnail",
+            return_value=(FAKE_THUMBS, "/tmp/fake_caps/"),
+        ) as frames,
+        patch("photolog.services.api.base.video_exif", return_value=FAKE_EXIF),
+        patch("photolog.services.api.base.probe_video", return_value=FAKE_PROBE),
+        patch("photolog.services.s3.upload_thumbs", return_value=dict(FAKE_S3_URLS)),
+        patch(
+            "photolog.services.s3.upload_video", return_value="https://s3.example.com/v.mp4"
+        ) as upload_video,
+        patch("photolog.services.api.base.file_checksum", side_effect=[IOError("gone"), "c"]),
+    ):
+        try:
+            prepare_job(job_data, db, settings).process()
+        except IOError:
+            pass
+        job = prepare_job(job_data, db, settings).process()
+
+    assert frames.call_count == 1
+    assert frames.call_args.args[4] == FAKE_PROBE["duration"]
+    assert upload_video.call_count == 1
+    assert job["step"] == "gphotos"
+    assert db.pictures.by_key("vidresume")["format"] == "video"
+
+
+def test_throttled_service_defers_job_without_using_an_attempt():
+    db = make_db("test_throttled.db")
+    queue = make_queue("test_throttled_q.db")
+    settings = FakeSettings()
+    for key in ("first", "second"):
+        job = _make_upload_job(key, "%s.jpg" % key)
+        job.update(step="gphotos", data={"s3_urls": FAKE_S3_URLS})
+        queue.append(job)
+    queue.append(_make_upload_job("other", "other.jpg"))
+
+    with patch(
+        "photolog.services.gphotos.upload_photo", side_effect=Throttled("gphotos", 60)
+    ) as upload:
+        for _ in range(2):
+            item_id, job = queue.claim("worker-1", sleep_wait=False, stages=["gphotos"])
+            run_job(db, settings, queue, "worker-1", item_id, job)
+
+    # The second one was deferred without calling the service
+    assert upload.call_count == 1
+    assert queue.claim("worker-1", sleep_wait=False, stages=["gphotos"]) == (None, None)
+    jobs = {job["key"]: job for job in queue.list_jobs()}
+    assert jobs["first"]["attempt"] == jobs["second"]["attempt"] == 0
+    assert jobs["second"]["error"].startswith("gphotos unavailable")
+    # Other work keeps flowing
+    item_id, job = queue.claim("worker-1", sleep_wait=False)
+    assert job["key"] == "other"
+
+
+def test_step_and_substep_times_are_recorded():
+    db = make_db("test_step_metrics.db")
+    settings = FakeSettings()
+    job_data = _make_upload_job("timed", "timed.jpg")
+
+    with (
+        patch("photolog.services.api.base.read_exif", return_value=FAKE_EXIF),
+        patch("photolog.services.api.base.generate_thumbnails", return_value=FAKE_THUMBS),
+        patch("photolog.services.s3.upload_thumbs", return_value=FAKE_S3_URLS),
+        patch("photolog.services.api.base.file_checksum", side_effect=IOError("gone")),
+    ):
+        try:
+            prepare_job(job_data, db, settings).process()
+        except IOError:
+            pass
+
+    steps = {(s["step"], s["substep"]): s for s in MetricsDB(db.path).summary()}
+    assert list(steps) == [
+        ("upload_and_store", ""),
+        ("upload_and_store", "local_store"),
+        ("upload_and_store", "read_exif"),
+        ("upload_and_store", "s3_upload"),
+        ("upload_and_store", "thumbs"),
+    ]
+    assert steps[("upload_and_store", "")]["errors"] == 1
+    assert {s["job_type"] for s in steps.values()} == {"image"}
+    assert steps[("upload_and_store", "thumbs")]["errors"] == 0
+
+
+def test_image_job_streams_thumbnails_without_disk():
+    db = make_db("test_img_in_memory.db")
+    settings = FakeSettings()
+    settings.THUMBS_IN_MEMORY = True
+    settings.THUMBS_FOLDER = os.path.join(TEST_FILES, "no-thumbs")
+    filename = os.path.join(TEST_FILES, "streamed.jpg")
+    Image.new("RGB", (640, 480)).save(filename, format="JPEG")
+    job_data = _make_upload_job("streamed", "streamed.jpg")
+
+    with (
+        patch("photolog.services.api.base.read_exif", return_value=FAKE_EXIF),
+        patch("photolog.services.s3.upload_objects", return_value=FAKE_S3_URLS) as upload,
+        patch("photolog.services.api.base.file_checksum", return_value="abc"),
+        patch("photolog.services.flickr.upload", return_value=("url", "1")),
+        patch("photolog.services.gphotos.upload_photo", return_value={}),
+    ):
+        _run_to_completion(job_data, db, settings)
+
+    (_, objects, path), _ = upload.call_args
+    assert path == "2020/6"
+    assert objects["original"][1] == filename
+    assert all(isinstance(objects[size][1], bytes) for size in ("thumb", "medium", "large"))
+    assert not os.path.exists(settings.THUMBS_FOLDER)
+    assert not os.path.exists(filename)
+    assert db.pictures.by_key("streamed")["thumb"] == FAKE_S3_URLS["thumb"]
+
+
+def test_checksum_from_upload_is_not_computed_again():
+    db = make_db("test_payload_checksum.db")
+    settings = FakeSettings()
+    job_data = _make_upload_job("hashed", "hashed.jpg")
+    job_data["data"] = {"checksum": "from-upload"}
+
+    with (
+        patch("photolog.services.api.base.read_exif", return_value=FAKE_EXIF),
+        patch("photolog.services.api.base.generate_thumbnails", return_value=FAKE_THUMBS),
+        patch("photolog.services.s3.upload_thumbs", return_value=FAKE_S3_URLS),
+        patch("photolog.services.api.base.file_checksum") as file_checksum,
+    ):
+        prepare_job(job_data, db, settings).process()
+
+    file_checksum.assert_not_called()
+    assert db.pictures.by_key("hashed")["checksum"] == "from-upload"
@@ -1,6 +1,25 @@
+import os
+import json
+import errno
+import pickle
+import socket
+import sqlite3
+import threading
+from time import sleep, time
+from datetime import datetime
+from unittest.mock import patch
+
 import pytest
 
-from photolog.squeue import SqliteQueue
+from photolog.squeue import (
+    SqliteQueue,
+    Wakeup,
+    Heartbeat,
+    JsonCodec,
+    PickleCodec,
+    PRIORITY_HIGH,
+    job_stage,
+)
 
 
 @pytest.fixture
@@ -57,11 +76,9 @@ def test_peek_default_size_one(queue):
 
 
 def test_iter(queue):
-    # __iter__ currently has a bug: loads(str(obj_buffer)) should be loads(bytes(obj_buffer))
     queue.append({"job": "a"})
     queue.append({"job": "b"})
-    with pytest.raises(TypeError):
-        list(queue)
+    assert list(queue) == [{"job": "a"}, {"job": "b"}]
 
 
 def test_append_bad_and_total_bad_jobs(queue):
@@ -125,6 +142,47 @@ def test_retry_jobs_moves_bad_to_queue(queue):
     assert item == {"job": "retry_me"}
 
 
+def test_retry_jobs_keeps_jobs_buried_meanwhile(queue):
+    queue.append_bad({"job": "old"})
+    main = threading.get_ident()
+    get_conn = queue._get_conn
+    racer = threading.Thread(target=queue.append_bad, args=({"job": "new"},))
+
+    class RacingConn(object):
+        """Another worker buries a job right after the bad ids are read"""
+
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return self.conn.__exit__(*exc)
+
+        def execute(self, sql, *args):
+            cursor = self.conn.execute(sql, *args)
+            if sql == queue._bad_ids:
+                racer.start()
+                racer.join(0.3)
+            return cursor
+
+        def executemany(self, sql, rows):
+            return self.conn.executemany(sql, rows)
+
+    def racing_conn():
+        conn = get_conn()
+        return RacingConn(conn) if threading.get_ident() == main else conn
+
+    queue._get_conn = racing_conn
+    queue.retry_jobs()
+    racer.join()
+    del queue._get_conn
+
+    assert queue.popleft(sleep_wait=False) == {"job": "old"}
+    assert queue.total_bad_jobs() == 1
+
+
 def test_append_various_types(queue):
     queue.append("a string")
     queue.append(42)
@@ -133,3 +191,399 @@ def test_append_various_types(queue):
     assert queue.popleft(sleep_wait=False) == "a string"
     assert queue.popleft(sleep_wait=False) == 42
     assert queue.popleft(sleep_wait=False) == [1, 2, 3]
+
+
+def test_popleft_wakes_up_on_append(queue):
+    received = []
+    consumer = threading.Thread(target=lambda: received.append((queue.popleft(), time())))
+    consumer.start()
+    sleep(0.3)  # Let the consumer go idle
+    appended_at = time()
+    queue.append({"job": "wake"})
+    consumer.join(timeout=queue.POLL_FALLBACK)
+    item, received_at = received[0]
+    assert item == {"job": "wake"}
+    assert received_at - appended_at < 0.5
+
+
+def test_popleft_polls_without_wakeup(tmp_path):
+    queue = SqliteQueue(str(tmp_path / "polling.db"), wakeup=False)
+    received = []
+    consumer = threading.Thread(target=lambda: received.append(queue.popleft()))
+    consumer.start()
+    queue.append({"job": "polled"})
+    consumer.join(timeout=5)
+    assert received == [{"job": "polled"}]
+
+
+def test_wakeup_notify_removes_stale_listeners(tmp_path):
+    wakeup = Wakeup(str(tmp_path / "stale.db"))
+    os.makedirs(wakeup.dir, exist_ok=True)
+    stale = os.path.join(wakeup.dir, "stale-listener")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(stale)
+    sock.close()  # Socket file stays behind, nobody is reading
+    wakeup.notify()
+    assert not os.path.exists(stale)
+
+
+def test_append_succeeds_when_wakeup_is_denied(tmp_path):
+    queue = SqliteQueue(str(tmp_path / "denied.db"))
+    os.makedirs(queue._wakeup.dir, exist_ok=True)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    listener.bind(os.path.join(queue._wakeup.dir, "other-user"))
+    try:
+        denied = PermissionError(errno.EACCES, "Permission denied")
+        with patch.object(socket.socket, "sendto", side_effect=denied):
+            queue.append({"job": "queued"})
+    finally:
+        listener.close()
+    assert queue.popleft(sleep_wait=False) == {"job": "queued"}
+
+
+def test_claim_keeps_item_until_ack(queue):
+    queue.append({"job": "a"})
+    item_id, item = queue.claim("worker-1", sleep_wait=False)
+    assert item == {"job": "a"}
+    assert len(queue) == 1
+    # Claimed items are invisible to other workers
+    assert queue.claim("worker-2", sleep_wait=False) == (None, None)
+    assert queue.ack(item_id, "worker-1")
+    assert len(queue) == 0
+
+
+def test_expired_lease_is_reclaimed(queue):
+    queue.append({"job": "a"})
+    item_id, _ = queue.claim("dead-worker", lease_time=0.1, sleep_wait=False)
+    sleep(0.2)
+    reclaimed_id, item = queue.claim("worker-2", sleep_wait=False)
+    assert (reclaimed_id, item) == (item_id, {"job": "a"})
+    # The dead worker cannot ack nor advance what it doesn't own anymore
+    assert not queue.ack(item_id, "dead-worker")
+    assert not queue.advance(item_id, "dead-worker", {"job": "duplicate"})
+    assert not queue.heartbeat(item_id, "dead-worker")
+    assert len(queue) == 1
+
+
+def test_heartbeat_extends_lease(queue):
+    queue.append({"job": "a"})
+    item_id, _ = queue.claim("worker-1", lease_time=0.2, sleep_wait=False)
+    sleep(0.1)
+    assert queue.heartbeat(item_id, "worker-1", lease_time=1)
+    sleep(0.2)
+    assert queue.claim("worker-2", sleep_wait=False) == (None, None)
+
+
+def test_heartbeat_thread_keeps_lease(queue):
+    queue.append({"job": "a"})
+    item_id, _ = queue.claim("worker-1", lease_time=0.3, sleep_wait=False)
+    heartbeat = Heartbeat(queue, "worker-1", 0.3)
+    heartbeat.add(item_id)
+    sleep(0.5)
+    assert queue.claim("worker-2", sleep_wait=False) == (None, None)
+    heartbeat.stop()
+
+
+def test_release_keeps_place_in_line(queue):
+    queue.append({"job": "a"})
+    queue.append({"job": "b"})
+    item_id, item = queue.claim("worker-1", sleep_wait=False)
+    item["attempt"] = 1
+    assert queue.release(item_id, "worker-1", item)
+    assert queue.popleft(sleep_wait=False) == {"job": "a", "attempt": 1}
+
+
+def test_bury_moves_claimed_item_to_bad_jobs(queue):
+    queue.append({"job": "a"})
+    item_id, item = queue.claim("worker-1", sleep_wait=False)
+    assert queue.bury(item_id, "worker-1", item)
+    assert len(queue) == 0
+    assert queue.get_bad_jobs() == [{"job": "a"}]
+
+
+def test_upgrades_old_queue_table(tmp_path):
+    path = str(tmp_path / "old.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE queue (id INTEGER PRIMARY KEY AUTOINCREMENT, item BLOB)")
+    queue = SqliteQueue(path)
+    queue.append({"job": "a"})
+    item_id, item = queue.claim("worker-1", sleep_wait=False)
+    assert item == {"job": "a"}
+
+
+def test_append_many(queue):
+    queue.append_many({"job": i} for i in range(3))
+    assert len(queue) == 3
+    assert queue.popleft(sleep_wait=False) == {"job": 0}
+
+
+def test_append_many_empty(queue):
+    queue.append_many([])
+    assert len(queue) == 0
+
+
+def test_pop_many(queue):
+    queue.append_many({"job": i} for i in range(5))
+    assert queue.pop_many(3) == [{"job": 0}, {"job": 1}, {"job": 2}]
+    assert queue.pop_many(3) == [{"job": 3}, {"job": 4}]
+    assert queue.pop_many(3, sleep_wait=False) == []
+
+
+def test_claim_many(queue):
+    queue.append_many({"job": i} for i in range(3))
+    claimed = queue.claim_many("worker-1", 2, sleep_wait=False)
+    assert [item for _, item in claimed] == [{"job": 0}, {"job": 1}]
+    assert queue.claim("worker-2", sleep_wait=False)[1] == {"job": 2}
+    for item_id, _ in claimed:
+        assert queue.ack(item_id, "worker-1")
+    assert len(queue) == 1
+
+
+def test_job_payload_round_trip(queue):
+    job = {
+        "key": "abc",
+        "uploaded_at": datetime(2020, 6, 15, 12, 30, 1, 5),
+        "tags": {"travel", "family"},
+        "changes": [["1", datetime(1999, 12, 31)]],
+        "data": {"exif": {"width": 800, "timestamp": None}},
+    }
+    queue.append(job)
+    assert queue.popleft(sleep_wait=False) == job
+
+
+def test_json_codec_payload_is_inspectable():
+    codec = JsonCodec()
+    payload = codec.dumps({"key": "abc", "tags": {"x"}})
+    assert payload[:2] == b"J" + bytes([JsonCodec.VERSION])
+    assert json.loads(payload[2:]) == {"key": "abc", "tags": {"__set__": ["x"]}}
+
+
+def test_json_codec_compresses_large_payloads():
+    codec = JsonCodec(compress_over=100)
+    job = {"keys": ["%032x" % i for i in range(50)]}
+    payload = codec.dumps(job)
+    assert payload[:1] == b"Z"
+    assert len(payload) < len(json.dumps(job))
+    assert codec.loads(payload) == job
+
+
+def test_json_codec_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        JsonCodec().dumps({"bad": object()})
+
+
+def test_json_codec_rejects_newer_versions():
+    with pytest.raises(ValueError):
+        JsonCodec().loads(b"J" + bytes([JsonCodec.VERSION + 1]) + b"{}")
+
+
+def test_reads_legacy_pickled_rows(queue):
+    legacy = {"key": "old", "uploaded_at": datetime(2015, 1, 1)}
+    with queue._get_conn() as conn:
+        conn.execute("INSERT INTO queue (item) VALUES (?)", (pickle.dumps(legacy, 2),))
+    assert queue.popleft(sleep_wait=False) == legacy
+
+
+def test_pluggable_codec(tmp_path):
+    queue = SqliteQueue(str(tmp_path / "pickled.db"), codec=PickleCodec())
+    queue.append({"job": ("a", "tuple")})
+    assert queue.popleft(sleep_wait=False) == {"job": ("a", "tuple")}
+
+
+def test_priority_goes_first(queue):
+    queue.append({"job": "upload-1"})
+    queue.append({"job": "upload-2"})
+    queue.append({"job": "mass-tag"}, priority=PRIORITY_HIGH)
+    assert list(queue.peek(3)) == [{"job": "mass-tag"}, {"job": "upload-1"}, {"job": "upload-2"}]
+    assert queue.popleft(sleep_wait=False) == {"job": "mass-tag"}
+    assert queue.popleft(sleep_wait=False) == {"job": "upload-1"}
+
+
+def test_follow_up_items_keep_priority(queue):
+    queue.append({"job": "upload"})
+    queue.append({"job": "tag", "step": 1}, priority=PRIORITY_HIGH)
+    item_id, item = queue.claim("worker-1", sleep_wait=False)
+    queue.advance(item_id, "worker-1", {"job": "tag", "step": 2})
+    assert queue.popleft(sleep_wait=False) == {"job": "tag", "step": 2}
+
+
+def test_retried_bad_jobs_keep_priority(queue):
+    queue.append({"job": "upload"})
+    queue.append({"job": "tag"}, priority=PRIORITY_HIGH)
+    item_id, item = queue.claim("worker-1", sleep_wait=False)
+    queue.bury(item_id, "worker-1", item)
+    queue.retry_jobs()
+    assert queue.popleft(sleep_wait=False) == {"job": "tag"}
+
+
+def test_claim_by_stage(queue):
+    queue.append({"type": "upload", "key": "a", "step": "upload_and_store"})
+    queue.append({"type": "upload", "key": "b", "step": "flickr"})
+    queue.append({"type": "mass-tag", "key": "c"})
+    assert queue.claim("w1", sleep_wait=False, stages=["flickr", "gphotos"])[1]["key"] == "b"
+    assert queue.claim("w2", sleep_wait=False, stages=["local_process"])[1]["key"] == "a"
+    assert queue.claim("w3", sleep_wait=False, stages=["local_process"]) == (None, None)
+    assert queue.claim("w4", sleep_wait=False)[1]["key"] == "c"
+
+
+def test_next_step_moves_stage(queue):
+    queue.append({"type": "upload", "key": "a", "step": "upload_and_store"})
+    item_id, job = queue.claim("w1", sleep_wait=False, stages=["local_process"])
+    job["step"] = "gphotos"
+    queue.advance(item_id, "w1", job)
+    assert queue.claim("w1", sleep_wait=False, stages=["local_process"]) == (None, None)
+    assert queue.claim("w2", sleep_wait=False, stages=["gphotos"])[1]["key"] == "a"
+
+
+def test_job_stage():
+    assert job_stage({"type": "upload", "step": "upload_and_store"}) == "local_process"
+    assert job_stage({"step": "gphotos"}) == "gphotos"
+    assert job_stage({"type": "tag-day"}) == "tag-day"
+    assert job_stage("not a job") is None
+
+
+def test_upgrade_fills_stage_of_queued_jobs(tmp_path):
+    path = str(tmp_path / "old.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE queue (id INTEGER PRIMARY KEY AUTOINCREMENT, item BLOB)")
+        conn.execute(
+            "INSERT INTO queue (item) VALUES (?)",
+            (pickle.dumps({"type": "upload", "step": "flickr"}, 2),),
+        )
+    queue = SqliteQueue(path)
+    assert queue.claim("w1", sleep_wait=False, stages=["flickr"])[1] == {
+        "type": "upload",
+        "step": "flickr",
+    }
+
+
+def test_advance_keeps_place_in_line(queue):
+    queue.append({"key": "a", "step": 1})
+    queue.append({"key": "b", "step": 1})
+    item_id, job = queue.claim("w1", sleep_wait=False)
+    job["step"] = 2
+    assert queue.advance(item_id, "w1", job)
+    assert queue.claim("w1", sleep_wait=False) == (item_id, {"key": "a", "step": 2})
+
+
+def test_delayed_append(queue):
+    queue.append({"job": "later"}, delay=0.2)
+    queue.append({"job": "now"})
+    assert queue.popleft(sleep_wait=False) == {"job": "now"}
+    assert queue.popleft(sleep_wait=False) is None
+    started = time()
+    assert queue.popleft() == {"job": "later"}
+    # Waited for the item to be due, not for the polling fallback
+    assert time() - started < 1
+
+
+def test_retry_jobs_at_a_rate(queue):
+    for n in range(3):
+        queue.append_bad({"job": n})
+    queue.retry_jobs(rate=5)
+    assert queue.total_bad_jobs() == 0
+    assert len(queue) == 3
+    assert queue.pop_many(3, sleep_wait=False) == [{"job": 0}]
+    sleep(0.45)
+    assert queue.pop_many(3, sleep_wait=False) == [{"job": 1}, {"job": 2}]
+
+
+def test_lists_jobs_metadata(queue):
+    job = {"type": "upload", "key": "k1", "step": "flickr", "attempt": 0, "filename": "a.jpg"}
+    queue.append(job)
+    queue.append({"type": "tag-day", "key": "k2", "attempt": 0}, priority=PRIORITY_HIGH)
+    jobs = queue.list_jobs()
+    assert [j["key"] for j in jobs] == ["k2", "k1"]
+    assert jobs[1]["type"] == "upload"
+    assert jobs[1]["step"] == "flickr"
+    assert jobs[1]["filename"] == "a.jpg"
+    assert jobs[1]["attempt"] == 0
+    assert jobs[1]["enqueued_at"] <= time()
+    assert queue.count_by("type") == {"upload": 1, "tag-day": 1}
+    assert queue.count_by("step") == {"flickr": 1, None: 1}
+    with pytest.raises(ValueError):
+        queue.count_by("item")
+
+
+def test_metadata_follows_job(queue):
+    queue.append({"type": "upload", "key": "k1", "step": "flickr", "attempt": 0})
+    item_id, job = queue.claim("w1", sleep_wait=False)
+    job["attempt"] = 1
+    queue.retry(item_id, "w1", job, 0, "IOError: boom")
+    [listed] = queue.list_jobs()
+    assert listed["attempt"] == 1
+    assert listed["error"] == "IOError: boom"
+    job["step"] = "gphotos"
+    queue.claim("w1", sleep_wait=False)
+    queue.advance(item_id, "w1", job)
+    [listed] = queue.list_jobs()
+    assert listed["step"] == "gphotos"
+    assert listed["error"] is None
+
+    queue.claim("w1", sleep_wait=False)
+    queue.bury(item_id, "w1", job, "ValueError: bad")
+    [bad] = queue.list_bad_jobs()
+    assert bad["key"] == "k1"
+    assert bad["step"] == "gphotos"
+    assert bad["error"] == "ValueError: bad"
+    assert queue.count_by("type", bad=True) == {"upload": 1}
+    queue.retry_jobs()
+    assert queue.list_jobs()[0]["error"] == "ValueError: bad"
+
+
+def test_purge_bad_key(queue):
+    queue.append_bad({"key": "keep"})
+    queue.append_bad({"key": "remove"})
+    assert queue.purge_bad_key("remove") == 1
+    assert queue.purge_bad_key("missing") == 0
+    assert queue.get_bad_jobs() == [{"key": "keep"}]
+
+
+def test_upgrade_fills_metadata_of_stored_jobs(tmp_path):
+    path = str(tmp_path / "old.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE queue (id INTEGER PRIMARY KEY AUTOINCREMENT, item BLOB)")
+        conn.execute("CREATE TABLE bad_jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, item BLOB)")
+        conn.execute(
+            "INSERT INTO bad_jobs (item) VALUES (?)",
+            (pickle.dumps({"type": "mass-tag", "key": "old", "attempt": 4}, 2),),
+        )
+    queue = SqliteQueue(path)
+    [bad] = queue.list_bad_jobs()
+    assert (bad["type"], bad["key"], bad["attempt"]) == ("mass-tag", "old", 4)
+    assert queue.purge_bad_key("old") == 1
+
+
+def test_forked_item_waits_for_its_branches(queue):
+    queue.append({"key": "a", "step": "local"})
+    queue.append({"key": "b", "step": "local"})
+    item_id, job = queue.claim("w1", sleep_wait=False)
+    branches = [{"key": "a", "step": "x"}, {"key": "a", "step": "y"}]
+    assert queue.fork(item_id, "w1", {"key": "a", "step": "join"}, branches)
+
+    # Branches keep the place in line of their job, the job itself waits
+    taken = queue.claim_many("w1", 5, sleep_wait=False)
+    assert [job for _, job in taken] == branches + [{"key": "b", "step": "local"}]
+    (x_id, _), (y_id, _), (b_id, _) = taken
+    queue.ack(x_id, "w1")
+    assert queue.claim("w2", sleep_wait=False) == (None, None)
+    queue.ack(y_id, "w1")
+    assert queue.claim("w2", sleep_wait=False) == (item_id, {"key": "a", "step": "join"})
+
+
+def test_bad_branch_holds_its_job_until_purged(queue):
+    queue.append({"key": "a"})
+    item_id, job = queue.claim("w1", sleep_wait=False)
+    queue.fork(item_id, "w1", {"key": "a", "step": "join"}, [{"key": "a", "step": "x"}])
+    branch_id, branch = queue.claim("w1", sleep_wait=False)
+    queue.bury(branch_id, "w1", branch)
+    assert queue.claim("w1", sleep_wait=False) == (None, None)
+
+    # Retried branches still belong to their job
+    queue.retry_jobs()
+    branch_id, branch = queue.claim("w1", sleep_wait=False)
+    queue.bury(branch_id, "w1", branch)
+    assert queue.claim("w1", sleep_wait=False) == (None, None)
+
+    queue.purge_bad_key("a")
+    assert queue.claim("w1", sleep_wait=False)[1] == {"key": "a", "step": "join"}
@@ -0,0 +1,109 @@
+import os
+from io import BytesIO
+from unittest.mock import patch, Mock
+
+import piexif
+from PIL import Image
+
+from photolog.services import s3
+from photolog.services.api.base import (
+    generate_thumbnails,
+    encode_thumbnails,
+    thumb_size,
+    draft,
+    THUMBNAILS,
+)
+
+
+def make_jpeg(path, size, orientation=None):
+    image = Image.new("RGB", size, (200, 120, 40))
+    exif = piexif.dump({"0th": {piexif.ImageIFD.Orientation: orientation}} if orientation else {})
+    image.save(path, format="JPEG", exif=exif)
+    return path
+
+
+def test_thumb_size_rounds_like_pillow():
+    for size in [(6000, 4000), (4000, 6000), (4032, 3024), (1999, 1001), (5000, 37), (90, 80)]:
+        for dim in THUMBNAILS.values():
+            image = Image.new("1", size)
+            image.thumbnail((dim, dim))
+            assert thumb_size(size, dim) == image.size
+
+
+def test_thumbnails_are_cascaded_from_one_decode(tmp_path):
+    original = make_jpeg(str(tmp_path / "landscape.jpg"), (3000, 2000))
+    thumbs_folder = str(tmp_path)
+    with patch.object(Image, "open", wraps=Image.open) as opened:
+        thumbs = generate_thumbnails(original, thumbs_folder)
+
+    assert opened.call_count == 1
+    assert list(thumbs) == ["original", "thumb", "medium", "web", "large"]
+    sizes = {name: Image.open(path).size for name, path in thumbs.items()}
+    assert sizes == {
+        "original": (3000, 2000),
+        "thumb": (100, 67),
+        "medium": (320, 213),
+        "web": (1200, 800),
+        "large": (2048, 1365),
+    }
+
+
+def test_rotated_sizes_keep_exif_on_large_only(tmp_path):
+    # Orientation 6: stored landscape, displayed portrait
+    original = make_jpeg(str(tmp_path / "rotated.jpg"), (3000, 2000), orientation=6)
+    thumbs = generate_thumbnails(original, str(tmp_path), base_name="portrait.jpg")
+
+    large = Image.open(thumbs["large"])
+    assert large.size == (2048, 1365)
+    assert large.getexif()[piexif.ImageIFD.Orientation] == 6
+    assert Image.open(thumbs["web"]).size == (800, 1200)
+    assert Image.open(thumbs["thumb"]).size == (67, 100)
+    assert piexif.ImageIFD.Orientation not in Image.open(thumbs["thumb"]).getexif()
+    assert all(os.path.basename(path).startswith("portrait") for path in thumbs.values())
+
+
+def test_draft_uses_smallest_scale_meeting_the_size(tmp_path):
+    path = make_jpeg(str(tmp_path / "draft.jpg"), (800, 600))
+    assert draft(Image.open(path), (100, 75)) == 8
+    assert draft(Image.open(path), (100, 75), margin=2) == 4
+    assert draft(Image.open(path), (500, 375)) == 1
+    assert draft(Image.open(path), (100, 75), margin=None) == 1
+    assert draft(Image.new("RGB", (800, 600)), (100, 75)) == 1
+
+
+def test_draft_decoding_keeps_thumbnail_sizes(tmp_path):
+    original = make_jpeg(str(tmp_path / "big.jpg"), (4200, 2800))
+    with patch("photolog.services.api.base.draft", wraps=draft) as drafted:
+        thumbs = generate_thumbnails(original, str(tmp_path))
+    assert drafted.call_count == 1
+    assert Image.open(thumbs["large"]).size == (2048, 1365)
+    assert Image.open(thumbs["thumb"]).size == (100, 67)
+
+
+def test_thumbnails_encoded_in_memory(tmp_path):
+    original = make_jpeg(str(tmp_path / "memory.jpg"), (3000, 2000), orientation=6)
+    encoded = encode_thumbnails(original)
+
+    assert os.listdir(str(tmp_path)) == ["memory.jpg"]
+    assert list(encoded) == list(THUMBNAILS)
+    images = {name: Image.open(BytesIO(data)) for name, data in encoded.items()}
+    assert images["large"].size == (2048, 1365)
+    assert images["large"].getexif()[piexif.ImageIFD.Orientation] == 6
+    assert images["thumb"].size == (67, 100)
+
+
+def test_upload_objects_sends_files_and_bytes(tmp_path):
+    original = make_jpeg(str(tmp_path / "orig.jpg"), (10, 10))
+    client = Mock()
+    settings = Mock(S3_BUCKET="bucket")
+    with patch("photolog.services.s3.get_client", return_value=client):
+        urls = s3.upload_objects(
+            settings, {"original": ("o.jpg", original), "thumb": ("t.jpg", b"thumb")}, "2020/6"
+        )
+    assert urls == {
+        "original": "https://bucket.s3.amazonaws.com/2020/6/o.jpg",
+        "thumb": "https://bucket.s3.amazonaws.com/2020/6/t.jpg",
+    }
+    bodies = {call.kwargs["Key"]: call.kwargs["Body"] for call in client.put_object.call_args_list}
+    assert bodies["2020/6/t.jpg"] == b"thumb"
+    assert bodies["2020/6/o.jpg"].name == original
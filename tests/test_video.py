@@ -0,0 +1,152 @@
+import os
+import json
+import subprocess
+from datetime import datetime
+from unittest.mock import patch
+
+from photolog.services.api import base
+
+
+class FakeSettings(object):
+    THUMBS_FOLDER = "/thumbs"
+
+
+def _probe(stdout):
+    return subprocess.CompletedProcess([], 0, stdout=stdout, stderr=b"")
+
+
+def _write(path, content):
+    with open(path, "wb") as fh:
+        fh.write(content)
+    return str(path)
+
+
+def _grab_frame(cmd, **kwargs):
+    with open(cmd[-1], "wb") as fh:
+        fh.write(b"jpeg")
+    return _probe(b"")
+
+
+PROBE = {
+    "streams": [
+        {
+            "codec_type": "video",
+            "codec_name": "h264",
+            "width": 1920,
+            "height": 1080,
+            "side_data_list": [{"side_data_type": "Display Matrix", "rotation": -90}],
+        },
+        {"codec_type": "audio", "codec_name": "aac"},
+    ],
+    "format": {
+        "format_name": "mov,mp4,m4a,3gp,3g2,mj2",
+        "duration": "1200.480000",
+        "tags": {"creation_time": "2019-03-04T10:11:12.000000Z"},
+    },
+}
+
+
+def test_probe_video():
+    with patch("subprocess.run", return_value=_probe(json.dumps(PROBE).encode())) as run:
+        probe = base.probe_video(FakeSettings(), "/videos/clip.mp4")
+    assert run.call_count == 1
+    assert probe == {
+        "container": "mov,mp4,m4a,3gp,3g2,mj2",
+        "codecs": ["h264", "aac"],
+        "duration": 1200.48,
+        "width": 1080,  # Portrait, rotated
+        "height": 1920,
+        "rotation": 90,
+        "creation_time": "2019:03:04 10:11:12",
+    }
+
+
+def test_probe_video_without_clock_date():
+    data = json.loads(json.dumps(PROBE))
+    data["format"]["tags"]["creation_time"] = "1970-01-01T00:00:00.000000Z"
+    with patch("subprocess.run", return_value=_probe(json.dumps(data).encode())):
+        assert base.probe_video(FakeSettings(), "/videos/clip.mp4")["creation_time"] is None
+
+
+def test_probe_video_unreadable():
+    failed = subprocess.CompletedProcess([], 1, stdout=b"{}", stderr=b"Invalid data")
+    with patch("subprocess.run", return_value=failed):
+        assert base.probe_video(FakeSettings(), "/videos/broken.mp4") is None
+    with patch("subprocess.run", return_value=_probe(b"")):
+        assert base.probe_video(FakeSettings(), "/videos/broken.mp4") is None
+
+
+def test_video_duration():
+    with patch("subprocess.run", return_value=_probe(json.dumps(PROBE).encode())):
+        assert base.video_duration(FakeSettings(), "/videos/clip.mp4") == 1200.48
+
+
+def test_video_exif_from_probe(tmp_path):
+    video = _write(tmp_path / "clip.mp4", b"v" * 100)
+    probe = {
+        "container": "mov,mp4,m4a,3gp,3g2,mj2",
+        "width": 1080,
+        "height": 1920,
+        "creation_time": "2019:03:04 10:11:12",
+    }
+    with patch.object(base, "read_exif") as read_exif:
+        exif = base.video_exif(None, video, datetime(2020, 1, 1), None, "/thumb.jpg", probe)
+    read_exif.assert_not_called()
+    assert exif == {
+        "year": 2019,
+        "month": 3,
+        "day": 4,
+        "width": 1080,
+        "height": 1920,
+        "size": 100,
+        "timestamp": "2019:03:04 10:11:12",
+        "mime": "video/mp4",
+    }
+
+
+def test_video_exif_failed_probe_reads_thumbnail(tmp_path):
+    video = _write(tmp_path / "clip.mpg", b"v" * 100)
+    upload_date = datetime(2020, 1, 2)
+    dims = {"width": 640, "height": 480}
+    with patch.object(base, "read_exif", return_value=dims):
+        exif = base.video_exif(None, video, upload_date, None, "/thumb.jpg", {})
+    assert (exif["year"], exif["month"], exif["day"]) == (2020, 1, 2)
+    assert (exif["width"], exif["height"]) == (640, 480)
+    assert exif["timestamp"] == upload_date
+    assert exif["mime"] == "video/mpeg"
+
+
+def test_video_thumbnail_seeks_to_the_middle(tmp_path):
+    video = str(tmp_path / "clip.mp4")
+    with (
+        patch("subprocess.run", side_effect=_grab_frame) as call,
+        patch.object(base, "generate_thumbnails", return_value={"thumb": "t"}) as thumbs,
+    ):
+        result, output_dir = base.get_video_thumbnail(
+            FakeSettings(), video, "clip.mp4", "KEY", 1200.0
+        )
+
+    cmd = call.call_args.args[0]
+    assert cmd[cmd.index("-ss") + 1] == "600.000"
+    assert cmd.index("-ss") < cmd.index("-i")
+    assert cmd[cmd.index("-frames:v") + 1] == "1"
+    assert os.listdir(output_dir) == [base.POSTER_NAME]
+    assert thumbs.call_args.args[0] == os.path.join(output_dir, base.POSTER_NAME)
+    assert result == {"thumb": "t"}
+
+
+def test_video_thumbnail_placeholder_without_frame(tmp_path):
+    video = str(tmp_path / "broken.mp4")
+    with (
+        patch.object(base, "video_duration", return_value=None),
+        patch("subprocess.run", return_value=subprocess.CompletedProcess([], 1, b"", b"")) as call,
+        patch.object(base, "generate_thumbnails", return_value={}) as thumbs,
+    ):
+        _, output_dir = base.get_video_thumbnail(FakeSettings(), video, "broken.mp4", "KEY")
+
+    cmd = call.call_args.args[0]
+    assert cmd[cmd.index("-ss") + 1] == "0.000"
+    placeholder = thumbs.call_args.args[0]
+    assert placeholder == os.path.join(output_dir, "bare-thumb.png")
+    with open(placeholder, "rb") as fh:
+        assert fh.read() == base.VIDEO_PLACEHOLDER
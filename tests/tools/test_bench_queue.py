@@ -0,0 +1,55 @@
+import json
+
+from photolog.tools.bench_queue import run, percentile
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) is None
+
+
+def test_benchmark_reports_every_payload_size(tmp_path):
+    output = str(tmp_path / "bench.json")
+    run(
+        [
+            "--producers",
+            "2",
+            "--consumers",
+            "2",
+            "--jobs",
+            "20",
+            "--payload-sizes",
+            "10,2000",
+            "--output",
+            output,
+        ]
+    )
+    with open(output) as fh:
+        report = json.load(fh)
+    assert [r["payload_size"] for r in report["results"]] == [10, 2000]
+    for result in report["results"]:
+        assert result["jobs"] == result["dequeued"] == 40
+        assert result["latency_p50"] <= result["latency_p99"] <= result["latency_max"]
+        assert result["producer_lock_wait"] >= 0
+
+
+def test_benchmark_claims_in_batches(tmp_path):
+    output = str(tmp_path / "bench.json")
+    run(
+        [
+            "--jobs",
+            "25",
+            "--batch",
+            "10",
+            "--mode",
+            "claim",
+            "--payload-sizes",
+            "100",
+            "--output",
+            output,
+        ]
+    )
+    with open(output) as fh:
+        assert json.load(fh)["results"][0]["dequeued"] == 25
@@ -0,0 +1,23 @@
+import json
+
+from PIL import Image
+
+from photolog.tools.bench_thumbs import run, psnr
+
+
+def test_psnr():
+    image = Image.new("RGB", (10, 10), (100, 100, 100))
+    assert psnr(image, image) is None
+    assert round(psnr(image, Image.new("RGB", (10, 10), (110, 100, 100))), 1) == 32.9
+
+
+def test_benchmark_compares_margins_with_full_decode(tmp_path):
+    output = str(tmp_path / "bench.json")
+    run(["--size", "2400x1600", "--margins", "1", "--repeat", "1", "--output", output])
+    with open(output) as fh:
+        (image,) = json.load(fh)["images"]
+    full, drafted = image["results"]
+    assert full["margin"] == "full"
+    assert drafted["margin"] == 1
+    assert set(drafted["psnr"]) == {"thumb", "medium", "web", "large"}
+    assert all(value is None or value > 30 for value in drafted["psnr"].values())
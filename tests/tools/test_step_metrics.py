@@ -0,0 +1,22 @@
+import os
+import json
+
+from photolog.metrics import MetricsDB, measure
+from photolog.tools.step_metrics import run
+from tests.conftest import TEST_FILES
+
+
+def test_prints_step_percentiles(capsys):
+    path = os.path.join(TEST_FILES, "test_step_metrics_cli.db")
+    measures = []
+    with measure(measures, "upload", "local_process", "thumbs"):
+        pass
+    MetricsDB(path).record(measures)
+
+    run(["--db", path])
+    table = capsys.readouterr().out.splitlines()
+    assert table[0].split()[:3] == ["job_type", "step", "substep"]
+    assert table[1].split()[:4] == ["upload", "local_process", "thumbs", "1"]
+
+    run(["--db", path, "--json", "--type", "video"])
+    assert json.loads(capsys.readouterr().out) == []
@@ -1,4 +1,5 @@
 import os
+from hashlib import md5
 from unittest.mock import patch, MagicMock
 
 import pytest
@@ -12,6 +13,7 @@ from photolog.tools.uploader import (
     verify_exists,
     handle_file,
     upload_directories,
+    handle_files,
 )
 
 
@@ -166,7 +168,7 @@ def test_handle_file_upload_success(tmp_path):
     f.write_bytes(b"x" * 2048)
 
     mock_response = MagicMock()
-    mock_response.status_code = 201
+    mock_response.status_code = 202
 
     with (
         patch("photolog.tools.uploader.verify_exists", return_value=False),
@@ -205,7 +207,7 @@ def test_handle_file_with_target_date(tmp_path):
     f.write_bytes(b"x" * 2048)
 
     mock_response = MagicMock()
-    mock_response.status_code = 201
+    mock_response.status_code = 202
 
     with (
         patch("photolog.tools.uploader.verify_exists", return_value=False),
@@ -227,7 +229,7 @@ def test_upload_directories_filters_allowed_files(tmp_path):
 
     uploaded = []
 
-    def fake_handle(host, full_file, secret, tags, skip, halt, target_date):
+    def fake_handle(host, full_file, secret, tags, skip, halt, target_date, checksum=None):
         uploaded.append(full_file)
         return True
 
@@ -253,11 +255,11 @@ def test_upload_directories_images_before_raws(tmp_path):
 
     order = []
 
-    def fake_handle(host, full_file, *args, **kwargs):
-        order.append(os.path.basename(full_file))
-        return True
+    def fake_handle(host, full_files, *args, **kwargs):
+        order.extend(os.path.basename(full_file) for full_file in full_files)
+        return len(full_files)
 
-    with patch("photolog.tools.uploader.handle_file", side_effect=fake_handle):
+    with patch("photolog.tools.uploader.handle_files", side_effect=fake_handle):
         upload_directories(
             [str(tmp_path)],
             [],
@@ -302,3 +304,146 @@ def test_upload_directories_filelist(tmp_path):
         upload_directories([], [str(f)], "http://localhost/", "secret", "", "", False, None)
 
     assert len(uploaded) == 1
+
+
+def test_upload_directories_passes_checksums(tmp_path):
+    (tmp_path / "a.jpg").write_bytes(b"a" * 2048)
+    (tmp_path / "b.jpg").write_bytes(b"b" * 2048)
+
+    checksums = {}
+
+    def fake_handle(host, full_files, secret, tags, skip, halt, target_date, sums):
+        checksums.update(zip((os.path.basename(f) for f in full_files), sums))
+        return len(full_files)
+
+    with patch("photolog.tools.uploader.handle_files", side_effect=fake_handle):
+        upload_directories(
+            [str(tmp_path)], [], "http://localhost/", "secret", "", "", False, None, 2
+        )
+
+    assert checksums == {
+        "a.jpg": md5(b"a" * 2048).hexdigest(),
+        "b.jpg": md5(b"b" * 2048).hexdigest(),
+    }
+
+
+def test_verify_exists_uses_given_checksum(tmp_path):
+    f = tmp_path / "photo.jpg"
+    f.write_bytes(b"x" * 2048)
+    mock_response = MagicMock()
+    mock_response.status_code = 404
+    with (
+        patch("photolog.tools.uploader.requests.get", return_value=mock_response) as get,
+        patch("photolog.tools.uploader.file_checksum") as file_checksum,
+    ):
+        verify_exists("http://localhost/", str(f), "secret", "known")
+    file_checksum.assert_not_called()
+    assert get.call_args.kwargs["params"]["checksum"] == "known"
+
+
+def test_upload_directories_groups_photos_and_sends_videos_alone(tmp_path):
+    for n in range(5):
+        (tmp_path / ("photo%s.jpg" % n)).write_bytes(b"x" * 2048)
+    (tmp_path / "clip.mp4").write_bytes(b"x" * 2048)
+
+    requests_sent = []
+
+    def fake_handle_files(host, full_files, *args):
+        requests_sent.append([os.path.basename(f) for f in full_files])
+        return len(full_files)
+
+    def fake_handle_file(host, full_file, *args, **kwargs):
+        requests_sent.append([os.path.basename(full_file)])
+        return True
+
+    with (
+        patch("photolog.tools.uploader.GROUP_FILES", 3),
+        patch("photolog.tools.uploader.handle_files", side_effect=fake_handle_files),
+        patch("photolog.tools.uploader.handle_file", side_effect=fake_handle_file),
+    ):
+        upload_directories([str(tmp_path)], [], "http://localhost/", "secret", "", "", False, None)
+
+    assert requests_sent == [
+        ["photo0.jpg", "photo1.jpg", "photo2.jpg"],
+        ["photo3.jpg", "photo4.jpg"],
+        ["clip.mp4"],
+    ]
+
+
+def test_handle_files_posts_new_files_in_one_request(tmp_path):
+    new = [tmp_path / "new1.jpg", tmp_path / "new2.arw"]
+    for f in new:
+        f.write_bytes(b"x" * 2048)
+    old = tmp_path / "old.jpg"
+    old.write_bytes(b"o" * 2048)
+    tiny = tmp_path / "tiny.jpg"
+    tiny.write_bytes(b"x" * 10)
+
+    mock_response = MagicMock()
+    mock_response.status_code = 202
+
+    with (
+        patch(
+            "photolog.tools.uploader.verify_exists",
+            side_effect=lambda host, full_file, *args: full_file == str(old),
+        ),
+        patch("photolog.tools.uploader.requests.post", return_value=mock_response) as post,
+    ):
+        files = [str(new[0]), str(old), str(tiny), str(new[1])]
+        uploaded = handle_files("http://localhost/", files, "secret", "", "", False, "2024-01-01")
+
+    assert uploaded == 2
+    post.assert_called_once()
+    kwargs = post.call_args.kwargs
+    assert [(field, part[0]) for field, part in kwargs["files"]] == [
+        ("photo_file", "new1.jpg"),
+        ("photo_file", "new2.arw"),
+    ]
+    assert kwargs["data"]["target_date"] == "2024-01-01"
+
+
+def test_handle_files_nothing_new(tmp_path):
+    f = tmp_path / "old.jpg"
+    f.write_bytes(b"x" * 2048)
+    with (
+        patch("photolog.tools.uploader.verify_exists", return_value=True),
+        patch("photolog.tools.uploader.requests.post") as post,
+    ):
+        assert handle_files("http://localhost/", [str(f)], "secret", "", "", False, None) == 0
+    post.assert_not_called()
+
+
+def test_handle_files_logs_failed_batch(tmp_path):
+    f = tmp_path / "new.jpg"
+    f.write_bytes(b"x" * 2048)
+    mock_response = MagicMock()
+    mock_response.status_code = 500
+    mock_response.text = "Internal error"
+
+    with (
+        patch("photolog.tools.uploader.verify_exists", return_value=False),
+        patch("photolog.tools.uploader.requests.post", return_value=mock_response),
+        patch("photolog.tools.uploader.log") as log,
+    ):
+        assert handle_files("http://localhost/", [str(f)], "secret", "", "", False, None) == 0
+
+    message = log.error.call_args.args[0]
+    assert "500" in message
+    assert "Internal error" in message
+    assert str(f) in message
+
+
+def test_handle_file_retries_connection_errors(tmp_path):
+    f = tmp_path / "photo.jpg"
+    f.write_bytes(b"x" * 2048)
+    mock_response = MagicMock()
+    mock_response.status_code = 202
+
+    with (
+        patch(
+            "photolog.tools.uploader.verify_exists",
+            side_effect=[requests.ConnectionError(), False],
+        ),
+        patch("photolog.tools.uploader.requests.post", return_value=mock_response),
+    ):
+        assert handle_file("http://localhost/", str(f), "secret", "", "", False, None)
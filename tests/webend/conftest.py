@@ -8,7 +8,7 @@ WEBEND_TESTS_DIR = os.path.dirname(__file__)
 # Must be set before importing photolog.web.main
 os.environ["SETTINGS"] = os.environ.get("SETTINGS", "/tmp/test_settings.yaml")
 
-from photolog.web.main import app, db, queue, user, login_manager  # noqa: E402
+from photolog.web.main import app, db, queue, metrics, user, login_manager  # noqa: E402
 
 # Configure login manager for testing
 login_manager.login_view = "login"
@@ -54,6 +54,7 @@ def reset_web_db(setup_test_files):
     # Clear connections
     db._connection_cache.clear()
     queue._connection_cache.clear()
+    metrics._connection_cache.clear()
 
     # Drop and recreate tables
     with db._get_conn() as conn:
@@ -69,11 +70,17 @@ def reset_web_db(setup_test_files):
         for table in queue._create:
             conn.execute(table)
 
+    with metrics._get_conn() as conn:
+        conn.execute("DROP TABLE IF EXISTS step_metrics")
+        for table in metrics._create:
+            conn.execute(table)
+
     yield
 
     # Cleanup after test
     db._connection_cache.clear()
     queue._connection_cache.clear()
+    metrics._connection_cache.clear()
 
 
 @pytest.fixture
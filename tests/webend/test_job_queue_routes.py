@@ -1,7 +1,8 @@
 """Tests for job queue management routes"""
 
 import uuid
-from photolog.web.main import queue
+from photolog.metrics import measure
+from photolog.web.main import queue, metrics
 
 
 class TestViewQueueRoute:
@@ -116,11 +117,14 @@ class TestBadJobsRoute:
         assert len(data) > 100
 
     def test_bad_jobs_shows_jobs_with_details(self, authenticated_client):
-        """Bad jobs are displayed with full details"""
-        # Add a bad job - would need to directly insert into db
-        # For now just test the page renders
+        """Bad jobs are displayed with their metadata and last error"""
+        queue.append_bad(
+            {"type": "tag-day", "key": "bad-key", "attempt": 3}, error="ValueError: nope"
+        )
         response = authenticated_client.get("/jobs/bad/")
         assert response.status_code == 200
+        assert b"bad-key" in response.data
+        assert b"ValueError: nope" in response.data
 
 
 class TestPurgeFormRoute:
@@ -185,8 +189,40 @@ class TestPurgeBadJobRoute:
         )
         assert response.status_code == 200
 
+    def test_purge_bad_job_only_removes_that_key(self, authenticated_client):
+        """POST removes the bad job with the given key and keeps the rest"""
+        queue.append_bad({"type": "tag-day", "key": "test-key", "attempt": 3})
+        queue.append_bad({"type": "tag-day", "key": "other-key", "attempt": 3})
+        authenticated_client.post("/jobs/bad/purge/", data={"job_key": "test-key"})
+        assert [job["key"] for job in queue.list_bad_jobs()] == ["other-key"]
+
     def test_purge_bad_job_missing_key(self, authenticated_client):
         """POST without job_key handled gracefully"""
         response = authenticated_client.post("/jobs/bad/purge/", data={}, follow_redirects=False)
         # Should either error or redirect
         assert response.status_code in [302, 400]
+
+
+class TestMetricsRoute:
+    """GET /jobs/metrics/ - Step timings"""
+
+    def test_metrics_requires_login(self, web_client):
+        """GET requires authentication"""
+        response = web_client.get("/jobs/metrics/")
+        assert response.status_code == 302
+
+    def test_metrics_shows_step_percentiles(self, authenticated_client):
+        """GET lists the recorded steps of the requested job type"""
+        measures = []
+        with measure(measures, "upload", "local_process", "thumbs") as current:
+            current.bytes = 2048
+        with measure(measures, "tag-day", "tag_day"):
+            pass
+        metrics.record(measures)
+
+        response = authenticated_client.get("/jobs/metrics/?type=upload")
+        assert response.status_code == 200
+        data = response.get_data(as_text=True)
+        assert "thumbs" in data
+        assert "2.0KB" in data
+        assert "tag_day" not in data
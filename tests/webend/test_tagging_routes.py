@@ -189,6 +189,17 @@ class TestMassTagRoute:
         assert job_data["keys"][2] == multiple_pictures[2]["key"]
         assert "batch-tag" in job_data["tags"]
 
+    def test_mass_tag_jumps_ahead_of_uploads(self, authenticated_client, multiple_pictures):
+        """Mass tag jobs are queued with high priority"""
+        queue.append({"type": "upload", "key": "upload-key", "attempt": 0})
+        authenticated_client.post(
+            "/edit/tags/",
+            data={"keys": f"http://example.com/photo/{multiple_pictures[0]['key']}/", "tags": "x"},
+        )
+
+        assert queue.popleft(sleep_wait=False)["type"] == "mass-tag"
+        assert queue.popleft(sleep_wait=False)["type"] == "upload"
+
     def test_mass_tag_post_empty_tags_no_op(self, authenticated_client, multiple_pictures):
         """POST with empty tags doesn't queue"""
         urls = "\n".join(